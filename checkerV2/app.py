@@ -9,16 +9,17 @@
 from flask import Flask, render_template, request, redirect, url_for, jsonify, flash
 from werkzeug.utils import secure_filename
 import os, uuid, logging, json, re, time, random, math
-from collections import Counter
+import copy, functools, hashlib, inspect, io, threading
+from collections import Counter, OrderedDict
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from concurrent.futures import ThreadPoolExecutor
 
 # === 外部安全檢查代理（可選） ===
 try:
-    from 安全檢查代理人 import get_checker
+    from 安全檢查代理人 import get_checker, init_checker
 except Exception:
-    get_checker = None
+    get_checker = init_checker = None
 
 # === AI SDKs ===
 import anthropic
@@ -38,6 +39,12 @@ try:
 except Exception:
     Document = None
 
+# === 可選：orjson 加速 LLM 回應解析與提詞內 JSON 序列化 ===
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # === HTML 安全清洗（防 XSS） ===
 try:
     import bleach
@@ -135,6 +142,10 @@ def _backoff_sleep(attempt):
 # ----------------------------------------------------------------------
 SECURITY_AGENT_ENABLED = env_bool("SECURITY_AGENT_ENABLED", True)
 SECURITY_AGENT_MUST_PASS = env_bool("SECURITY_AGENT_MUST_PASS", True)
+# 啟動時於背景預載安全檢查代理人，第一個批改請求不必等待初始化
+SECURITY_AGENT_PREWARM = env_bool("SECURITY_AGENT_PREWARM", True)
+if SECURITY_AGENT_ENABLED and SECURITY_AGENT_PREWARM and init_checker is not None:
+    init_checker()
 UNIFY_TABLE_STYLE = env_bool("UNIFY_TABLE_STYLE", True)
 
 # ----------------------------------------------------------------------
@@ -164,40 +175,60 @@ def calc_score_gap(g_score: int, c_score: int, max_score: int) -> tuple[int, flo
 # ----------------------------------------------------------------------
 # 小工具與表格（整數化顯示）
 # ----------------------------------------------------------------------
+def _item_sort_key(it):
+    iid = str(it.get("item_id",""))
+    m = re.findall(r"\d+", iid)
+    return (int(m[0]) if m else 9999, iid)
+
 def _sort_items_by_id(items):
-    def _key(it):
-        iid = str(it.get("item_id",""))
-        m = re.findall(r"\d+", iid)
-        return (int(m[0]) if m else 9999, iid)
-    return sorted(items or [], key=_key)
+    return sorted(items or [], key=_item_sort_key)
 
 def _fmt_item_id(iid: str) -> str:
     s = str(iid or "").strip()
     return f"Q{s}" if re.fullmatch(r"\d+", s) else s
 
-def render_final_table(items, total_score):
-    items = _sort_items_by_id(items)
-    rows = []
-    for it in items:
-        rows.append(f"""
+def _final_table_row(it, iid=None):
+    if iid is None:
+        iid = _fmt_item_id(it.get('item_id',''))
+    return f"""
         <tr>
-          <td>{_fmt_item_id(it.get('item_id',''))}</td>
+          <td>{iid}</td>
           <td style="text-align:center">{i(it.get('max_score',0))}</td>
           <td style="text-align:center">{i(it.get('final_score',0))}</td>
           <td>{it.get('comment','')}</td>
         </tr>
-        """)
+        """
+
+def _final_table_html(rows_html, total_score):
     html = f"""
     <table class="table">
       <thead><tr><th>題目編號</th><th>題目配分</th><th>學生得分</th><th>批改意見</th></tr></thead>
       <tbody>
-        {''.join(rows)}
+        {rows_html}
         <tr class="total"><td>總分</td><td></td><td style="text-align:center">{i(total_score)}</td><td></td></tr>
       </tbody>
     </table>
     """
     return sanitize_html(html)
 
+def render_final_table(items, total_score):
+    items = _sort_items_by_id(items)
+    return _final_table_html("".join(_final_table_row(it) for it in items), total_score)
+
+def render_final_tables(item_lists, totals):
+    """
+    一次渲染多張逐題對齊的結果表（各串列同長度、第 k 筆為同一題，如 GPT / Claude / 最終）
+    題號排序與格式化只做一次，單次走訪把各列寫入各表的緩衝區；輸出與逐張呼叫 render_final_table 相同
+    """
+    first = item_lists[0]
+    order = sorted(range(len(first)), key=lambda k: _item_sort_key(first[k]))
+    bufs = [io.StringIO() for _ in item_lists]
+    for k in order:
+        iid = _fmt_item_id(first[k].get('item_id',''))
+        for buf, items in zip(bufs, item_lists):
+            buf.write(_final_table_row(items[k], iid))
+    return [_final_table_html(buf.getvalue(), total) for buf, total in zip(bufs, totals)]
+
 def render_grader_table(items, total_score):
     items = _sort_items_by_id(items)
     rows = []
@@ -281,45 +312,55 @@ def decorate_comment_by_outcome(raw: str, outcome: str) -> str:
 # ----------------------------------------------------------------------
 # 配分解析
 # ----------------------------------------------------------------------
+def _compile_hint(env_name: str, flags: int):
+    """編譯環境變數提供的自訂正則；格式錯誤時記錄警告並忽略"""
+    hint = _strip_inline_comment(os.getenv(env_name))
+    if not hint:
+        return None
+    try:
+        return re.compile(hint, flags)
+    except re.error as e:
+        logger.warning(f"{env_name} 正則格式錯誤，已忽略: {e}")
+        return None
+
+# 配分與題號的正則在載入時編譯一次（每份答案、每題都會用到）
+_SCORE_PATTERNS = [p for p in [
+    _compile_hint("QUESTION_SCORE_HINT", re.I),
+    re.compile(r'(?:配分|分值|分數|得分)\s*[:：]?\s*(\d+(?:\.\d+)?)\s*分?', re.I),
+    re.compile(r'(?:總分|滿分|full\s*score)\s*[:：]?\s*(\d+(?:\.\d+)?)\s*分?', re.I),
+    re.compile(r'\(\s*(\d+(?:\.\d+)?)\s*(?:分|points?|pts?)\s*\)', re.I),
+    re.compile(r'\[\s*(\d+(?:\.\d+)?)\s*(?:分|points?|pts?)\s*\]', re.I),
+    re.compile(r'(?:Points?|Score|Marks?)\s*[:：]?\s*(\d+(?:\.\d+)?)', re.I),
+    re.compile(r'(?:共|總共|total)\s*(\d+(?:\.\d+)?)\s*分', re.I),
+    re.compile(r'\(\s*(\d+(?:\.\d+)?)\s*\)$', re.I),
+] if p is not None]
+
 def extract_question_score(question_text: str, fallback_score: float = 10.0) -> float:
     if not question_text:
         return fallback_score
-    score_hint = _strip_inline_comment(os.getenv("QUESTION_SCORE_HINT"))
-    score_patterns = [
-        score_hint,
-        r'(?:配分|分值|分數|得分)\s*[:：]?\s*(\d+(?:\.\d+)?)\s*分?',
-        r'(?:總分|滿分|full\s*score)\s*[:：]?\s*(\d+(?:\.\d+)?)\s*分?',
-        r'\(\s*(\d+(?:\.\d+)?)\s*(?:分|points?|pts?)\s*\)',
-        r'\[\s*(\d+(?:\.\d+)?)\s*(?:分|points?|pts?)\s*\]',
-        r'(?:Points?|Score|Marks?)\s*[:：]?\s*(\d+(?:\.\d+)?)',
-        r'(?:共|總共|total)\s*(\d+(?:\.\d+)?)\s*分',
-        r'\(\s*(\d+(?:\.\d+)?)\s*\)$',
-    ]
-    score_patterns = [p for p in score_patterns if p]
-    for pattern in score_patterns:
+    for pattern in _SCORE_PATTERNS:
         try:
-            matches = re.findall(pattern, question_text, re.I)
+            matches = pattern.findall(question_text)
             if matches:
                 score = float(matches[0])
                 if 0 < score <= 1000:
                     logger.info(f"從題目文本提取到配分: {score}")
                     return score
-        except (ValueError, re.error) as e:
-            logger.warning(f"配分解析模式 '{pattern}' 執行錯誤: {e}")
+        except ValueError as e:
+            logger.warning(f"配分解析模式 '{pattern.pattern}' 執行錯誤: {e}")
             continue
     logger.info(f"未能提取配分，使用預設值: {fallback_score}")
     return fallback_score
 
-SPLIT_HINT = _strip_inline_comment(os.getenv("QUESTION_SPLIT_HINT"))
+SPLIT_HINT = _compile_hint("QUESTION_SPLIT_HINT", re.I|re.M)
 _Q_PATTERNS = [
-    r'(?im)^\s*(?:Q|第)\s*(\d{1,3})\s*(?:題)?[).。：:\-、]\s*',
-    r'(?im)^\s*(\d{1,3})\s*[).、：:]\s*',
+    re.compile(r'(?im)^\s*(?:Q|第)\s*(\d{1,3})\s*(?:題)?[).。：:\-、]\s*'),
+    re.compile(r'(?im)^\s*(\d{1,3})\s*[).、：:]\s*'),
 ]
 def split_by_question(text: str) -> dict[str, str]:
     text = text or ""
     if SPLIT_HINT:
-        pat = re.compile(SPLIT_HINT, re.I|re.M)
-        matches = list(pat.finditer(text))
+        matches = list(SPLIT_HINT.finditer(text))
         if not matches:
             return {"1": text.strip()}
         parts = []
@@ -333,8 +374,7 @@ def split_by_question(text: str) -> dict[str, str]:
             if qid and chunk:
                 parts.append((str(int(qid)), chunk))
         return {k:v for k,v in parts} if parts else {"1": text.strip()}
-    for pat in _Q_PATTERNS:
-        rg = re.compile(pat)
+    for rg in _Q_PATTERNS:
         matches = list(rg.finditer(text))
         if not matches:
             continue
@@ -419,20 +459,29 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 openai_client = None
 claude_client = None
 gemini_model = None
+
+def _pooled_http_client():
+    """長連線 HTTP client（HTTP/2 + keep-alive 連線池），避免每次請求重新 TLS 握手；未安裝 h2 時退回 HTTP/1.1"""
+    import httpx
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+    try:
+        return httpx.Client(http2=True, limits=limits)
+    except ImportError:
+        return httpx.Client(limits=limits)
 resolved_openai_model = None
 resolved_claude_model = None
 resolved_gemini_model = None
 
 if OPENAI_API_KEY:
     try:
-        openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
+        openai_client = openai.OpenAI(api_key=OPENAI_API_KEY, http_client=_pooled_http_client())
         logger.info("✅ OpenAI client 初始化")
     except Exception as e:
         logger.error("OpenAI 初始化失敗: %s", e)
 
 if ANTHROPIC_API_KEY:
     try:
-        claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY)
+        claude_client = anthropic.Anthropic(api_key=ANTHROPIC_API_KEY, http_client=_pooled_http_client())
         logger.info("✅ Anthropic client 初始化")
     except Exception as e:
         logger.error("Anthropic 初始化失敗: %s", e)
@@ -496,17 +545,27 @@ ALLOWED_EXT = _allowed_exts()
 def allowed_file(fname: str) -> bool:
     return os.path.splitext(fname)[1].lower() in ALLOWED_EXT
 
-def read_text(path: str) -> str:
-    ext = os.path.splitext(path)[1].lower()
+def read_text(src, filename: str | None = None) -> str:
+    """讀取 txt / docx / pdf 文字；src 可為路徑或檔案物件（如上傳的 FileStorage.stream，副檔名取自 filename）"""
+    if hasattr(src, "read"):
+        ext = os.path.splitext(filename or getattr(src, "name", "") or "")[1].lower()
+        data = src.read()
+        if ext == ".txt":
+            # 與文字模式開檔相同：統一換行為 \n
+            return data.decode("utf-8", errors="ignore").replace("\r\n", "\n").replace("\r", "\n")
+        src = io.BytesIO(data)
+    else:
+        ext = os.path.splitext(src)[1].lower()
     if ext == ".txt":
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        with open(src, "r", encoding="utf-8", errors="ignore") as f:
             return f.read()
     if ext == ".docx":
         if not Document: raise RuntimeError("未安裝 python-docx，無法讀取 DOCX")
-        doc = Document(path); return "\n".join(p.text for p in doc.paragraphs)
+        doc = Document(src); return "\n".join(p.text for p in doc.paragraphs)
     if ext == ".pdf":
         if not fitz: raise RuntimeError("未安裝 PyMuPDF，無法讀取 PDF")
-        text=[]; doc = fitz.open(path)
+        text=[]
+        doc = fitz.open(stream=src.getvalue(), filetype="pdf") if isinstance(src, io.BytesIO) else fitz.open(src)
         for p in doc: text.append(p.get_text())
         doc.close(); return "\n".join(text)
     raise ValueError(f"不支援的檔案格式: {ext}")
@@ -514,6 +573,24 @@ def read_text(path: str) -> str:
 # ----------------------------------------------------------------------
 # JSON / Anthropic 工具
 # ----------------------------------------------------------------------
+def _json_loads(s: str):
+    """解析 JSON；有 orjson 時優先使用，orjson 不接受的內容（如 NaN / Infinity 等非標準值）再交給 json"""
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(s)
+
+def _json_text(obj) -> str:
+    """序列化成 JSON 字串（保留中文）以嵌入提詞；有 orjson 時使用其精簡輸出"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
 def extract_json_best_effort(text: str):
     if not text: return None
     def _sanitize(s: str) -> str:
@@ -523,18 +600,18 @@ def extract_json_best_effort(text: str):
         s = re.sub(r',\s*([}\]])', r'\1', s)
         return s
     t = (text or "").strip()
-    try: return json.loads(_sanitize(t))
+    try: return _json_loads(_sanitize(t))
     except Exception: pass
     if "```json" in t:
         s = t.find("```json")+7; e = t.find("```", s)
         if e != -1:
             cand = _sanitize(t[s:e].strip())
-            try: return json.loads(cand)
+            try: return _json_loads(cand)
             except Exception: pass
     try:
         s = t.find("{"); e = t.rfind("}")
         if s!=-1 and e!=-1 and e>s:
-            cand = _sanitize(t[s:e+1]); return json.loads(cand)
+            cand = _sanitize(t[s:e+1]); return _json_loads(cand)
     except Exception: pass
     return None
 
@@ -546,9 +623,79 @@ def anthropic_text(resp):
         else: out.append(getattr(p, "text", "") or "")
     return "".join(out).strip()
 
+# ----------------------------------------------------------------------
+# 批改結果快取：相同代理人 + 提詞 + 題目 + 答案（溫度 0）直接重用先前的結果
+# 記憶體 LRU；GRADER_CACHE_PERSIST 開啟時另存 Mongo 集合 grader_cache 供跨行程共用（TTL 到期自動刪除）
+# 帶同儕摘要（共識回合）的呼叫與失敗結果不快取
+# ----------------------------------------------------------------------
+GRADER_CACHE_SIZE = env_int("GRADER_CACHE_SIZE", 512)
+GRADER_CACHE_PERSIST = env_bool("GRADER_CACHE_PERSIST", False)
+GRADER_CACHE_TTL = env_int("GRADER_CACHE_TTL", 7 * 24 * 3600)
+_grader_cache: "OrderedDict[str, dict]" = OrderedDict()
+_grader_cache_lock = threading.Lock()
+
+def _grader_cache_get(key: str):
+    with _grader_cache_lock:
+        res = _grader_cache.get(key)
+        if res is not None:
+            _grader_cache.move_to_end(key)
+            return res
+    if GRADER_CACHE_PERSIST:
+        try:
+            doc = col_grader_cache.find_one({"_id": key}, {"result": 1})
+        except Exception as e:
+            logger.warning(f"批改快取讀取失敗: {e}")
+            return None
+        if doc:
+            _grader_cache_put(key, doc["result"], persist=False)
+            return doc["result"]
+    return None
+
+def _grader_cache_put(key: str, res: dict, persist: bool = True):
+    with _grader_cache_lock:
+        _grader_cache[key] = res
+        _grader_cache.move_to_end(key)
+        while len(_grader_cache) > GRADER_CACHE_SIZE:
+            _grader_cache.popitem(last=False)
+    if persist and GRADER_CACHE_PERSIST:
+        try:
+            col_grader_cache.replace_one(
+                {"_id": key},
+                {"_id": key, "result": res, "created_at": datetime.now(timezone.utc)},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"批改快取寫入失敗: {e}")
+
+def _cached_grader(fn):
+    """批改函式快取包裝：以 SHA-256(函式名稱 + 全部參數) 為鍵，命中時回傳深拷貝，呼叫端可自由修改"""
+    sig = inspect.signature(fn)
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if GRADER_CACHE_SIZE <= 0:
+            return fn(*args, **kwargs)
+        bound = sig.bind(*args, **kwargs)
+        bound.apply_defaults()
+        if bound.arguments.get("peer_notes"):
+            return fn(*args, **kwargs)
+        key = hashlib.sha256(
+            json.dumps([fn.__name__, bound.arguments], ensure_ascii=False, default=str).encode("utf-8")
+        ).hexdigest()
+        cached = _grader_cache_get(key)
+        if cached is not None:
+            logger.debug(f"批改快取命中 ({fn.__name__})")
+            return copy.deepcopy(cached)
+        res = fn(*args, **kwargs)
+        if res.get("model") not in (None, "unavailable") and (res.get("rubric") or {}).get("items"):
+            _grader_cache_put(key, copy.deepcopy(res))
+        return res
+    return wrapper
+
 # ----------------------------------------------------------------------
 # GPT / Claude 調用
 # ----------------------------------------------------------------------
+@_cached_grader
 def call_gpt_grader(exam, answer, prompt_text, peer_notes: str | None = None):
     if not openai_client:
         return {"agent":"gpt","score":0,"feedback":"OpenAI 不可用","rubric":{"items":[],"total_score":0},"raw":""}
@@ -627,6 +774,7 @@ def call_gpt_grader(exam, answer, prompt_text, peer_notes: str | None = None):
             "part2_student":data.get("part2_student",""),"part3_analysis":data.get("part3_analysis",""),
             "part4_table":table_html,"raw":raw}
 
+@_cached_grader
 def call_claude_grader(exam, answer, prompt_text, expected_items_count: int | None = None, expected_item_ids: list[str] | None = None, peer_notes: str | None = None):
     if not claude_client:
         return {"agent":"claude","score":0,"feedback":"Claude 不可用","rubric":{"items":[],"total_score":0},"raw":""}
@@ -780,10 +928,10 @@ def call_gemini_arbitration(exam, answer, prompt_text, gpt_res, claude_res):
 {guard_wrap("學生答案", answer)}
 
 【GPT 批改（僅供參考，請勿直接抄寫）】
-{json.dumps(gpt_res, ensure_ascii=False)}
+{_json_text(gpt_res)}
 
 【Claude 批改（僅供參考，請勿直接抄寫）】
-{json.dumps(claude_res, ensure_ascii=False)}
+{_json_text(claude_res)}
 """
     try:
         resp = gemini_model.generate_content(arb_prompt)
@@ -868,16 +1016,16 @@ def run_prompt_autotune(subject: str, current_prompt: str, context: dict):
 {current_prompt}
 
 【本次批改摘要（可視為原始資料）】
-- 項目配分：{json.dumps(expected_scores, ensure_ascii=False)}
+- 項目配分：{_json_text(expected_scores)}
 - GPT 總分：{gpt_res.get('score', 0)}
 - Claude 總分：{claude_res.get('score', 0)}
 - 最終總分：{arbitration.get('final_score', 0)}
 - 仲裁理由：{arbitration.get('reason', '')}
 
 【左右代理逐題評論與最終彙整（JSON）】
-GPT: {json.dumps(gpt_res, ensure_ascii=False)}
-CLAUDE: {json.dumps(claude_res, ensure_ascii=False)}
-FINAL: {json.dumps(arbitration, ensure_ascii=False)}
+GPT: {_json_text(gpt_res)}
+CLAUDE: {_json_text(claude_res)}
+FINAL: {_json_text(arbitration)}
 """
     try:
         resp = gemini_model.generate_content(prompt)
@@ -918,7 +1066,10 @@ _EMB_CACHE: dict[str, list[float]] = {}
 
 _EMB_CACHE: dict[str, list[float]] = {}
 
-import hashlib
+def _emb_cache_key(text: str) -> str:
+    # 使用穩定的 SHA256 雜湊替代不穩定的 hash()
+    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
+    return f"gemini:{EMBEDDING_MODEL_NAME}:{text_hash}"
 
 def _get_embedding(text: str) -> list[float]:
     """
@@ -930,9 +1081,7 @@ def _get_embedding(text: str) -> list[float]:
         logger.error("❌ 未設定 GEMINI_API_KEY，無法使用 Gemini Embedding")
         return []
 
-    # 使用穩定的 SHA256 雜湊替代不穩定的 hash()
-    text_hash = hashlib.sha256(text.encode('utf-8')).hexdigest()
-    key = f"gemini:{EMBEDDING_MODEL_NAME}:{text_hash}"
+    key = _emb_cache_key(text)
     
     if key in _EMB_CACHE:
         logger.debug(f"📋 Embedding 快取命中 (text_len={len(text)})")
@@ -1014,6 +1163,30 @@ def _get_embedding(text: str) -> list[float]:
         return []
 
 
+def _get_embeddings(texts: list[str]) -> list[list[float]]:
+    """
+    一次取得多段文字的 embedding（與 texts 同順序）：快取未命中的文字合併為單一 embed_content 請求，
+    回傳格式無法逐筆對應時改為逐筆呼叫 _get_embedding
+    """
+    keys = [_emb_cache_key(t) for t in texts]
+    missing = list(dict.fromkeys(t for t, k in zip(texts, keys) if k not in _EMB_CACHE))
+    if len(missing) > 1 and GEMINI_API_KEY:
+        try:
+            logger.info(f"🔎 批次呼叫 Gemini Embedding (model={EMBEDDING_MODEL_NAME}, n={len(missing)})")
+            resp = genai.embed_content(
+                model=EMBEDDING_MODEL_NAME,
+                content=missing,
+                task_type="semantic_similarity"
+            )
+            vecs = resp.get("embedding") if isinstance(resp, dict) else getattr(resp, "embedding", None)
+            if (isinstance(vecs, (list, tuple)) and len(vecs) == len(missing)
+                    and all(isinstance(v, (list, tuple)) and v for v in vecs)):
+                for t, v in zip(missing, vecs):
+                    _EMB_CACHE[_emb_cache_key(t)] = list(v)
+        except Exception as e:
+            logger.warning(f"批次 Embedding 失敗，改為逐筆呼叫: {e}")
+    return [_EMB_CACHE[k] if k in _EMB_CACHE else _get_embedding(t) for t, k in zip(texts, keys)]
+
 
 def _norm_for_overlap(s: str) -> str:
     s = (s or "").strip().lower()
@@ -1071,8 +1244,7 @@ def call_gemini_similarity(gpt_res, claude_res, threshold: float = None):
     if _SIM_ONLY_EMB:
         sa = _concat_comments(gpt_res)
         sb = _concat_comments(claude_res)
-        va = _get_embedding(sa)
-        vb = _get_embedding(sb)
+        va, vb = _get_embeddings([sa, sb])  # 兩段評論合併為一次 embedding 請求
         emb_sim = _cosine_vec(va, vb) if va and vb else 0.0
         reason = f"embedding(gemini:{EMBEDDING_MODEL_NAME}) cosine:{emb_sim:.2f}"
         return {"similar": emb_sim >= final_th, "score": emb_sim, "reason": reason}
@@ -1081,8 +1253,7 @@ def call_gemini_similarity(gpt_res, claude_res, threshold: float = None):
     # ====== 若未啟用 ONLY EMBEDDING，這裡可放回舊的混和方案（目前不啟用） ======
     sa = _concat_comments(gpt_res)
     sb = _concat_comments(claude_res)
-    va = _get_embedding(sa)
-    vb = _get_embedding(sb)
+    va, vb = _get_embeddings([sa, sb])
     emb_sim = _cosine_vec(va, vb) if va and vb else 0.0
     mixed = emb_sim
     reason = f"embedding-only fallback cosine:{emb_sim:.2f}"
@@ -1265,7 +1436,7 @@ def run_gemini_weakness_review(subject: str,
 {student_text[:2000]}
 
 【逐題矩陣（主要依據）】
-{json.dumps(matrix, ensure_ascii=False)}
+{_json_text(matrix)}
 """
     try:
         resp = gemini_model.generate_content(prompt)
@@ -1296,39 +1467,81 @@ col_events = db["grading_events"]
 # === 共識回合詳細紀錄集合與開關 ===
 CONSENSUS_LOG_ENABLED = env_bool("CONSENSUS_LOG_ENABLED", True)
 col_consensus = db["consensus_round_logs"]
+col_grader_cache = db["grader_cache"]
 
 try:
-    col_prompts.create_index([("subject", 1), ("version", -1)])
     col_bbmsgs.create_index([("task_id", 1), ("timestamp", -1)])
     col_events.create_index([("created_at", -1)])
     col_consensus.create_index([("task_id", 1), ("qid", 1), ("round_idx", 1), ("agent", 1)])
+    if GRADER_CACHE_PERSIST:
+        col_grader_cache.create_index("created_at", expireAfterSeconds=GRADER_CACHE_TTL)
 except Exception as e:
     logger.warning("Mongo 索引建立警告: %s", e)
 
-def get_latest_prompt(subject: str):
+# (subject, version) 唯一：多個行程同時升版時，後寫入者會收到 DuplicateKeyError 並改用下一版號
+# 既有資料已有重複版本（或舊的非唯一索引仍在）時建立失敗，僅記錄警告，行程內仍以鎖序列化升版
+try:
+    col_prompts.create_index([("subject", 1), ("version", -1)], unique=True)
+except Exception as e:
+    logger.warning("題詞版本唯一索引建立失敗（請清除重複版本並移除舊索引）: %s", e)
+
+# 最新題詞快取 {subject: (取得時間, 文件)}：每次批改與頁面載入都會查詢，題詞改版時立即失效
+# 多行程部署時其他行程最多延遲 PROMPT_CACHE_TTL 秒看到新版本
+PROMPT_CACHE_TTL = env_float("PROMPT_CACHE_TTL", 30.0)
+_prompt_cache: dict[str, tuple[float, dict]] = {}
+_prompt_cache_lock = threading.Lock()
+
+def _fetch_latest_prompt(subject: str):
     return col_prompts.find_one({"subject": subject}, sort=[("version", -1)])
 
+def get_latest_prompt(subject: str):
+    """回傳淺拷貝，呼叫端修改欄位不影響快取"""
+    now = time.monotonic()
+    with _prompt_cache_lock:
+        hit = _prompt_cache.get(subject)
+    if hit and now - hit[0] < PROMPT_CACHE_TTL:
+        return dict(hit[1])
+    doc = _fetch_latest_prompt(subject)
+    if doc is not None:
+        with _prompt_cache_lock:
+            _prompt_cache[subject] = (now, doc)
+        return dict(doc)
+    return None
+
+# 升版為「讀最新版 → 寫入 +1」，並行批改時（自動套用題詞）須序列化，否則會寫出重複版本
+_prompt_bump_lock = threading.Lock()
+_PROMPT_BUMP_ATTEMPTS = 5
+
 def create_or_bump_prompt(subject: str, content: str, updated_by="user"):
-    latest = get_latest_prompt(subject)
-    version = (latest["version"] + 1) if latest else 1
-    data = {
-        "prompt_id": str(uuid.uuid4()),
-        "subject": subject,
-        "prompt_content": content,
-        "created_at": datetime.now(timezone.utc),
-        "updated_at": datetime.now(timezone.utc),
-        "updated_by": updated_by,
-        "version": version,
-    }
-    try:
-        col_prompts.insert_one(data)
-    except mongo_errors.DuplicateKeyError:
-        data["version"] += 1
-        col_prompts.insert_one(data)
+    with _prompt_bump_lock:
+        for attempt in range(_PROMPT_BUMP_ATTEMPTS):
+            latest = _fetch_latest_prompt(subject)  # 版本號須以資料庫為準，不走快取
+            now = datetime.now(timezone.utc)
+            data = {
+                "prompt_id": str(uuid.uuid4()),
+                "subject": subject,
+                "prompt_content": content,
+                "created_at": now,
+                "updated_at": now,
+                "updated_by": updated_by,
+                "version": (latest["version"] + 1) if latest else 1,
+            }
+            try:
+                col_prompts.insert_one(data)
+                break
+            except mongo_errors.DuplicateKeyError:
+                # 其他行程搶先寫入同一版號：重新讀取最新版後再試
+                data.pop("_id", None)
+                if attempt == _PROMPT_BUMP_ATTEMPTS - 1:
+                    raise
+    with _prompt_cache_lock:
+        _prompt_cache.pop(subject, None)
     return data
 
-def log_prompt_blackboard(task_id: str, subject: str, action: str, content: str, payload=None):
-    col_bbmsgs.insert_one({
+def log_prompt_blackboard(task_id: str, subject: str, action: str, content: str, payload=None,
+                          buffer: list | None = None):
+    """寫入一則黑板訊息；傳入 buffer 時只加入該串列，之後由 flush_blackboard 一次寫入"""
+    doc = {
         "message_id": str(uuid.uuid4()),
         "task_id": task_id,
         "subject": subject,
@@ -1338,7 +1551,21 @@ def log_prompt_blackboard(task_id: str, subject: str, action: str, content: str,
         "payload": payload,
         "created_by": "system" if action!="initial_set" else "user",
         "timestamp": datetime.now(timezone.utc)
-    })
+    }
+    if buffer is not None:
+        buffer.append(doc)
+    else:
+        col_bbmsgs.insert_one(doc)
+
+def flush_blackboard(buffer: list):
+    """將累積的黑板訊息以單次 insert_many 寫入並清空（時間戳於記錄當下產生，讀取端依 timestamp 排序不受影響）"""
+    if not buffer:
+        return
+    try:
+        col_bbmsgs.insert_many(buffer, ordered=False)
+    except Exception as e:
+        logger.warning(f"黑板訊息批次寫入失敗: {e}")
+    buffer.clear()
 
 def log_consensus_round(
     task_id: str,
@@ -1415,14 +1642,16 @@ def grade():
     task_id = str(uuid.uuid4())
     ex_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_exam_{secure_filename(exam_file.filename)}")
     st_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_student_{secure_filename(ans_file.filename)}")
-    exam_file.save(ex_path); ans_file.save(st_path)
 
+    # 直接解析上傳串流，不先寫檔再重新開啟；解析成功後才存檔留底
     try:
-        exam_raw = read_text(ex_path)
-        answer_raw = read_text(st_path)
+        exam_raw = read_text(exam_file.stream, exam_file.filename)
+        answer_raw = read_text(ans_file.stream, ans_file.filename)
     except Exception as e:
         flash(f"讀檔失敗：{e}", "error")
         return redirect(url_for("index", subject=subject))
+    exam_file.stream.seek(0); exam_file.save(ex_path)
+    ans_file.stream.seek(0); ans_file.save(st_path)
 
     # 安全檢查（整卷）
     if SECURITY_AGENT_ENABLED and get_checker is not None:
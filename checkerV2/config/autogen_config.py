@@ -4,13 +4,25 @@
 """
 
 import os
-from typing import Dict, List, Any, Optional
+import io
+import re
+import gzip
+import asyncio
+import random
+import threading
+from typing import Callable, Dict, List, Any, Optional
 import json
 import logging
 from datetime import datetime
 import autogen
 from autogen import AssistantAgent, UserProxyAgent, GroupChat, GroupChatManager
 
+# 可選：orjson 序列化較快且直接輸出 bytes；未安裝時退回標準 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 class EnhancedMultiAgentGradingSystem:
@@ -20,12 +32,15 @@ class EnhancedMultiAgentGradingSystem:
         self.config = config or self._load_default_config()
         self.grading_history = []
         self.current_task_id = None
+        self._history_lock = threading.Lock()
         
     def _load_default_config(self) -> Dict[str, Any]:
         """載入預設配置"""
         return {
             "max_rounds": int(os.getenv("MAX_GRADING_ROUNDS", 8)),
             "timeout": int(os.getenv("GRADING_TIMEOUT", 300)),
+            "report_max_message_chars": int(os.getenv("REPORT_MAX_MESSAGE_CHARS", 2000)),
+            "agreement_tolerance": float(os.getenv("GRADER_AGREEMENT_TOLERANCE", 3)),
             "temperature": {
                 "grader": 0.1,
                 "arbitrator": 0.05,
@@ -35,9 +50,35 @@ class EnhancedMultiAgentGradingSystem:
                 "primary_grader": "gpt-4",
                 "secondary_grader": "claude-3-sonnet-20240229", 
                 "arbitrator": "gpt-4",
-                "security_inspector": "gpt-3.5-turbo"
+                "security_inspector": "gpt-3.5-turbo",
+                # 簡單任務改用本地量化模型（vLLM / Ollama 的 OpenAI 相容端點）
+                "primary_grader_simple": os.getenv("LOCAL_GRADER_MODEL", "qwen2.5-coder-7b-instruct-awq"),
+                "secondary_grader_simple": os.getenv("LOCAL_SECONDARY_GRADER_MODEL",
+                                                     os.getenv("LOCAL_GRADER_MODEL", "qwen2.5-coder-7b-instruct-awq"))
+            },
+            # 未設定 LOCAL_LLM_BASE_URL 時不啟用本地路由，維持原本的雲端模型
+            "local_llm": {
+                "base_url": os.getenv("LOCAL_LLM_BASE_URL", ""),
+                "api_key": os.getenv("LOCAL_LLM_API_KEY", "EMPTY")
             }
         }
+
+    def _grader_config_entry(self, role: str, api_key_env: str, task_type: str) -> Dict[str, Any]:
+        """依任務複雜度決定批改專家使用的模型；simple 任務走本地端點，其餘維持原設定"""
+        local_llm = self.config.get("local_llm") or {}
+        local_model = self.config["models"].get(f"{role}_simple")
+
+        if task_type == "simple" and local_llm.get("base_url") and local_model:
+            return {
+                "model": local_model,
+                "base_url": local_llm["base_url"],
+                "api_key": local_llm.get("api_key") or "EMPTY",
+            }
+
+        return {
+            "model": self.config["models"][role],
+            "api_key": os.getenv(api_key_env),
+        }
     
     def create_specialized_agents(self, grading_prompt: str, task_type: str = "general") -> Dict[str, Any]:
         """創建專門化的代理人"""
@@ -87,10 +128,7 @@ class EnhancedMultiAgentGradingSystem:
             - 與其他專家理性討論分歧
             """,
             llm_config={
-                "config_list": [{
-                    "model": self.config["models"]["primary_grader"],
-                    "api_key": os.getenv("OPENAI_API_KEY"),
-                }],
+                "config_list": [self._grader_config_entry("primary_grader", "OPENAI_API_KEY", task_type)],
                 "temperature": self.config["temperature"]["grader"],
                 "timeout": self.config["timeout"],
             }
@@ -121,16 +159,13 @@ class EnhancedMultiAgentGradingSystem:
             - 以同理心理解學生水平
             """,
             llm_config={
-                "config_list": [{
-                    "model": self.config["models"]["secondary_grader"],
-                    "api_key": os.getenv("ANTHROPIC_API_KEY"),
-                }],
+                "config_list": [self._grader_config_entry("secondary_grader", "ANTHROPIC_API_KEY", task_type)],
                 "temperature": self.config["temperature"]["grader"],
                 "timeout": self.config["timeout"],
             }
         )
         
-        # 專業裁判代理
+        # 專業裁判代理（為維持公平性，一律使用雲端模型）
         arbitrator_agent = AssistantAgent(
             name="Senior_Arbitrator",
             system_message=f"""
@@ -243,6 +278,9 @@ class EnhancedMultiAgentGradingSystem:
                 # 檢查是否需要裁判介入
                 if self._should_call_arbitrator(messages):
                     return agents["arbitrator"]
+                # 兩位專家分數相近且無分歧時直接結束，省下裁判與後續回合
+                elif self._graders_agree(messages) is not None:
+                    return None
                 else:
                     return agents["gpt4_grader"]
             
@@ -285,6 +323,28 @@ class EnhancedMultiAgentGradingSystem:
         
         # 如果分歧言論超過閾值，召喚裁判
         return disagreement_count >= 2
+
+    def _graders_agree(self, messages: List[Dict]) -> Optional[float]:
+        """兩位專家最新分數差距在容許範圍內時回傳平均分，否則回傳 None"""
+        scores = {}
+        for msg in reversed(messages):
+            name = msg.get("name", "")
+            if name in ("GPT4_Expert_Grader", "Claude_Expert_Grader") and name not in scores:
+                score = self._extract_score_from_content(msg.get("content", ""))
+                if score is not None:
+                    scores[name] = score
+                if len(scores) == 2:
+                    break
+
+        if len(scores) < 2:
+            return None
+
+        gpt_score = scores["GPT4_Expert_Grader"]
+        claude_score = scores["Claude_Expert_Grader"]
+        if abs(gpt_score - claude_score) > self.config.get("agreement_tolerance", 3):
+            return None
+
+        return (gpt_score + claude_score) / 2
     
     def execute_collaborative_grading(self, 
                                     exam_content: str, 
@@ -293,7 +353,9 @@ class EnhancedMultiAgentGradingSystem:
                                     task_id: str = None) -> Dict[str, Any]:
         """執行協作批改"""
         
-        self.current_task_id = task_id or f"task_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        # 以區域變數保存任務ID，避免批次並行時互相覆寫 self.current_task_id
+        task_id = task_id or f"task_{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        self.current_task_id = task_id
         
         try:
             # 分析任務複雜度
@@ -323,7 +385,7 @@ class EnhancedMultiAgentGradingSystem:
             )
             
             # 開始協作批改
-            logger.info(f"開始協作批改任務: {self.current_task_id}")
+            logger.info(f"開始協作批改任務: {task_id}")
             
             chat_result = agents["coordinator"].initiate_chat(
                 manager, 
@@ -332,12 +394,12 @@ class EnhancedMultiAgentGradingSystem:
             )
             
             # 處理批改結果
-            result = self._process_grading_result(groupchat.messages)
+            result = self._process_grading_result(groupchat.messages, task_id)
             
             # 記錄批改歷史
             self._record_grading_history(result)
             
-            logger.info(f"協作批改完成: {self.current_task_id}")
+            logger.info(f"協作批改完成: {task_id}")
             
             return result
             
@@ -347,23 +409,81 @@ class EnhancedMultiAgentGradingSystem:
                 "final_score": 0,
                 "reasoning": f"批改過程發生錯誤：{str(e)}",
                 "error": True,
-                "task_id": self.current_task_id
+                "error_type": type(e).__name__,
+                "task_id": task_id
             }
+
+    async def execute_collaborative_grading_async(self,
+                                                  exam_content: str,
+                                                  student_answer: str,
+                                                  grading_prompt: str,
+                                                  task_id: str = None) -> Dict[str, Any]:
+        """非同步執行協作批改（AutoGen 對話為同步阻塞，放到執行緒中跑）"""
+        return await asyncio.to_thread(
+            self.execute_collaborative_grading,
+            exam_content, student_answer, grading_prompt, task_id
+        )
+
+    async def execute_collaborative_grading_batch(self,
+                                                  tasks: List[Dict[str, Any]],
+                                                  max_concurrency: int = None,
+                                                  max_retries: int = 3,
+                                                  on_progress: Optional[Callable[[int, int], None]] = None) -> List[Any]:
+        """
+        批次並行批改
+        - tasks: 每筆為 execute_collaborative_grading 的參數 dict
+        - max_concurrency: 同時進行的批改數上限（受供應商速率限制約束）
+        - 遇到 RateLimitError 時以指數退避重試
+        - on_progress(done, total): 每完成一筆即回報進度
+        """
+        if max_concurrency is None:
+            max_concurrency = int(os.getenv("GRADING_MAX_CONCURRENCY", 10))
+        sem = asyncio.Semaphore(max(1, max_concurrency))
+        total = len(tasks)
+        done = 0
+
+        async def _one(task: Dict[str, Any]) -> Dict[str, Any]:
+            nonlocal done
+            async with sem:
+                for attempt in range(max_retries + 1):
+                    result = await self.execute_collaborative_grading_async(**task)
+                    if not (result.get("error") and result.get("error_type") == "RateLimitError"):
+                        break
+                    if attempt < max_retries:
+                        logger.warning(f"批改任務遭遇速率限制，第 {attempt + 1} 次重試: {result.get('task_id')}")
+                        await asyncio.sleep(min(2 ** attempt + random.random(), 30.0))
+            done += 1
+            if on_progress:
+                try:
+                    on_progress(done, total)
+                except Exception as e:
+                    logger.warning(f"進度回報失敗: {str(e)}")
+            return result
+
+        return await asyncio.gather(*[_one(t) for t in tasks], return_exceptions=True)
+
+    def execute_collaborative_grading_batch_sync(self,
+                                                 tasks: List[Dict[str, Any]],
+                                                 max_concurrency: int = None,
+                                                 on_progress: Optional[Callable[[int, int], None]] = None) -> List[Any]:
+        """批次並行批改的同步包裝"""
+        return asyncio.run(self.execute_collaborative_grading_batch(
+            tasks, max_concurrency=max_concurrency, on_progress=on_progress
+        ))
     
     def _analyze_task_complexity(self, exam_content: str, student_answer: str) -> str:
         """分析任務複雜度"""
         
         # 簡單的複雜度評估邏輯
-        complexity_indicators = {
-            "code_lines": len(student_answer.split('\n')),
-            "question_count": exam_content.count('Q') + exam_content.count('題'),
-            "code_blocks": student_answer.count('{') + student_answer.count('}'),
-        }
-        
+        # 行數以換行字元計數（等同 split 後的行數），避免產生整份答案的行列表
+        code_lines = student_answer.count('\n') + 1
+        question_count = exam_content.count('Q') + exam_content.count('題')
+        code_blocks = student_answer.count('{') + student_answer.count('}')
+
         total_score = (
-            min(complexity_indicators["code_lines"] / 20, 3) +
-            min(complexity_indicators["question_count"] / 3, 3) +
-            min(complexity_indicators["code_blocks"] / 10, 3)
+            min(code_lines / 20, 3) +
+            min(question_count / 3, 3) +
+            min(code_blocks / 10, 3)
         )
         
         if total_score <= 3:
@@ -404,14 +524,19 @@ class EnhancedMultiAgentGradingSystem:
 請開始協作批改！
 """
     
-    def _process_grading_result(self, chat_messages: List[Dict]) -> Dict[str, Any]:
+    def _process_grading_result(self, chat_messages: List[Dict], task_id: str = None) -> Dict[str, Any]:
         """處理批改結果"""
+
+        task_id = task_id or self.current_task_id
         
-        # 提取最終評分
-        final_score = self._extract_final_score(chat_messages)
+        # 提取最終評分：裁判未介入且兩位專家分數相近時取平均，否則以對話最後出現的分數為準
+        consensus_score = None
+        if not any("Arbitrator" in msg.get("name", "") for msg in chat_messages):
+            consensus_score = self._graders_agree(chat_messages)
+        final_score = consensus_score if consensus_score is not None else self._extract_final_score(chat_messages)
         
         # 生成評分報告
-        grading_report = self._generate_grading_report(chat_messages)
+        grading_report = self._generate_grading_report(chat_messages, task_id)
         
         # 分析協作品質
         collaboration_quality = self._analyze_collaboration_quality(chat_messages)
@@ -421,7 +546,7 @@ class EnhancedMultiAgentGradingSystem:
             "grading_report": grading_report,
             "chat_history": chat_messages,
             "collaboration_quality": collaboration_quality,
-            "task_id": self.current_task_id,
+            "task_id": task_id,
             "timestamp": datetime.now().isoformat(),
             "error": False
         }
@@ -431,64 +556,83 @@ class EnhancedMultiAgentGradingSystem:
         
         # 尋找最後的評分信息
         for message in reversed(messages):
-            content = message.get("content", "")
-            
-            # 使用正則表達式提取分數
-            import re
-            
-            # 尋找總分模式
-            patterns = [
-                r'總分[：:]\s*(\d+(?:\.\d+)?)',
-                r'最終得分[：:]\s*(\d+(?:\.\d+)?)',
-                r'得分[：:]\s*(\d+(?:\.\d+)?)',
-                r'分數[：:]\s*(\d+(?:\.\d+)?)',
-            ]
-            
-            for pattern in patterns:
-                match = re.search(pattern, content)
-                if match:
-                    try:
-                        return float(match.group(1))
-                    except ValueError:
-                        continue
+            score = self._extract_score_from_content(message.get("content", ""))
+            if score is not None:
+                return score
         
         # 如果找不到明確分數，返回0
         logger.warning("無法從對話中提取最終評分")
         return 0.0
-    
-    def _generate_grading_report(self, messages: List[Dict]) -> str:
-        """生成評分報告"""
+
+    def _extract_score_from_content(self, content: str) -> Optional[float]:
+        """以正則表達式從單則訊息中提取分數"""
+        
+        # 尋找總分模式
+        patterns = [
+            r'總分[：:]\s*(\d+(?:\.\d+)?)',
+            r'最終得分[：:]\s*(\d+(?:\.\d+)?)',
+            r'得分[：:]\s*(\d+(?:\.\d+)?)',
+            r'分數[：:]\s*(\d+(?:\.\d+)?)',
+        ]
         
-        report_sections = []
+        for pattern in patterns:
+            match = re.search(pattern, content)
+            if match:
+                try:
+                    return float(match.group(1))
+                except ValueError:
+                    continue
         
+        return None
+    
+    def _generate_grading_report(self, messages: List[Dict], task_id: str = None) -> str:
+        """生成評分報告"""
+
+        # 單則訊息過長時僅保留前段，避免報告與歷史檔無限制膨脹
+        max_chars = self.config.get("report_max_message_chars", 2000)
+
+        buf = io.StringIO()
+
         # 添加標題
-        report_sections.append("# 多代理人協作批改報告\n")
-        
+        buf.write("# 多代理人協作批改報告\n\n")
+
         # 添加任務信息
-        report_sections.append(f"**任務ID:** {self.current_task_id}")
-        report_sections.append(f"**批改時間:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-        report_sections.append(f"**參與代理:** GPT-4專家, Claude專家, 資深裁判\n")
-        
+        buf.write(f"**任務ID:** {task_id or self.current_task_id}\n")
+        buf.write(f"**批改時間:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+        buf.write("**參與代理:** GPT-4專家, Claude專家, 資深裁判\n\n")
+
         # 添加批改過程
-        report_sections.append("## 批改過程記錄\n")
-        
+        buf.write("## 批改過程記錄\n\n")
+
         for i, message in enumerate(messages, 1):
             speaker = message.get("name", f"Agent_{i}")
             content = message.get("content", "")
-            
-            report_sections.append(f"### {speaker}")
-            report_sections.append(f"```\n{content}\n```\n")
-        
-        return "\n".join(report_sections)
+            if len(content) > max_chars:
+                content = content[:max_chars] + "...[truncated]"
+
+            buf.write(f"### {speaker}\n```\n{content}\n```\n\n")
+
+        return buf.getvalue()
     
     def _analyze_collaboration_quality(self, messages: List[Dict]) -> Dict[str, Any]:
         """分析協作品質"""
-        
+
+        # 單次走訪即可同時取得參與者、訊息長度與裁判參與狀態
+        names = set()
+        total_length = 0
+        arbitrator_involved = False
+        for msg in messages:
+            name = msg.get("name", "")
+            names.add(name)
+            total_length += len(msg.get("content", ""))
+            if not arbitrator_involved and "Arbitrator" in name:
+                arbitrator_involved = True
+
         return {
             "total_rounds": len(messages),
-            "agents_participated": len(set(msg.get("name", "") for msg in messages)),
-            "average_message_length": sum(len(msg.get("content", "")) for msg in messages) / len(messages) if messages else 0,
-            "arbitrator_involved": any("Arbitrator" in msg.get("name", "") for msg in messages),
+            "agents_participated": len(names),
+            "average_message_length": total_length / len(messages) if messages else 0,
+            "arbitrator_involved": arbitrator_involved,
             "consensus_reached": self._check_consensus_reached(messages)
         }
     
@@ -531,17 +675,25 @@ class EnhancedMultiAgentGradingSystem:
         })
         
         # 持久化到檔案（可選）
+        # chat_history 為大量重複的自然語言，壓縮後體積約為原本的數分之一
+        # 固定使用標準函式庫的 gzip：檔名與格式不隨執行環境安裝的套件改變，每次附加的 member 串接後仍是合法的 gzip 檔
         try:
-            import json
-            history_file = "logs/grading_history.json"
+            history_file = "logs/grading_history.jsonl.gz"
             os.makedirs(os.path.dirname(history_file), exist_ok=True)
-            
-            with open(history_file, "a", encoding="utf-8") as f:
-                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+            if orjson is not None:
+                line = orjson.dumps(result, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+            else:
+                line = (json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8")
+            
+            # 批次並行時多個執行緒會同時寫入，需序列化避免行交錯
+            with self._history_lock:
+                with gzip.open(history_file, "ab") as f:
+                    f.write(line)
                 
         except Exception as e:
             logger.warning(f"無法保存批改歷史: {str(e)}")
-    
+
     def get_grading_statistics(self) -> Dict[str, Any]:
         """獲取批改統計信息"""
         
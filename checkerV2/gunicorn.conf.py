@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn 設定（正式環境部署用）
+    gunicorn -c gunicorn.conf.py teacher_app:app
+    GUNICORN_WORKERS=1 GUNICORN_BIND=0.0.0.0:5000 gunicorn -c gunicorn.conf.py app:app
+
+app:app 只能以單一 worker 執行：批改任務存於行程內的 TASKS，/task/<id> 只在建立任務的 worker 查得到
+（要提高並行請調大 GUNICORN_THREADS）
+
+多個 worker 時，get_exam 的考試快取（EXAM_CACHE_TTL）是各 worker 各自一份：
+某個 worker 更新考試後只清除自己的快取，其他 worker 最多延遲 EXAM_CACHE_TTL 秒才看到新狀態
+
+請求大多在等待 LLM / MongoDB 回應，預設以 gthread（多執行緒）worker 處理並行；
+安裝 gevent 後可設定 GUNICORN_WORKER_CLASS=gevent，單一 worker 以協程同時處理大量等待中的請求
+（批改進度的 SSE 長連線也不再各佔一條執行緒）
+
+不啟用 preload_app：應用模組在匯入時就建立 MongoClient，PyMongo 的連線池不可跨 fork 共用，
+各 worker 需在自己的行程內匯入並建立連線
+"""
+
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", f"0.0.0.0:{os.getenv('TEACHER_PORT', '5001')}")
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("GUNICORN_WORKERS", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", "8"))                        # gthread 使用
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))  # gevent 使用
+preload_app = False
+
+# 整份考卷的批改可能需要數分鐘，避免 worker 被誤判逾時而重啟
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "300"))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
@@ -3,12 +3,19 @@
 簡化版 AI 批改 API
 不需要 MongoDB，直接使用內存臨時儲存
 專門為 grading.html 提供批改服務
+
+正式環境建議以多執行緒 WSGI 伺服器啟動（批改請求多半在等待 LLM 回應）：
+    gunicorn -k gthread -w 4 --threads 8 -b 0.0.0.0:5001 simple_grading_api:app
+直接執行本檔時，若已安裝 waitress 且未開啟 FLASK_DEBUG，會改用 waitress 啟動
 """
 
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import os
+import io
 import logging
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # 導入現有的批改系統函數
@@ -23,6 +30,12 @@ except ImportError as e:
     print("將使用內建的批改函數")
     HAS_APP = False
 
+# 可選：orjson 加速請求/回應 JSON 解析與序列化
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 load_dotenv()
 
 # ----------------------------------------------------------------------
@@ -30,6 +43,22 @@ load_dotenv()
 # ----------------------------------------------------------------------
 app = Flask(__name__)
 CORS(app)  # 允許跨域請求
+
+# request.get_json() 與 jsonify() 皆透過 app.json，換成 orjson 即全部路由生效（Flask >= 2.2）
+if orjson is not None:
+    try:
+        from flask.json.provider import DefaultJSONProvider
+
+        class OrjsonProvider(DefaultJSONProvider):
+            def dumps(self, obj, **kwargs):
+                return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        pass
 app.secret_key = os.environ.get("SECRET_KEY", os.urandom(24))
 
 # ----------------------------------------------------------------------
@@ -42,6 +71,49 @@ logging.basicConfig(
 )
 logger = logging.getLogger("simple_grading_api")
 
+# 同時進行的批改請求上限（每題 GPT + Claude 各一個）
+GRADING_MAX_WORKERS = int(os.getenv("GRADING_MAX_WORKERS", "16"))
+
+# 預設評分提詞（未傳入自訂提詞時使用，依科目填入）
+_DEFAULT_PROMPT_TMPL = """請作為專業的{subject}教師進行評分。
+
+評分標準：
+1. 正確性（40%）：答案是否正確完整
+2. 邏輯性（30%）：思路是否清晰合理
+3. 完整性（20%）：是否涵蓋所有要點
+4. 表達（10%）：語言是否流暢清楚
+
+請給出具體分數和改進建議。"""
+
+@lru_cache(maxsize=256)
+def _split_questions_cached(question_text):
+    """
+    拆分題目（同一份考卷會被每位學生的請求重複拆分，故依題目全文快取）
+    注意：回傳值為快取共用物件，呼叫端只可讀取不可修改
+    """
+    try:
+        questions = enhanced_split_by_question(question_text)
+        if not questions:
+            questions = split_by_question(question_text)
+    except:
+        questions = split_by_question(question_text)
+    return questions
+
+def _grade_one(grader, label, q_id, q_text, answer, q_score, prompt_text):
+    """在工作執行緒中批改單一題目，失敗時回傳 0 分並附上錯誤訊息"""
+    try:
+        result = grader(
+            question=q_text,
+            answer=answer,
+            max_score=q_score,
+            prompt_text=prompt_text
+        )
+        logger.info(f"{label} 批改完成 Q{q_id}: {result.get('score', 0)}/{q_score}")
+        return {"id": q_id, **result}
+    except Exception as e:
+        logger.error(f"{label} 批改失敗 Q{q_id}: {e}")
+        return {"id": q_id, "score": 0, "comment": f"批改失敗：{e}"}
+
 # ----------------------------------------------------------------------
 # API 端點 - 單個答案批改
 # ----------------------------------------------------------------------
@@ -74,6 +146,7 @@ def api_grade_single():
         max_score = data.get("max_score", 100)
         student_name = data.get("student_name", "學生")
         custom_prompt = data.get("prompt", None)  # 允許自訂評分提詞
+        include_feedback = data.get("include_feedback", True)  # 只需要分數時可略過回饋文字
         
         logger.info(f"收到批改請求 - 學生：{student_name}, 科目：{subject}, 滿分：{max_score}")
         
@@ -83,24 +156,11 @@ def api_grade_single():
             logger.info("使用自訂評分提詞")
         else:
             # 使用預設評分提詞
-            prompt_text = f"""請作為專業的{subject}教師進行評分。
-
-評分標準：
-1. 正確性（40%）：答案是否正確完整
-2. 邏輯性（30%）：思路是否清晰合理
-3. 完整性（20%）：是否涵蓋所有要點
-4. 表達（10%）：語言是否流暢清楚
-
-請給出具體分數和改進建議。"""
+            prompt_text = _DEFAULT_PROMPT_TMPL.format(subject=subject)
             logger.info(f"使用預設評分提詞（科目：{subject}）")
         
-        # 拆分題目
-        try:
-            questions_list = enhanced_split_by_question(question_text)
-            if not questions_list:
-                questions_list = split_by_question(question_text)
-        except:
-            questions_list = split_by_question(question_text)
+        # 拆分題目（答案每位學生不同，不快取）
+        questions_list = _split_questions_cached(question_text)
         
         logger.info(f"拆分出 {len(questions_list)} 個題目")
         
@@ -114,50 +174,34 @@ def api_grade_single():
         
         logger.info(f"拆分出 {len(answers_list)} 個答案")
         
-        # 執行批改
-        gpt_results = []
-        claude_results = []
+        # 執行批改：各題 GPT / Claude 呼叫彼此獨立，全部同時送出
+        answers_by_id = {a["id"]: a for a in reversed(answers_list)}  # 題號重複時與原本一樣取第一筆
+        # 結果依題目順序存放（題號可能重複，不能以題號為鍵，否則後完成的會覆蓋先完成的）
+        gpt_results = [None] * len(questions_list)
+        claude_results = [None] * len(questions_list)
         
-        for q_item in questions_list:
-            q_id = q_item["id"]
-            q_text = q_item["text"]
-            q_score = q_item.get("score", max_score // len(questions_list))
+        workers = max(1, min(2 * len(questions_list), GRADING_MAX_WORKERS))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {}
+            for idx, q_item in enumerate(questions_list):
+                q_id = q_item["id"]
+                q_text = q_item["text"]
+                q_score = q_item.get("score", max_score // len(questions_list))
+                
+                # 找到對應的答案
+                answer_item = answers_by_id.get(q_id)
+                answer = answer_item["text"] if answer_item else ""
+                
+                logger.info(f"批改題目 {q_id}，配分：{q_score}")
+                
+                futures[pool.submit(_grade_one, call_gpt_grader, "GPT", q_id, q_text, answer, q_score, prompt_text)] = (gpt_results, idx)
+                futures[pool.submit(_grade_one, call_claude_grader, "Claude", q_id, q_text, answer, q_score, prompt_text)] = (claude_results, idx)
             
-            # 找到對應的答案
-            answer_item = next((a for a in answers_list if a["id"] == q_id), None)
-            answer = answer_item["text"] if answer_item else ""
-            
-            logger.info(f"批改題目 {q_id}，配分：{q_score}")
-            
-            # 調用 GPT 批改
-            try:
-                gpt_result = call_gpt_grader(
-                    question=q_text,
-                    answer=answer,
-                    max_score=q_score,
-                    prompt_text=prompt_text
-                )
-                gpt_results.append({"id": q_id, **gpt_result})
-                logger.info(f"GPT 批改完成 Q{q_id}: {gpt_result.get('score', 0)}/{q_score}")
-            except Exception as e:
-                logger.error(f"GPT 批改失敗 Q{q_id}: {e}")
-                gpt_results.append({"id": q_id, "score": 0, "comment": f"批改失敗：{e}"})
-            
-            # 調用 Claude 批改
-            try:
-                claude_result = call_claude_grader(
-                    question=q_text,
-                    answer=answer,
-                    max_score=q_score,
-                    prompt_text=prompt_text
-                )
-                claude_results.append({"id": q_id, **claude_result})
-                logger.info(f"Claude 批改完成 Q{q_id}: {claude_result.get('score', 0)}/{q_score}")
-            except Exception as e:
-                logger.error(f"Claude 批改失敗 Q{q_id}: {e}")
-                claude_results.append({"id": q_id, "score": 0, "comment": f"批改失敗：{e}"})
-        
-        # 計算總分
+            for future in as_completed(futures):
+                bucket, idx = futures[future]
+                bucket[idx] = future.result()
+        
+        # 計算總分（每題結果各計一次）
         gpt_total = sum(r.get("score", 0) for r in gpt_results)
         claude_total = sum(r.get("score", 0) for r in claude_results)
         
@@ -166,41 +210,47 @@ def api_grade_single():
         
         logger.info(f"批改完成 - GPT: {gpt_total}, Claude: {claude_total}, 最終: {final_score}")
         
-        # 生成回饋
-        feedback_parts = []
-        for i, q_item in enumerate(questions_list):
-            q_id = q_item["id"]
-            gpt_r = next((r for r in gpt_results if r["id"] == q_id), {})
-            claude_r = next((r for r in claude_results if r["id"] == q_id), {})
-            
-            avg_score = round((gpt_r.get("score", 0) + claude_r.get("score", 0)) / 2)
-            feedback_parts.append(f"📝 Q{q_id}: {avg_score}/{q_item.get('score', 0)}分")
-            
-            # GPT 評語
-            if gpt_r.get("comment"):
-                feedback_parts.append(f"   🤖 GPT: {gpt_r['comment'][:150]}")
-            
-            # Claude 評語
-            if claude_r.get("comment"):
-                feedback_parts.append(f"   🧠 Claude: {claude_r['comment'][:150]}")
-            
-            feedback_parts.append("")  # 空行分隔
-        
-        feedback = "\n".join(feedback_parts)
-        
-        return jsonify({
+        result = {
             "success": True,
             "score": final_score,
             "max_score": max_score,
             "percentage": round((final_score / max_score) * 100, 2),
-            "feedback": feedback,
             "details": {
                 "gpt_score": gpt_total,
                 "claude_score": claude_total,
                 "questions_count": len(questions_list),
                 "student_name": student_name
             }
-        })
+        }
+        
+        # 生成回饋
+        if include_feedback:
+            # 回饋依題號查詢結果；題號重複時與原本一樣取第一筆
+            gpt_by_id = {r["id"]: r for r in reversed(gpt_results)}
+            claude_by_id = {r["id"]: r for r in reversed(claude_results)}
+            buf = io.StringIO()
+            for i, q_item in enumerate(questions_list):
+                q_id = q_item["id"]
+                gpt_r = gpt_by_id.get(q_id, {})
+                claude_r = claude_by_id.get(q_id, {})
+                
+                if i:
+                    buf.write("\n")  # 空行分隔
+                
+                avg_score = round((gpt_r.get("score", 0) + claude_r.get("score", 0)) / 2)
+                buf.write(f"📝 Q{q_id}: {avg_score}/{q_item.get('score', 0)}分\n")
+                
+                # GPT 評語
+                if gpt_r.get("comment"):
+                    buf.write(f"   🤖 GPT: {gpt_r['comment'][:150]}\n")
+                
+                # Claude 評語
+                if claude_r.get("comment"):
+                    buf.write(f"   🧠 Claude: {claude_r['comment'][:150]}\n")
+            
+            result["feedback"] = buf.getvalue()
+        
+        return jsonify(result)
         
     except Exception as e:
         logger.error(f"API 批改失敗：{e}", exc_info=True)
@@ -246,9 +296,19 @@ if __name__ == "__main__":
     print("="*60)
     print()
     
-    app.run(
-        host=os.getenv("FLASK_HOST", "0.0.0.0"),
-        port=int(os.getenv("GRADING_API_PORT", "5001")),
-        debug=os.getenv("FLASK_DEBUG", "True").lower() == "true"
-    )
+    host = os.getenv("FLASK_HOST", "0.0.0.0")
+    port = int(os.getenv("GRADING_API_PORT", "5001"))
+    debug = os.getenv("FLASK_DEBUG", "False").lower() == "true"
+    
+    if not debug:
+        try:
+            from waitress import serve
+            threads = int(os.getenv("GRADING_API_THREADS", "16"))
+            logger.info(f"使用 waitress 啟動（threads={threads}）")
+            serve(app, host=host, port=port, threads=threads)
+            raise SystemExit(0)
+        except ImportError:
+            logger.warning("未安裝 waitress，改用 Flask 內建伺服器（多執行緒模式）")
+    
+    app.run(host=host, port=port, debug=debug, threaded=True)
 
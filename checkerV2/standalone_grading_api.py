@@ -3,6 +3,12 @@
 獨立版 AI 批改 API
 完全獨立運行，不需要任何外部依賴（除了 AI SDK）
 專門為 grading.html 提供批改服務
+
+正式環境建議以多執行緒 WSGI 伺服器啟動（批改請求多半在等待 LLM 回應）：
+    gunicorn -k gthread -w 2 --threads 16 -b 0.0.0.0:5001 standalone_grading_api:app
+多個 worker 時 /api/grade_batch 的工作存於 diskcache（BATCH_JOB_DIR），各 worker 共用；
+未安裝 diskcache 時批次工作只存於單一行程記憶體，批次端點須以單一 worker（-w 1）執行
+直接執行本檔時，若已安裝 waitress 且未開啟 FLASK_DEBUG，會改用 waitress 啟動
 """
 
 from flask import Flask, request, jsonify
@@ -10,6 +16,14 @@ import os
 import logging
 import json
 import re
+import hashlib
+import time
+import uuid
+import random
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
 
 # 導入 AI SDK
@@ -27,26 +41,81 @@ except ImportError:
     HAS_ANTHROPIC = False
     print("⚠️ Anthropic SDK 未安裝")
 
+# 可選：orjson 加速請求/回應 JSON 與模型回覆的解析
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 可選：diskcache 讓批改結果快取在重啟後仍然有效，並讓批次批改工作可跨 worker 查詢
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+# 可選：tiktoken 估算串流提前結束時的 OpenAI token 用量
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 load_dotenv()
 
+# ----------------------------------------------------------------------
+# 服務設定（啟動時讀取一次環境變數，之後只用模組常數）
+# ----------------------------------------------------------------------
+# 本服務不使用 session；未設定 SECRET_KEY 時以本行程隨機金鑰代替（空字串亦視為未設定）
+SECRET_KEY = os.environ.get("SECRET_KEY") or os.urandom(24)
+FLASK_HOST = os.getenv("FLASK_HOST", "0.0.0.0")
+GRADING_API_PORT = int(os.getenv("GRADING_API_PORT", "5001"))
+GRADING_API_THREADS = int(os.getenv("GRADING_API_THREADS", "16"))
+FLASK_DEBUG = os.getenv("FLASK_DEBUG", "False").lower() == "true"
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+
 # ----------------------------------------------------------------------
 # Flask 應用
 # ----------------------------------------------------------------------
 app = Flask(__name__)
-app.secret_key = os.environ.get("SECRET_KEY", os.urandom(24))
+app.secret_key = SECRET_KEY
+
+# request.get_json() 與 jsonify() 皆透過 app.json，換成 orjson 即全部路由生效（Flask >= 2.2）
+if orjson is not None:
+    try:
+        from flask.json.provider import DefaultJSONProvider
+
+        class OrjsonProvider(DefaultJSONProvider):
+            def dumps(self, obj, **kwargs):
+                return orjson.dumps(obj, default=self.default, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        pass
+
+# CORS 支援（手動實作，避免依賴 flask-cors）；預檢結果由瀏覽器快取一天
+_CORS_HEADERS = {
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type',
+    'Access-Control-Allow-Methods': 'GET,POST,OPTIONS',
+    'Access-Control-Max-Age': '86400',
+}
+
+@app.before_request
+def cors_preflight():
+    # 預檢請求直接回 204，不進入各端點
+    if request.method == "OPTIONS":
+        return "", 204
 
-# CORS 支援（手動實作，避免依賴 flask-cors）
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Origin', '*')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type')
-    response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
+    response.headers.update(_CORS_HEADERS)
     return response
 
 # ----------------------------------------------------------------------
 # Logging
 # ----------------------------------------------------------------------
-LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
     format="%(asctime)s - %(levelname)s - %(message)s"
@@ -62,308 +131,899 @@ anthropic_client = None
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
 
+def _pooled_http_client():
+    """長連線 HTTP client（HTTP/2 + keep-alive 連線池），避免每次請求重新 TLS 握手；未安裝 h2 時退回 HTTP/1.1"""
+    import httpx
+    limits = httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60)
+    try:
+        return httpx.Client(http2=True, limits=limits)
+    except ImportError:
+        return httpx.Client(limits=limits)
+
 if HAS_OPENAI and OPENAI_API_KEY:
     try:
-        openai_client = OpenAI(api_key=OPENAI_API_KEY)
+        openai_client = OpenAI(api_key=OPENAI_API_KEY, http_client=_pooled_http_client())
         logger.info("✅ OpenAI 客戶端初始化成功")
     except Exception as e:
         logger.error(f"OpenAI 初始化失敗: {e}")
 
 if HAS_ANTHROPIC and ANTHROPIC_API_KEY:
     try:
-        anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY)
+        anthropic_client = Anthropic(api_key=ANTHROPIC_API_KEY, http_client=_pooled_http_client())
         logger.info("✅ Anthropic 客戶端初始化成功")
     except Exception as e:
         logger.error(f"Anthropic 初始化失敗: {e}")
 
+def _warm_up_clients():
+    """先建立到各供應商的連線（DNS / TLS / HTTP2），讓第一個批改請求不必負擔握手延遲"""
+    for name, client in (("OpenAI", openai_client), ("Anthropic", anthropic_client)):
+        if client is None:
+            continue
+        try:
+            client.models.list()
+            logger.info(f"🔥 {name} 連線已預熱")
+        except Exception as e:
+            logger.warning(f"{name} 連線預熱失敗（不影響批改）: {e}")
+
+if os.getenv("GRADER_WARMUP", "1") == "1":
+    threading.Thread(target=_warm_up_clients, name="grader-warmup", daemon=True).start()
+
+# 批改呼叫皆為網路 I/O，以共用執行緒池並行送出（上限受供應商速率限制約束）
+GRADING_MAX_WORKERS = int(os.getenv("GRADING_MAX_WORKERS", "16"))
+grading_executor = ThreadPoolExecutor(max_workers=GRADING_MAX_WORKERS, thread_name_prefix="grader")
+
+# 預設評分提詞（未傳入自訂提詞時使用，依科目填入）
+_DEFAULT_PROMPT_TMPL = """請作為專業的{subject}教師進行評分。
+
+評分標準：
+1. 正確性（40%）：答案是否正確完整
+2. 邏輯性（30%）：思路是否清晰合理
+3. 完整性（20%）：是否涵蓋所有要點
+4. 表達（10%）：語言是否流暢清楚
+
+請給出具體分數和改進建議。"""
+
 # ----------------------------------------------------------------------
 # 簡化的題目拆分函數
 # ----------------------------------------------------------------------
-def simple_split_questions(text):
-    """簡單的題目拆分"""
-    lines = text.strip().split('\n')
-    questions = []
-    current_q = None
-    current_text = []
-    
-    for line in lines:
-        # 檢查是否是題目標題
-        match = re.match(r'^\s*(?:Q|題目|Question|Problem)\s*(\d+)', line, re.IGNORECASE)
-        if match:
-            # 儲存前一題
-            if current_q is not None:
-                questions.append({
-                    "id": current_q,
-                    "text": '\n'.join(current_text).strip(),
-                    "score": 10  # 預設分數
-                })
-            # 開始新題
-            current_q = match.group(1)
-            current_text = [line]
-        elif current_q is not None:
-            current_text.append(line)
-    
-    # 儲存最後一題
-    if current_q is not None:
-        questions.append({
-            "id": current_q,
-            "text": '\n'.join(current_text).strip(),
-            "score": 10
-        })
+# 題目標題必須位於行首；[^\S\n] 為「不含換行的空白」，確保比對不會跨行
+_Q_HEADER_RE = re.compile(r'^[^\S\n]*(?:Q|題目|Question|Problem)[^\S\n]*(\d+)', re.IGNORECASE | re.MULTILINE)
+_SCORE_RE = re.compile(r'(\d+(?:\.\d+)?)\s*分')
+
+def _iter_questions(text, total_score=None):
+    """
+    單次掃描全文找出各題標題，依序產生 (題號, 題目內容, 配分)
+    有傳入 total_score 時各題配分為總分平均分配（只計算一次），否則沿用預設 10 分 / 單題 100 分
+    """
+    text = text.strip()
+    headers = list(_Q_HEADER_RE.finditer(text))
     
     # 如果沒有拆分出題目，當作單一題目
-    if not questions:
-        questions.append({
-            "id": "1",
-            "text": text.strip(),
-            "score": 100
-        })
+    if not headers:
+        yield "1", text, 100 if total_score is None else total_score
+        return
+    
+    default_score = 10 if total_score is None else total_score // len(headers)
+    
+    # 每題內容為本題標題所在行起，到下一題標題所在行之前（第一題之前的文字不列入）
+    for i, match in enumerate(headers):
+        end = headers[i + 1].start() if i + 1 < len(headers) else len(text)
+        yield match.group(1), text[match.start():end].strip(), default_score
+
+def simple_split_questions(text, total_score=None):
+    """簡單的題目拆分"""
+    return [{"id": q_id, "text": q_text, "score": q_score} for q_id, q_text, q_score in _iter_questions(text, total_score)]
+
+def split_paired(question_text, answer_text, max_score):
+    """
+    拆分題目與答案並依題號配對（各題配分由滿分平均分配）
+    回傳 (題目列表, [(題號, 題目, 答案, 配分), ...])；答案直接由掃描結果建立索引，不另建列表
+    """
+    questions_list = simple_split_questions(question_text, max_score)
+    
+    answers_by_id = {}
+    for a_id, a_text, _ in _iter_questions(answer_text):
+        answers_by_id.setdefault(a_id, a_text)  # 題號重複時以第一個為準
     
-    return questions
+    logger.info(f"📊 拆分出 {len(questions_list)} 個題目, {len(answers_by_id)} 個答案")
+    
+    jobs = [(q["id"], q["text"], answers_by_id.get(q["id"], ""), q["score"]) for q in questions_list]
+    return questions_list, jobs
 
 # ----------------------------------------------------------------------
 # AI 批改函數
 # ----------------------------------------------------------------------
-def call_openai_grader(question, answer, max_score, prompt_text):
-    """調用 OpenAI GPT 批改"""
-    if not openai_client:
-        return {"score": 0, "comment": "OpenAI 未配置"}
-    
+OPENAI_GRADER_MODEL = "gpt-4o"
+ANTHROPIC_GRADER_MODEL = "claude-3-5-sonnet-20241022"
+
+# 各供應商同時進行的請求上限；暫時性錯誤（429 / 逾時 / 連線 / 5xx）以指數退避 + 抖動重試
+_PROVIDER_SEMAPHORES = {
+    "openai": threading.BoundedSemaphore(int(os.getenv("OPENAI_CONCURRENCY", "8"))),
+    "anthropic": threading.BoundedSemaphore(int(os.getenv("ANTHROPIC_CONCURRENCY", "8"))),
+}
+GRADER_MAX_ATTEMPTS = int(os.getenv("GRADER_MAX_ATTEMPTS", "3"))
+_RETRYABLE_ERRORS = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError"}
+
+# 行程內累計 token 用量（/api/health 可查）；OpenAI 串流提前結束時為估算值
+_token_usage = {"openai": 0, "anthropic": 0}
+_token_usage_lock = threading.Lock()
+
+def _record_usage(provider, tokens):
+    if tokens:
+        with _token_usage_lock:
+            _token_usage[provider] += tokens
+
+def _call_with_retry(provider, fn, **kwargs):
+    """在供應商並行上限內呼叫 fn，遇暫時性錯誤時重試"""
+    for attempt in range(GRADER_MAX_ATTEMPTS):
+        try:
+            with _PROVIDER_SEMAPHORES[provider]:
+                return fn(**kwargs)
+        except Exception as e:
+            if type(e).__name__ not in _RETRYABLE_ERRORS or attempt == GRADER_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(2 ** attempt + random.random(), 20.0)
+            logger.warning(f"{provider} 暫時性錯誤（{type(e).__name__}），{delay:.1f} 秒後第 {attempt + 1} 次重試")
+            time.sleep(delay)
+
+def _grader_failure(label, e):
+    """重試用盡時分數為 None（不計入總分，可稍後重批），其餘錯誤維持 0 分"""
+    logger.error(f"{label} 批改失敗: {e}")
+    if type(e).__name__ in _RETRYABLE_ERRORS:
+        return {"score": None, "comment": f"重試後仍失敗：{str(e)}", "retry_exhausted": True}
+    return {"score": 0, "comment": f"批改失敗：{str(e)}"}
+
+# 批改結果快取：相同（供應商, 模型, 提詞, 題目, 答案, 滿分）直接回傳上次結果（temperature 為 0）
+# 設定 GRADE_CACHE_DIR 且已安裝 diskcache 時改存磁碟，重啟後仍可命中
+GRADE_CACHE_SIZE = int(os.getenv("GRADE_CACHE_SIZE", "2048"))
+GRADE_CACHE_DIR = os.getenv("GRADE_CACHE_DIR", "")
+_grade_cache = OrderedDict()
+_grade_cache_lock = threading.Lock()
+_grade_disk_cache = None
+if GRADE_CACHE_DIR and diskcache is not None:
     try:
-        messages = [
-            {"role": "system", "content": prompt_text},
-            {"role": "user", "content": f"""題目：
+        _grade_disk_cache = diskcache.Cache(GRADE_CACHE_DIR)
+        logger.info(f"✅ 批改結果快取使用磁碟：{GRADE_CACHE_DIR}")
+    except Exception as e:
+        logger.error(f"磁碟快取初始化失敗，改用記憶體快取: {e}")
+
+def _grade_cache_key(provider, model, prompt_text, question, answer, max_score):
+    raw = json.dumps([provider, model, prompt_text, question, answer, max_score], ensure_ascii=False)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+def _grade_cache_get(key):
+    if _grade_disk_cache is not None:
+        result = _grade_disk_cache.get(key)
+        return dict(result) if result is not None else None
+    with _grade_cache_lock:
+        result = _grade_cache.get(key)
+        if result is None:
+            return None
+        _grade_cache.move_to_end(key)
+        return dict(result)
+
+def _grade_cache_put(key, result):
+    if GRADE_CACHE_SIZE <= 0:
+        return
+    if _grade_disk_cache is not None:
+        _grade_disk_cache.set(key, dict(result))
+        return
+    with _grade_cache_lock:
+        _grade_cache[key] = dict(result)
+        _grade_cache.move_to_end(key)
+        while len(_grade_cache) > GRADE_CACHE_SIZE:
+            _grade_cache.popitem(last=False)
+
+def _grader_user_message(question, answer, max_score):
+    """兩家模型共用的批改請求內容"""
+    return f"""題目：
 {question}
 
 學生答案：
 {answer}
 
 請評分（滿分{max_score}分）並給出評語。
-請以 JSON 格式回覆：{{"score": 分數, "comment": "評語"}}"""}
-        ]
-        
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=messages,
-            temperature=0.0,
-            max_tokens=1000
-        )
-        
-        result_text = response.choices[0].message.content.strip()
-        
-        # 嘗試解析 JSON
+請以 JSON 格式回覆：{{"score": 分數, "comment": "評語"}}"""
+
+_JSON_DECODER = json.JSONDecoder()
+
+def _extract_json_object(text):
+    """
+    取出回覆中的 JSON 物件，找不到時回傳 None
+    模型常在 JSON 前後加上說明文字，故從第一個 "{" 起以 raw_decode 解析，忽略其後的文字
+    """
+    start = text.find("{")
+    if start < 0:
+        return None
+    if start == 0 and orjson is not None:
+        try:
+            obj = orjson.loads(text)
+            return obj if isinstance(obj, dict) else None
+        except orjson.JSONDecodeError:
+            pass  # 可能是 JSON 後面還有文字，改用 raw_decode
+    try:
+        obj, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    return obj if isinstance(obj, dict) else None
+
+def _extract_json_array(text):
+    """取出回覆中的 JSON 陣列（合併批改用），找不到時回傳 None"""
+    start = text.find("[")
+    if start < 0:
+        return None
+    try:
+        obj, _ = _JSON_DECODER.raw_decode(text, start)
+    except ValueError:
+        return None
+    return obj if isinstance(obj, list) else None
+
+def _parse_grader_reply(result_text, max_score):
+    """
+    解析模型回覆：優先 JSON，否則從文字中提取分數
+    完全取不到分數時暫給滿分的 70%，並標記 score_estimated（此結果不可快取）
+    """
+    result = _extract_json_object(result_text)
+    if result is not None:
         try:
-            result = json.loads(result_text)
             return {
                 "score": min(float(result.get("score", 0)), max_score),
                 "comment": result.get("comment", "")
             }
-        except:
-            # 如果不是 JSON，嘗試提取分數
-            score_match = re.search(r'(\d+(?:\.\d+)?)\s*分', result_text)
-            score = float(score_match.group(1)) if score_match else max_score * 0.7
-            return {
-                "score": min(score, max_score),
-                "comment": result_text[:200]
-            }
+        except (TypeError, ValueError):
+            pass
+    
+    # 如果不是 JSON，嘗試提取分數
+    score_match = _SCORE_RE.search(result_text)
+    if score_match is None:
+        return {"score": max_score * 0.7, "comment": result_text[:200], "score_estimated": True}
+    return {
+        "score": min(float(score_match.group(1)), max_score),
+        "comment": result_text[:200]
+    }
+
+def _openai_grader_body(question, answer, max_score, prompt_text):
+    return {
+        "model": OPENAI_GRADER_MODEL,
+        "messages": [
+            {"role": "system", "content": prompt_text},
+            {"role": "user", "content": _grader_user_message(question, answer, max_score)}
+        ],
+        "temperature": 0.0,
+        "max_tokens": 1000
+    }
+
+def _anthropic_system(prompt_text):
+    """
+    系統提詞標記為可快取（Anthropic prompt caching），同一提詞的後續請求可重用前綴
+    預設提詞由固定模板依科目填入，相同科目送出的位元組完全一致；OpenAI 端則自動快取相同前綴
+    """
+    return [{"type": "text", "text": prompt_text, "cache_control": {"type": "ephemeral"}}]
+
+def _anthropic_grader_params(question, answer, max_score, prompt_text):
+    return {
+        "model": ANTHROPIC_GRADER_MODEL,
+        "max_tokens": 1000,
+        "temperature": 0.0,
+        "system": _anthropic_system(prompt_text),
+        "messages": [
+            {"role": "user", "content": _grader_user_message(question, answer, max_score)}
+        ]
+    }
+
+# 串流接收模型回覆：收到含 "}" 的片段時才嘗試解析（不逐 token 解析），JSON 完整即提前結束
+GRADER_STREAM = os.getenv("GRADER_STREAM", "1") == "1"
+
+def _reply_complete(parts, closer):
+    """已接收的片段是否已包含完整的 JSON 物件（closer 為 "}"）或陣列（closer 為 "]"）"""
+    extract = _extract_json_array if closer == "]" else _extract_json_object
+    return extract("".join(parts)) is not None
+
+@lru_cache(maxsize=8)
+def _openai_encoder(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+def _estimate_openai_tokens(body, reply):
+    """
+    估算 token 用量（提示 + 已接收的回覆）：OpenAI 的 usage 片段在串流最後才送出，提前結束時收不到
+    有 tiktoken 時依模型編碼計算；否則以字元數近似（中文約一字一 token）
+    """
+    text = "".join(str(m.get("content") or "") for m in body.get("messages", [])) + reply
+    if tiktoken is not None:
+        try:
+            return len(_openai_encoder(body.get("model", "")).encode(text))
+        except Exception:
+            pass
+    return len(text)
+
+def _openai_reply(closer="}", **body):
+    """回傳 (回覆文字, 使用 token 數)"""
+    if not GRADER_STREAM:
+        response = openai_client.chat.completions.create(**body)
+        usage = getattr(response, "usage", None)
+        return response.choices[0].message.content, getattr(usage, "total_tokens", 0)
+    
+    parts = []
+    tokens = 0
+    stream = openai_client.chat.completions.create(stream=True, stream_options={"include_usage": True}, **body)
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                tokens = chunk.usage.total_tokens
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                if closer in delta and _reply_complete(parts, closer):
+                    break
+    finally:
+        stream.close()
+    reply = "".join(parts)
+    if not tokens:
+        tokens = _estimate_openai_tokens(body, reply)
+    return reply, tokens
+
+def _anthropic_reply(closer="}", **params):
+    """回傳 (回覆文字, 使用 token 數)"""
+    if not GRADER_STREAM:
+        message = anthropic_client.messages.create(**params)
+        usage = getattr(message, "usage", None)
+        return message.content[0].text, getattr(usage, "input_tokens", 0) + getattr(usage, "output_tokens", 0)
+    
+    parts = []
+    with anthropic_client.messages.stream(**params) as stream:
+        for text in stream.text_stream:
+            parts.append(text)
+            if closer in text and _reply_complete(parts, closer):
+                break
+        # 提前結束時以目前快照的用量計算（輸出 token 為已接收部分）
+        try:
+            usage = stream.current_message_snapshot.usage
+            tokens = (usage.input_tokens or 0) + (usage.output_tokens or 0)
+        except Exception:
+            tokens = 0
+    return "".join(parts), tokens
+
+def call_openai_grader(question, answer, max_score, prompt_text):
+    """調用 OpenAI GPT 批改"""
+    if not openai_client:
+        return {"score": 0, "comment": "OpenAI 未配置"}
+    
+    cache_key = _grade_cache_key("openai", OPENAI_GRADER_MODEL, prompt_text, question, answer, max_score)
+    cached = _grade_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    
+    try:
+        result_text, tokens = _call_with_retry(
+            "openai", _openai_reply,
+            **_openai_grader_body(question, answer, max_score, prompt_text)
+        )
+        _record_usage("openai", tokens)
+        
+        result_text = result_text.strip()
+        result = _parse_grader_reply(result_text, max_score)
+        if not result.get("score_estimated"):
+            _grade_cache_put(cache_key, result)  # 僅快取成功解析出分數的批改結果
+        return result
     
     except Exception as e:
-        logger.error(f"GPT 批改失敗: {e}")
-        return {"score": 0, "comment": f"批改失敗：{str(e)}"}
+        return _grader_failure("GPT", e)
 
 def call_anthropic_grader(question, answer, max_score, prompt_text):
     """調用 Anthropic Claude 批改"""
     if not anthropic_client:
         return {"score": 0, "comment": "Claude 未配置"}
     
+    cache_key = _grade_cache_key("anthropic", ANTHROPIC_GRADER_MODEL, prompt_text, question, answer, max_score)
+    cached = _grade_cache_get(cache_key)
+    if cached is not None:
+        return cached
+    
     try:
-        message = anthropic_client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1000,
-            temperature=0.0,
-            system=prompt_text,
-            messages=[
-                {"role": "user", "content": f"""題目：
-{question}
-
-學生答案：
-{answer}
-
-請評分（滿分{max_score}分）並給出評語。
-請以 JSON 格式回覆：{{"score": 分數, "comment": "評語"}}"""}
-            ]
+        result_text, tokens = _call_with_retry(
+            "anthropic", _anthropic_reply,
+            **_anthropic_grader_params(question, answer, max_score, prompt_text)
         )
+        _record_usage("anthropic", tokens)
         
-        result_text = message.content[0].text.strip()
-        
-        # 嘗試解析 JSON
-        try:
-            result = json.loads(result_text)
-            return {
-                "score": min(float(result.get("score", 0)), max_score),
-                "comment": result.get("comment", "")
-            }
-        except:
-            # 如果不是 JSON，嘗試提取分數
-            score_match = re.search(r'(\d+(?:\.\d+)?)\s*分', result_text)
-            score = float(score_match.group(1)) if score_match else max_score * 0.7
-            return {
-                "score": min(score, max_score),
-                "comment": result_text[:200]
-            }
+        result_text = result_text.strip()
+        result = _parse_grader_reply(result_text, max_score)
+        if not result.get("score_estimated"):
+            _grade_cache_put(cache_key, result)  # 僅快取成功解析出分數的批改結果
+        return result
     
     except Exception as e:
-        logger.error(f"Claude 批改失敗: {e}")
-        return {"score": 0, "comment": f"批改失敗：{str(e)}"}
+        return _grader_failure("Claude", e)
 
 # ----------------------------------------------------------------------
-# API 端點
+# 合併批改：每家供應商一次呼叫批改所有題目（回覆 JSON 陣列）
+# 系統提詞只處理一次、只有一次往返；模型漏掉的題目由呼叫端逐題補批
 # ----------------------------------------------------------------------
-@app.route("/api/grade_single", methods=["POST", "OPTIONS"])
-def api_grade_single():
-    """單個答案批改 API"""
-    # 處理 OPTIONS 請求（CORS 預檢）
-    if request.method == "OPTIONS":
-        return jsonify({"success": True}), 200
+GRADER_COMBINED = os.getenv("GRADER_COMBINED", "0") == "1"
+
+def _combined_user_message(pending):
+    blocks = [
+        f"【題號 {q_id}】（滿分{q_score}分）\n題目：\n{q_text}\n\n學生答案：\n{answer}"
+        for _, q_id, q_text, answer, q_score in pending
+    ]
+    return ("請逐題評分並給出評語。\n\n" + "\n\n".join(blocks) +
+            '\n\n請以 JSON 陣列格式回覆，每題一個物件：[{"id": "題號", "score": 分數, "comment": "評語"}, ...]')
+
+def _question_key(q_id):
+    """題號正規化（模型可能回覆 1、"1"、"Q1" 或 "01"）"""
+    match = re.search(r'\d+', str(q_id))
+    return str(int(match.group(0))) if match else None
+
+def call_combined_grader(provider, pending, prompt_text):
+    """
+    一次請模型批改多題，pending 為 [(序號, 題號, 題目, 答案, 配分), ...]
+    回傳 {題號: {"score", "comment"}}；呼叫失敗或模型缺漏的題目不在結果中
+    """
+    max_scores = {_question_key(q_id): (q_id, q_score) for _, q_id, _, _, q_score in pending}
+    user_message = _combined_user_message(pending)
+    max_tokens = min(400 * len(pending) + 200, 8192)
     
     try:
-        data = request.get_json()
+        if provider == "openai":
+            result_text, tokens = _call_with_retry(
+                "openai", _openai_reply, closer="]",
+                model=OPENAI_GRADER_MODEL,
+                messages=[
+                    {"role": "system", "content": prompt_text},
+                    {"role": "user", "content": user_message}
+                ],
+                temperature=0.0,
+                max_tokens=max_tokens
+            )
+        else:
+            result_text, tokens = _call_with_retry(
+                "anthropic", _anthropic_reply, closer="]",
+                model=ANTHROPIC_GRADER_MODEL,
+                max_tokens=max_tokens,
+                temperature=0.0,
+                system=_anthropic_system(prompt_text),
+                messages=[{"role": "user", "content": user_message}]
+            )
+        _record_usage(provider, tokens)
+    except Exception as e:
+        logger.warning(f"{provider} 合併批改失敗，改為逐題批改: {e}")
+        return {}
+    
+    results = {}
+    for item in _extract_json_array(result_text) or []:
+        if not isinstance(item, dict):
+            continue
+        key = _question_key(item.get("id", ""))
+        if key not in max_scores:
+            continue
+        q_id, q_score = max_scores[key]
+        if q_id in results:
+            continue
+        try:
+            results[q_id] = {
+                "score": min(float(item.get("score", 0)), q_score),
+                "comment": item.get("comment", "")
+            }
+        except (TypeError, ValueError):
+            continue
+    
+    if len(results) < len(max_scores):
+        logger.warning(f"{provider} 合併批改缺少 {len(max_scores) - len(results)} 題，將逐題補批")
+    return results
+
+# ----------------------------------------------------------------------
+# 批改請求前處理 / 結果彙整（單次批改與批次批改共用）
+# ----------------------------------------------------------------------
+# 答案去除空白後少於此字數視為未作答，直接給 0 分，不呼叫模型
+MIN_ANSWER_CHARS = int(os.getenv("MIN_ANSWER_CHARS", "3"))
+
+def _is_blank_answer(answer):
+    return len(answer.strip()) < MIN_ANSWER_CHARS
+
+def _blank_answer_result(q_id):
+    return {"id": q_id, "score": 0, "comment": "未作答"}
+
+def _prepare_grading(data):
+    """
+    驗證並整理批改請求
+    回傳 (context, error)；error 不為 None 時為 (訊息, HTTP 狀態碼)
+    """
+    if not data:
+        return None, ("無效的請求資料", 400)
+    
+    question_text = data.get("question", "")
+    answer_text = data.get("answer", "")
+    subject = data.get("subject", "通識")
+    max_score = data.get("max_score", 100)
+    student_name = data.get("student_name", "學生")
+    custom_prompt = data.get("prompt", None)
+    feedback_text = data.get("feedback_text", True)  # 是否附上舊版純文字回饋
+    combined = data.get("combined", GRADER_COMBINED)  # 是否每家供應商以單次呼叫批改所有題目
+    
+    if not question_text or not answer_text:
+        return None, ("缺少題目或答案", 400)
+    
+    logger.info(f"📝 收到批改請求 - 學生：{student_name}, 科目：{subject}, 滿分：{max_score}")
+    
+    # 設定評分提詞
+    if custom_prompt:
+        prompt_text = custom_prompt
+        logger.info("✅ 使用自訂評分提詞")
+    else:
+        prompt_text = _DEFAULT_PROMPT_TMPL.format(subject=subject)
+        logger.info(f"✅ 使用預設評分提詞（科目：{subject}）")
+    
+    # 拆分題目與答案，並依題號配對成 (題號, 題目, 答案, 配分)
+    questions_list, jobs = split_paired(question_text, answer_text, max_score)
+    
+    return {
+        "prompt_text": prompt_text,
+        "questions_list": questions_list,
+        "jobs": jobs,
+        "max_score": max_score,
+        "student_name": student_name,
+        "feedback_text": feedback_text,
+        "combined": combined
+    }, None
+
+def _grading_response(ctx, gpt_results, claude_results):
+    """依兩家模型的逐題結果計算總分並組成回應"""
+    questions_list = ctx["questions_list"]
+    max_score = ctx["max_score"]
+    
+    # 計算總分（重試用盡的題目分數為 None，不計入）
+    gpt_total = sum(r.get("score") or 0 for r in gpt_results)
+    claude_total = sum(r.get("score") or 0 for r in claude_results)
+    failed_questions = sorted({r["id"] for r in gpt_results + claude_results if r.get("retry_exhausted")})
+    
+    # 計算平均分數
+    if gpt_results and claude_results:
+        final_score = round((gpt_total + claude_total) / 2, 1)
+    elif gpt_results:
+        final_score = round(gpt_total, 1)
+    elif claude_results:
+        final_score = round(claude_total, 1)
+    else:
+        return jsonify({
+            "success": False,
+            "message": "沒有可用的 AI 服務"
+        }), 500
+    
+    logger.info(f"📊 批改完成 - GPT: {gpt_total}, Claude: {claude_total}, 最終: {final_score}")
+    
+    # 逐題回饋（結構化資料，由前端自行呈現）
+    gpt_by_id = {r["id"]: r for r in reversed(gpt_results)}
+    claude_by_id = {r["id"]: r for r in reversed(claude_results)}
+    feedback_items = []
+    for q_item in questions_list:
+        q_id = q_item["id"]
+        gpt_r = gpt_by_id.get(q_id, {})
+        claude_r = claude_by_id.get(q_id, {})
         
-        # 驗證必要欄位
-        if not data:
-            return jsonify({"success": False, "message": "無效的請求資料"}), 400
+        # 計算平均分
+        if gpt_r and claude_r:
+            avg_score = round(((gpt_r.get("score") or 0) + (claude_r.get("score") or 0)) / 2, 1)
+        elif gpt_r:
+            avg_score = round(gpt_r.get("score") or 0, 1)
+        else:
+            avg_score = round(claude_r.get("score") or 0, 1)
         
-        question_text = data.get("question", "")
-        answer_text = data.get("answer", "")
-        subject = data.get("subject", "通識")
-        max_score = data.get("max_score", 100)
-        student_name = data.get("student_name", "學生")
-        custom_prompt = data.get("prompt", None)
+        feedback_items.append({
+            "q_id": q_id,
+            "avg": avg_score,
+            "max": q_item.get("score", 0),
+            "gpt_comment": gpt_r.get("comment", ""),
+            "claude_comment": claude_r.get("comment", "")
+        })
+    
+    result = {
+        "success": True,
+        "score": final_score,
+        "max_score": max_score,
+        "percentage": round((final_score / max_score) * 100, 2),
+        "feedback_items": feedback_items,
+        "details": {
+            "gpt_score": round(gpt_total, 1) if gpt_results else 0,
+            "claude_score": round(claude_total, 1) if claude_results else 0,
+            "questions_count": len(questions_list),
+            "failed_questions": failed_questions,
+            "student_name": ctx["student_name"]
+        }
+    }
+    
+    # 舊版文字回饋（預設保留以相容既有前端，傳入 feedback_text: false 可省略）
+    if ctx["feedback_text"]:
+        result["feedback"] = "\n".join(_feedback_text_lines(feedback_items))
+    
+    return jsonify(result)
+
+def _feedback_text_lines(feedback_items):
+    """由結構化回饋產生舊版純文字回饋的各行"""
+    for item in feedback_items:
+        yield f"📝 Q{item['q_id']}: {item['avg']}/{item['max']}分"
         
-        if not question_text or not answer_text:
-            return jsonify({
-                "success": False,
-                "message": "缺少題目或答案"
-            }), 400
+        # GPT 評語
+        if item["gpt_comment"]:
+            yield f"   🤖 GPT: {item['gpt_comment'][:150]}"
         
-        logger.info(f"📝 收到批改請求 - 學生：{student_name}, 科目：{subject}, 滿分：{max_score}")
+        # Claude 評語
+        if item["claude_comment"]:
+            yield f"   🧠 Claude: {item['claude_comment'][:150]}"
         
-        # 設定評分提詞
-        if custom_prompt:
-            prompt_text = custom_prompt
-            logger.info("✅ 使用自訂評分提詞")
-        else:
-            prompt_text = f"""請作為專業的{subject}教師進行評分。
+        yield ""  # 空行分隔
 
-評分標準：
-1. 正確性（40%）：答案是否正確完整
-2. 邏輯性（30%）：思路是否清晰合理
-3. 完整性（20%）：是否涵蓋所有要點
-4. 表達（10%）：語言是否流暢清楚
-
-請給出具體分數和改進建議。"""
-            logger.info(f"✅ 使用預設評分提詞（科目：{subject}）")
+# ----------------------------------------------------------------------
+# API 端點
+# ----------------------------------------------------------------------
+@app.route("/api/grade_single", methods=["POST", "OPTIONS"])
+def api_grade_single():
+    """單個答案批改 API"""
+    try:
+        ctx, error = _prepare_grading(request.get_json())
+        if error:
+            return jsonify({"success": False, "message": error[0]}), error[1]
         
-        # 拆分題目
-        questions_list = simple_split_questions(question_text)
-        answers_list = simple_split_questions(answer_text)
+        prompt_text = ctx["prompt_text"]
         
-        logger.info(f"📊 拆分出 {len(questions_list)} 個題目, {len(answers_list)} 個答案")
+        # 執行批改：所有（題目 × 供應商）一次送出，並行等待結果
+        gpt_by_index = {}
+        claude_by_index = {}
+        futures = {}
         
-        # 執行批改
-        gpt_results = []
-        claude_results = []
+        pending = []
+        for idx, (q_id, q_text, answer, q_score) in enumerate(ctx["jobs"]):
+            if _is_blank_answer(answer):
+                logger.info(f"⏭️ Q{q_id} 未作答，直接給 0 分")
+                if openai_client:
+                    gpt_by_index[idx] = _blank_answer_result(q_id)
+                if anthropic_client:
+                    claude_by_index[idx] = _blank_answer_result(q_id)
+                continue
+            pending.append((idx, q_id, q_text, answer, q_score))
         
-        for q_item in questions_list:
-            q_id = q_item["id"]
-            q_text = q_item["text"]
-            q_score = q_item.get("score", max_score // len(questions_list))
-            
-            # 找到對應的答案
-            answer_item = next((a for a in answers_list if a["id"] == q_id), None)
-            answer = answer_item["text"] if answer_item else ""
-            
+        # 合併批改：兩家各一次呼叫批改所有題目
+        gpt_combined = {}
+        claude_combined = {}
+        if ctx["combined"] and len(pending) > 1:
+            gpt_future = grading_executor.submit(call_combined_grader, "openai", pending, prompt_text) if openai_client else None
+            claude_future = grading_executor.submit(call_combined_grader, "anthropic", pending, prompt_text) if anthropic_client else None
+            gpt_combined = gpt_future.result() if gpt_future else {}
+            claude_combined = claude_future.result() if claude_future else {}
+        
+        for idx, q_id, q_text, answer, q_score in pending:
             logger.info(f"🔍 批改題目 Q{q_id}，配分：{q_score}")
             
-            # 調用 GPT 批改
+            # 調用 GPT 批改（合併批改已取得結果者不再呼叫）
             if openai_client:
-                gpt_result = call_openai_grader(q_text, answer, q_score, prompt_text)
-                gpt_results.append({"id": q_id, **gpt_result})
-                logger.info(f"✅ GPT 批改完成 Q{q_id}: {gpt_result.get('score', 0)}/{q_score}")
+                if q_id in gpt_combined:
+                    gpt_by_index[idx] = {"id": q_id, **gpt_combined[q_id]}
+                else:
+                    future = grading_executor.submit(call_openai_grader, q_text, answer, q_score, prompt_text)
+                    futures[future] = ("GPT", gpt_by_index, idx, q_id, q_score)
             
             # 調用 Claude 批改
             if anthropic_client:
-                claude_result = call_anthropic_grader(q_text, answer, q_score, prompt_text)
-                claude_results.append({"id": q_id, **claude_result})
-                logger.info(f"✅ Claude 批改完成 Q{q_id}: {claude_result.get('score', 0)}/{q_score}")
+                if q_id in claude_combined:
+                    claude_by_index[idx] = {"id": q_id, **claude_combined[q_id]}
+                else:
+                    future = grading_executor.submit(call_anthropic_grader, q_text, answer, q_score, prompt_text)
+                    futures[future] = ("Claude", claude_by_index, idx, q_id, q_score)
+        
+        for future in as_completed(futures):
+            label, results, idx, q_id, q_score = futures[future]
+            result = future.result()  # 批改函數內部已處理例外
+            results[idx] = {"id": q_id, **result}
+            logger.info(f"✅ {label} 批改完成 Q{q_id}: {result.get('score', 0)}/{q_score}")
         
-        # 計算總分
-        gpt_total = sum(r.get("score", 0) for r in gpt_results)
-        claude_total = sum(r.get("score", 0) for r in claude_results)
+        # 依題目順序排列
+        gpt_results = [gpt_by_index[i] for i in sorted(gpt_by_index)]
+        claude_results = [claude_by_index[i] for i in sorted(claude_by_index)]
         
-        # 計算平均分數
-        if gpt_results and claude_results:
-            final_score = round((gpt_total + claude_total) / 2, 1)
-        elif gpt_results:
-            final_score = round(gpt_total, 1)
-        elif claude_results:
-            final_score = round(claude_total, 1)
+        return _grading_response(ctx, gpt_results, claude_results)
+        
+    except Exception as e:
+        logger.error(f"❌ API 批改失敗：{e}", exc_info=True)
+        return jsonify({
+            "success": False,
+            "message": f"批改失敗：{str(e)}"
+        }), 500
+
+# ----------------------------------------------------------------------
+# 批次批改（OpenAI Batch API / Anthropic Message Batches）
+# 非同步完成（最長 24 小時），費用約為同步呼叫的一半，適合題數多、不急著要結果的情境：
+#   POST /api/grade_batch           送出，回傳 job_id
+#   GET  /api/grade_batch/<job_id>  查詢；全部完成後回傳與 /api/grade_single 相同格式的結果
+# ----------------------------------------------------------------------
+BATCH_MIN_QUESTIONS = int(os.getenv("BATCH_MIN_QUESTIONS", "10"))
+# 批次工作保存時間（秒）；供應商批次最長 24 小時，預設多留一天供查詢，取回最終結果後即刪除
+BATCH_JOB_TTL = int(os.getenv("BATCH_JOB_TTL", str(48 * 3600)))
+BATCH_JOB_DIR = os.getenv("BATCH_JOB_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".batch_jobs"))
+_batch_jobs = {}  # job_id -> (到期時間, 批次資訊)；未安裝 diskcache 時使用（僅限單一 worker，重啟後需重新送出）
+_batch_jobs_lock = threading.Lock()
+_batch_job_store = None
+if diskcache is not None:
+    try:
+        _batch_job_store = diskcache.Cache(BATCH_JOB_DIR)
+    except Exception as e:
+        logger.error(f"批次工作儲存初始化失敗，改用記憶體（僅限單一 worker）: {e}")
+else:
+    logger.warning("未安裝 diskcache：批次工作只存於本行程記憶體，/api/grade_batch 須以單一 worker 執行")
+
+def _batch_job_put(job_id, job):
+    if _batch_job_store is not None:
+        _batch_job_store.set(job_id, job, expire=BATCH_JOB_TTL)
+        return
+    now = time.monotonic()
+    with _batch_jobs_lock:
+        for expired in [k for k, (deadline, _) in _batch_jobs.items() if deadline <= now]:
+            del _batch_jobs[expired]
+        _batch_jobs[job_id] = (now + BATCH_JOB_TTL, job)
+
+def _batch_job_get(job_id):
+    if _batch_job_store is not None:
+        return _batch_job_store.get(job_id)
+    with _batch_jobs_lock:
+        entry = _batch_jobs.get(job_id)
+    if entry is None or entry[0] <= time.monotonic():
+        return None
+    return entry[1]
+
+def _batch_job_delete(job_id):
+    if _batch_job_store is not None:
+        _batch_job_store.delete(job_id)
+        return
+    with _batch_jobs_lock:
+        _batch_jobs.pop(job_id, None)
+
+def submit_batch_grading(jobs, prompt_text):
+    """將每題送進兩家供應商的批次 API，回傳各自的 batch id"""
+    batch_ids = {}
+    # 未作答的題目不送出，查詢結果時直接給 0 分（custom_id 仍以原題目順序編號）
+    pending = [(idx, job) for idx, job in enumerate(jobs) if not _is_blank_answer(job[2])]
+    if not pending:
+        return batch_ids
+    
+    if openai_client:
+        lines = []
+        for idx, (q_id, q_text, answer, q_score) in pending:
+            lines.append(json.dumps({
+                "custom_id": f"q{idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": _openai_grader_body(q_text, answer, q_score, prompt_text)
+            }, ensure_ascii=False))
+        batch_file = openai_client.files.create(
+            file=("grading_batch.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        batch_ids["openai"] = batch.id
+    
+    if anthropic_client:
+        batch = anthropic_client.messages.batches.create(requests=[
+            {"custom_id": f"q{idx}", "params": _anthropic_grader_params(q_text, answer, q_score, prompt_text)}
+            for idx, (q_id, q_text, answer, q_score) in pending
+        ])
+        batch_ids["anthropic"] = batch.id
+    
+    return batch_ids
+
+def _collect_openai_batch(batch_id, jobs):
+    """批次完成時回傳逐題結果（依題目順序），尚未完成回傳 None"""
+    batch = openai_client.batches.retrieve(batch_id)
+    if batch.status in ("failed", "expired", "cancelled"):
+        raise RuntimeError(f"OpenAI 批次 {batch_id} 狀態：{batch.status}")
+    if batch.status != "completed":
+        return None
+    
+    replies = {}
+    if batch.output_file_id:
+        for line in openai_client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            try:
+                replies[item["custom_id"]] = item["response"]["body"]["choices"][0]["message"]["content"].strip()
+            except (KeyError, IndexError, TypeError):
+                pass
+    
+    return _batch_results(jobs, replies, "GPT")
+
+def _collect_anthropic_batch(batch_id, jobs):
+    """批次完成時回傳逐題結果（依題目順序），尚未完成回傳 None"""
+    batch = anthropic_client.messages.batches.retrieve(batch_id)
+    if batch.processing_status != "ended":
+        return None
+    
+    replies = {}
+    for entry in anthropic_client.messages.batches.results(batch_id):
+        if entry.result.type == "succeeded":
+            replies[entry.custom_id] = entry.result.message.content[0].text.strip()
+    
+    return _batch_results(jobs, replies, "Claude")
+
+def _batch_results(jobs, replies, label):
+    results = []
+    for idx, (q_id, q_text, answer, q_score) in enumerate(jobs):
+        reply = replies.get(f"q{idx}")
+        if _is_blank_answer(answer):
+            results.append(_blank_answer_result(q_id))
+        elif reply is None:
+            logger.error(f"{label} 批次批改失敗 Q{q_id}")
+            results.append({"id": q_id, "score": 0, "comment": "批改失敗：批次請求未成功"})
         else:
+            results.append({"id": q_id, **_parse_grader_reply(reply, q_score)})
+    return results
+
+@app.route("/api/grade_batch", methods=["POST", "OPTIONS"])
+def api_grade_batch():
+    """以供應商批次 API 送出批改，立即回傳 job_id"""
+    try:
+        ctx, error = _prepare_grading(request.get_json())
+        if error:
+            return jsonify({"success": False, "message": error[0]}), error[1]
+        
+        if len(ctx["jobs"]) < BATCH_MIN_QUESTIONS:
             return jsonify({
                 "success": False,
-                "message": "沒有可用的 AI 服務"
-            }), 500
+                "message": f"題數少於 {BATCH_MIN_QUESTIONS} 題，請改用 /api/grade_single"
+            }), 400
         
-        logger.info(f"📊 批改完成 - GPT: {gpt_total}, Claude: {claude_total}, 最終: {final_score}")
+        if not openai_client and not anthropic_client:
+            return jsonify({"success": False, "message": "沒有可用的 AI 服務"}), 500
         
-        # 生成回饋
-        feedback_parts = []
-        for q_item in questions_list:
-            q_id = q_item["id"]
-            gpt_r = next((r for r in gpt_results if r["id"] == q_id), {}) if gpt_results else {}
-            claude_r = next((r for r in claude_results if r["id"] == q_id), {}) if claude_results else {}
-            
-            # 計算平均分
-            if gpt_r and claude_r:
-                avg_score = round((gpt_r.get("score", 0) + claude_r.get("score", 0)) / 2, 1)
-            elif gpt_r:
-                avg_score = round(gpt_r.get("score", 0), 1)
-            else:
-                avg_score = round(claude_r.get("score", 0), 1)
-            
-            feedback_parts.append(f"📝 Q{q_id}: {avg_score}/{q_item.get('score', 0)}分")
-            
-            # GPT 評語
-            if gpt_r.get("comment"):
-                feedback_parts.append(f"   🤖 GPT: {gpt_r['comment'][:150]}")
-            
-            # Claude 評語
-            if claude_r.get("comment"):
-                feedback_parts.append(f"   🧠 Claude: {claude_r['comment'][:150]}")
-            
-            feedback_parts.append("")  # 空行分隔
+        batch_ids = submit_batch_grading(ctx["jobs"], ctx["prompt_text"])
+        if not batch_ids:
+            # 全部未作答，不需送出批次，直接回傳結果
+            blank = [_blank_answer_result(q_id) for q_id, _, _, _ in ctx["jobs"]]
+            return _grading_response(ctx, blank if openai_client else [], blank if anthropic_client else [])
+        
+        job_id = uuid.uuid4().hex
+        _batch_job_put(job_id, {**ctx, "batch_ids": batch_ids})
         
-        feedback = "\n".join(feedback_parts)
+        logger.info(f"📦 已送出批次批改 {job_id}：{batch_ids}")
+        return jsonify({"success": True, "job_id": job_id, "batch_ids": batch_ids}), 202
         
+    except Exception as e:
+        logger.error(f"❌ 批次批改送出失敗：{e}", exc_info=True)
         return jsonify({
-            "success": True,
-            "score": final_score,
-            "max_score": max_score,
-            "percentage": round((final_score / max_score) * 100, 2),
-            "feedback": feedback,
-            "details": {
-                "gpt_score": round(gpt_total, 1) if gpt_results else 0,
-                "claude_score": round(claude_total, 1) if claude_results else 0,
-                "questions_count": len(questions_list),
-                "student_name": student_name
-            }
-        })
+            "success": False,
+            "message": f"批次批改送出失敗：{str(e)}"
+        }), 500
+
+@app.route("/api/grade_batch/<job_id>", methods=["GET"])
+def api_grade_batch_status(job_id):
+    """查詢批次批改；兩家皆完成後回傳最終結果"""
+    job = _batch_job_get(job_id)
+    if not job:
+        return jsonify({"success": False, "message": "找不到此批次批改"}), 404
+    
+    try:
+        batch_ids = job["batch_ids"]
+        gpt_results = _collect_openai_batch(batch_ids["openai"], job["jobs"]) if "openai" in batch_ids else []
+        claude_results = _collect_anthropic_batch(batch_ids["anthropic"], job["jobs"]) if "anthropic" in batch_ids else []
+        
+        if gpt_results is None or claude_results is None:
+            return jsonify({"success": True, "status": "processing", "job_id": job_id}), 202
+        
+        response = _grading_response(job, gpt_results, claude_results)
+        _batch_job_delete(job_id)  # 最終結果已回傳，不再保留
+        return response
         
     except Exception as e:
-        logger.error(f"❌ API 批改失敗：{e}", exc_info=True)
+        logger.error(f"❌ 批次批改查詢失敗：{e}", exc_info=True)
         return jsonify({
             "success": False,
-            "message": f"批改失敗：{str(e)}"
+            "message": f"批次批改查詢失敗：{str(e)}"
         }), 500
 
 @app.route("/api/health", methods=["GET"])
@@ -376,7 +1036,8 @@ def health_check():
         "ai_services": {
             "openai": openai_client is not None,
             "anthropic": anthropic_client is not None
-        }
+        },
+        "token_usage": dict(_token_usage)
     })
 
 @app.route("/", methods=["GET"])
@@ -388,6 +1049,7 @@ def index():
         "description": "獨立 AI 批改服務 - GPT + Claude",
         "endpoints": {
             "grade": "POST /api/grade_single",
+            "grade_batch": "POST /api/grade_batch, GET /api/grade_batch/<job_id>",
             "health": "GET /api/health"
         },
         "ai_status": {
@@ -404,7 +1066,7 @@ if __name__ == "__main__":
     print("🤖 獨立版 AI 批改 API 服務")
     print("="*60)
     print()
-    print("📡 服務地址: http://localhost:5001")
+    print(f"📡 服務地址: http://localhost:{GRADING_API_PORT}")
     print("📝 API 端點: POST /api/grade_single")
     print()
     print("🔑 AI 服務狀態：")
@@ -418,9 +1080,14 @@ if __name__ == "__main__":
     print("="*60)
     print()
     
-    app.run(
-        host=os.getenv("FLASK_HOST", "0.0.0.0"),
-        port=int(os.getenv("GRADING_API_PORT", "5001")),
-        debug=os.getenv("FLASK_DEBUG", "True").lower() == "true"
-    )
+    if not FLASK_DEBUG:
+        try:
+            from waitress import serve
+            logger.info(f"使用 waitress 啟動（threads={GRADING_API_THREADS}）")
+            serve(app, host=FLASK_HOST, port=GRADING_API_PORT, threads=GRADING_API_THREADS)
+            raise SystemExit(0)
+        except ImportError:
+            logger.warning("未安裝 waitress，改用 Flask 內建伺服器（多執行緒模式）")
+    
+    app.run(host=FLASK_HOST, port=GRADING_API_PORT, debug=FLASK_DEBUG, threaded=True)
 
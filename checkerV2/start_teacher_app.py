@@ -3,16 +3,19 @@
 """
 自動批改系統教師版啟動腳本
 整合原有的批改系統和新的教師管理界面
+兩個應用在同一個 Python 行程中以執行緒啟動，共用已載入的套件（teacher_app 本身也匯入 app）
 """
 
 import os
 import sys
-import subprocess
 import threading
 import time
 import webbrowser
 from pathlib import Path
 
+# 確保以其他工作目錄執行時仍可匯入同目錄下的 app / teacher_app
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
 def check_requirements():
     """檢查必要的套件和環境"""
     # 套件名稱對應表：pip名稱 -> import名稱
@@ -66,82 +69,62 @@ def check_env_file():
     
     return found_env
 
-def get_python_command():
-    """獲取Python命令"""
-    # 在Windows上優先使用py命令
-    if os.name == 'nt':
-        try:
-            subprocess.run(['py', '--version'], check=True, capture_output=True)
-            return 'py'
-        except:
-            pass
-    
-    # 嘗試python命令
-    try:
-        subprocess.run(['python', '--version'], check=True, capture_output=True)
-        return 'python'
-    except:
-        pass
-    
-    # 最後嘗試python3
-    try:
-        subprocess.run(['python3', '--version'], check=True, capture_output=True)
-        return 'python3'
-    except:
-        pass
-    
-    return 'python'  # 預設值
+def _serve(module_name, port_env, default_port):
+    """在本行程中匯入應用模組並啟動其 Flask app（關閉 reloader，避免模組被重複載入）"""
+    module = __import__(module_name)
+    module.app.run(host=os.getenv("FLASK_HOST", "0.0.0.0"),
+                   port=int(os.getenv(port_env, default_port)),
+                   debug=False, use_reloader=False, threaded=True)
 
 def start_original_app():
     """啟動原有的批改系統"""
-    print("🚀 啟動原有批改系統 (端口 5000)...")
-    python_cmd = get_python_command()
+    print(f"🚀 啟動原有批改系統 (端口 {os.getenv('FLASK_PORT', '5000')})...")
     try:
-        subprocess.run([python_cmd, "app.py"], check=True)
-    except subprocess.CalledProcessError as e:
+        _serve("app", "FLASK_PORT", "5000")
+    except Exception as e:
         print(f"❌ 原有批改系統啟動失敗: {e}")
-    except KeyboardInterrupt:
-        print("⏹️  原有批改系統已停止")
 
 def start_teacher_app():
     """啟動教師版應用"""
-    print("🎓 啟動教師版應用 (端口 5001)...")
-    python_cmd = get_python_command()
+    print(f"🎓 啟動教師版應用 (端口 {os.getenv('TEACHER_PORT', '5001')})...")
     try:
-        subprocess.run([python_cmd, "teacher_app.py"], check=True)
-    except subprocess.CalledProcessError as e:
+        _serve("teacher_app", "TEACHER_PORT", "5001")
+    except Exception as e:
         print(f"❌ 教師版應用啟動失敗: {e}")
-    except KeyboardInterrupt:
-        print("⏹️  教師版應用已停止")
+
+def wait_for_port(port, timeout=60.0, interval=0.1):
+    """輪詢本機端口直到可連線；逾時回傳 False"""
+    import socket
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(interval)
+    return False
 
 def open_browser():
     """自動開啟瀏覽器到教師版系統"""
     print("🌐 等待應用程式完全啟動...")
-    time.sleep(15)  # 等待應用程式完全啟動
     
-    # 檢查端口是否真的在監聽
-    import socket
-    max_retries = 10
-    for i in range(max_retries):
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex(('127.0.0.1', 5001))
-            sock.close()
-            if result == 0:
-                print("✅ 應用程式已完全啟動，正在開啟瀏覽器...")
-                break
-        except:
-            pass
-        time.sleep(2)
-        print(f"⏳ 等待應用程式啟動... ({i+1}/{max_retries})")
+    # 與 start_teacher_app 相同的端口設定
+    port = int(os.getenv("TEACHER_PORT", "5001"))
+    url = f"http://localhost:{port}/teacher"
+    
+    # 端口一可連線就開啟瀏覽器，不固定等待
+    if wait_for_port(port):
+        print("✅ 應用程式已完全啟動，正在開啟瀏覽器...")
+    else:
+        print("⚠️  等待應用程式啟動逾時，仍嘗試開啟瀏覽器")
     
     try:
         # 使用 open_new_tab 確保開啟新分頁
-        webbrowser.open_new_tab("http://localhost:5001/teacher")
-        print("✅ 已開啟教師版系統網頁: http://localhost:5001/teacher")
+        webbrowser.open_new_tab(url)
+        print(f"✅ 已開啟教師版系統網頁: {url}")
     except Exception as e:
         print(f"⚠️  無法自動開啟瀏覽器: {e}")
-        print("請手動開啟瀏覽器並訪問: http://localhost:5001/teacher")
+        print(f"請手動開啟瀏覽器並訪問: {url}")
 
 def main():
     """主函數"""
@@ -156,8 +139,8 @@ def main():
     check_env_file()
     
     print("\n📋 系統說明:")
-    print("   - 原有批改系統: http://localhost:5000")
-    print("   - 教師版管理界面: http://localhost:5001")
+    print(f"   - 原有批改系統: http://localhost:{os.getenv('FLASK_PORT', '5000')}")
+    print(f"   - 教師版管理界面: http://localhost:{os.getenv('TEACHER_PORT', '5001')}")
     print("   - 按 Ctrl+C 停止所有服務")
     print("\n" + "="*60)
     
@@ -174,8 +157,7 @@ def main():
         browser_thread = threading.Thread(target=open_browser, daemon=True)
         
         original_thread.start()
-        time.sleep(2)  # 等待原有系統啟動
-        teacher_thread.start()
+        teacher_thread.start()  # teacher_app 匯入 app 時由匯入鎖等待其載入完成
         browser_thread.start()  # 啟動瀏覽器開啟線程
         
         # 等待用戶中斷
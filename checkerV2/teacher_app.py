@@ -4,31 +4,56 @@
 整合現有的三代理人批改系統，提供完整的教師管理界面
 """
 
-from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, jsonify, flash, send_file, Response, stream_with_context
 from werkzeug.utils import secure_filename
-import os, uuid, logging, json, re, time, random, math
-from collections import Counter
+import os, uuid, logging, json, re, time, threading
 from datetime import datetime, timezone
+import dataclasses
+from dataclasses import dataclass, field
+from collections import OrderedDict, defaultdict
+from functools import lru_cache, partial
+from types import MappingProxyType
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor
-import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import io
-import pandas as pd
 
 # 導入現有的批改系統
 from app import (
     call_gpt_grader, call_claude_grader, call_gemini_arbitration,
     call_gemini_similarity, enhanced_split_by_question, split_by_question,
     read_text, allowed_file, get_latest_prompt, create_or_bump_prompt,
-    log_prompt_blackboard, sanitize_html, render_final_table,
-    normalize_items, _sort_items_by_id, i, calc_score_gap,
-    decorate_comment_by_outcome, build_comment_matrix_for_weakness,
-    run_gemini_weakness_review, extract_json_best_effort,
+    log_prompt_blackboard, flush_blackboard, render_final_tables,
+    build_comment_matrix_for_weakness, run_gemini_weakness_review,
     run_prompt_autotune, PROMPT_AUTOTUNE_MODE
 )
 
 # === MongoDB ===
-from pymongo import MongoClient, errors as mongo_errors
+from pymongo import MongoClient, UpdateOne, errors as mongo_errors
+from bson.raw_bson import RawBSONDocument
+
+# 可選：Celery 任務佇列（設定 CELERY_BROKER_URL 或 REDIS_URL 時啟用）
+try:
+    from celery import Celery
+except ImportError:
+    Celery = None
+
+# 可選：安全檢查代理人（依賴 openai / pandas，未安裝時略過安全檢查）
+try:
+    from 安全檢查代理人 import get_checker, init_checker
+except ImportError:
+    get_checker = init_checker = None
+
+# 可選：orjson 加速 API 回應序列化
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# 可選：Redis 快取全班統計（設定 REDIS_URL 時啟用）
+try:
+    import redis
+except ImportError:
+    redis = None
 
 load_dotenv()
 
@@ -36,9 +61,30 @@ load_dotenv()
 # Flask 應用
 # ----------------------------------------------------------------------
 app = Flask(__name__)
+
+# jsonify() 與 request.get_json() 皆透過 app.json，換成 orjson 即全部 API 生效（Flask >= 2.2）
+# 保留 Flask 預設輸出：鍵排序、datetime 交回 default() 轉為 HTTP 日期格式
+if orjson is not None:
+    try:
+        from flask.json.provider import DefaultJSONProvider
+
+        class OrjsonProvider(DefaultJSONProvider):
+            _OPTIONS = (orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+                        | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_PASSTHROUGH_DATETIME)
+
+            def dumps(self, obj, **kwargs):
+                return orjson.dumps(obj, default=self.default, option=self._OPTIONS).decode("utf-8")
+
+            def loads(self, s, **kwargs):
+                return orjson.loads(s)
+
+        app.json = OrjsonProvider(app)
+    except ImportError:
+        pass
 app.secret_key = os.environ.get("SECRET_KEY", os.urandom(24))
 app.config["UPLOAD_FOLDER"] = os.path.join(os.getcwd(), "uploads")
 app.config["MAX_CONTENT_LENGTH"] = 50 * 1024 * 1024  # 50MB
+UPLOAD_BUFFER_SIZE = 1024 * 1024  # 儲存上傳檔案時每次複製 1MB（werkzeug 預設 16KB）
 os.makedirs(app.config["UPLOAD_FOLDER"], exist_ok=True)
 
 # ----------------------------------------------------------------------
@@ -67,7 +113,9 @@ if GEMINI_API_KEY:
 # ----------------------------------------------------------------------
 MONGODB_URI = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
 MONGODB_DB = os.getenv("MONGODB_DB", "grading_blackboard")
-mongo = MongoClient(MONGODB_URI)
+# 全模組共用同一個 client（內建連線池），不要在函數內另建 MongoClient
+MONGO_SOCKET_TIMEOUT_MS = 5000
+mongo = MongoClient(MONGODB_URI, maxPoolSize=50, minPoolSize=5, socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS)
 db = mongo[MONGODB_DB]
 
 # 集合定義
@@ -75,7 +123,20 @@ col_exams = db["exams"]
 col_students = db["students"] 
 col_submissions = db["submissions"]
 col_grading_results = db["grading_results"]
+# 唯讀的投影查詢（統計 / 匯出）改以 RawBSONDocument 解碼：欄位讀取時才解析，不為每筆建立完整 dict
+col_grading_results_raw = db.get_collection(
+    "grading_results",
+    codec_options=col_grading_results.codec_options.with_options(document_class=RawBSONDocument)
+)
 col_classes = db["classes"]
+col_bbmsgs = db["blackboard_messages"]  # 由 app.py 批改流程寫入
+col_weakness = db["weakness_analyses"]  # 整卷弱點分析（體積大，與批改結果分開存放）
+col_class_stats = db["class_stats"]  # 全班統計的實體化結果（每場考試一筆，批改結果寫入時失效）
+
+# 黑板訊息只取頁面需要的欄位
+_BBMSG_PROJECTION = {"type": 1, "action": 1, "content": 1, "payload": 1, "timestamp": 1, "_id": 0}
+# 單一任務的訊息通常在百則左右，一批取回（預設首批 101 筆，超過就得再來回一次）
+_BBMSG_BATCH_SIZE = 200
 
 # 建立索引
 try:
@@ -84,158 +145,400 @@ try:
     col_submissions.create_index([("exam_id", 1), ("student_id", 1)])
     col_grading_results.create_index([("exam_id", 1), ("student_id", 1)])
     col_classes.create_index([("teacher_id", 1)])
+    # 與實際查詢形狀一致：依考試排名（含排序鍵）、依狀態統計提交
+    col_grading_results.create_index([("exam_id", 1), ("final_score", -1)])
+    col_submissions.create_index([("exam_id", 1), ("status", 1)])
+    col_grading_results.create_index([("exam_id", 1), ("status", 1)])
+    col_bbmsgs.create_index([("task_id", 1), ("action", 1), ("timestamp", -1)])
 except Exception as e:
     logger.warning("Mongo 索引建立警告: %s", e)
 
+# 不可變的識別碼由資料庫保證唯一（既有資料若已有重複會建立失敗，僅記錄警告）
+for _col, _key in ((col_exams, "exam_id"), (col_grading_results, "result_id"), (col_weakness, "result_id"),
+                   (col_class_stats, "exam_id")):
+    try:
+        _col.create_index([(_key, 1)], unique=True)
+    except Exception as e:
+        logger.warning("Mongo 唯一索引 %s.%s 建立警告: %s", _col.name, _key, e)
+
+# 安全檢查代理人建立時需讀取樣本並組 system message；啟動時於背景先建立單例，
+# 第一個批改/安全檢查請求不必等待（app 匯入時若已啟動預載，init_checker 不會重複啟動）
+SECURITY_AGENT_PREWARM = os.getenv("SECURITY_AGENT_PREWARM", "1").lower() in ("1", "true", "yes")
+if init_checker is not None and SECURITY_AGENT_PREWARM:
+    init_checker()
+
+# ----------------------------------------------------------------------
+# 批改任務佇列
+# 啟用後整份考卷的批改交給獨立 worker 執行，HTTP 請求立即返回 task_id：
+#   celery -A teacher_app.celery_app worker -Q llm --concurrency 4
+# worker 需在同一目錄（或共用的 uploads 資料夾）下執行，才能讀到上傳的答案檔
+# 未安裝 celery 或未設定 broker 時，沿用行程內執行緒批改
+# 同一份考卷內同時批改的答案數（每份答案多半在等待 LLM 回應），及批改結果每幾份批次寫入一次
+# ----------------------------------------------------------------------
+GRADING_CONCURRENCY = int(os.getenv("GRADING_CONCURRENCY", "8"))
+GRADING_WRITE_BATCH = int(os.getenv("GRADING_WRITE_BATCH", "10"))
+# GPT / Claude 分數差不超過此值時視為直接共識，不再呼叫 Gemini 比對語意
+CONSENSUS_FASTPATH_GAP = int(os.getenv("CONSENSUS_FASTPATH_GAP", "1"))
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL") or os.getenv("REDIS_URL")
+celery_app = None
+if Celery is not None and CELERY_BROKER_URL:
+    celery_app = Celery("teacher_app", broker=CELERY_BROKER_URL,
+                        backend=os.getenv("CELERY_RESULT_BACKEND") or CELERY_BROKER_URL)
+    celery_app.conf.task_routes = {"grade_exam": {"queue": "llm"}}
+    logger.info("✅ 批改任務改由 Celery worker 執行")
+
+# ----------------------------------------------------------------------
+# 全班統計快取（Redis）：新批改結果寫入時清除該考試的快取
+# ----------------------------------------------------------------------
+CLASS_STATS_TTL = int(os.getenv("CLASS_STATS_TTL", "300"))
+redis_client = None
+if redis is not None and os.getenv("REDIS_URL"):
+    try:
+        redis_client = redis.Redis.from_url(os.getenv("REDIS_URL"))
+        logger.info("✅ Redis 統計快取已啟用")
+    except Exception as e:
+        logger.warning("Redis 初始化失敗，不使用統計快取: %s", e)
+
+def _class_stats_key(exam_id):
+    return f"class_stats:v2:{exam_id}"
+
+def _rank_pct_key(exam_id):
+    return f"rank_pct:{exam_id}"
+
+def _cache_get(key):
+    if redis_client is None:
+        return None
+    try:
+        cached = redis_client.get(key)
+        return json.loads(cached) if cached else None
+    except Exception as e:
+        logger.warning("讀取統計快取失敗: %s", e)
+        return None
+
+def _cache_set(key, value):
+    if redis_client is None:
+        return
+    try:
+        redis_client.setex(key, CLASS_STATS_TTL, json.dumps(value, default=str))
+    except Exception as e:
+        logger.warning("寫入統計快取失敗: %s", e)
+
+def _get_cached_class_stats(exam_id):
+    return _cache_get(_class_stats_key(exam_id))
+
+def _set_cached_class_stats(exam_id, stats):
+    _cache_set(_class_stats_key(exam_id), stats)
+
+def _get_materialized_class_stats(exam_id):
+    """讀取 MongoDB 中實體化的全班統計文件 {stats, gen}（多行程共用，不需 Redis）"""
+    try:
+        return col_class_stats.find_one({"exam_id": exam_id}, {"_id": 0, "stats": 1, "gen": 1})
+    except Exception as e:
+        logger.warning("讀取實體化統計失敗: %s", e)
+        return None
+
+def _materialize_class_stats(exam_id, stats, gen):
+    """寫回統計；以讀取時的 gen 為條件，計算期間若有新結果寫入（gen 已遞增）則放棄寫回"""
+    try:
+        col_class_stats.update_one(
+            {"exam_id": exam_id, "gen": gen},
+            {"$set": {"stats": stats, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True
+        )
+    except mongo_errors.DuplicateKeyError:
+        pass
+    except Exception as e:
+        logger.warning("寫入實體化統計失敗: %s", e)
+
+def _invalidate_class_stats(exam_id):
+    try:
+        col_class_stats.update_one({"exam_id": exam_id}, {"$inc": {"gen": 1}, "$unset": {"stats": ""}}, upsert=True)
+    except Exception as e:
+        logger.warning("清除實體化統計失敗: %s", e)
+    if redis_client is None:
+        return
+    try:
+        redis_client.delete(_class_stats_key(exam_id), _rank_pct_key(exam_id))
+    except Exception as e:
+        logger.warning("清除統計快取失敗: %s", e)
+
 # ----------------------------------------------------------------------
 # 資料模型
 # ----------------------------------------------------------------------
-class Exam:
-    def __init__(self, teacher_id, title, subject, description="", max_score=100):
-        self.exam_id = str(uuid.uuid4())
-        self.teacher_id = teacher_id
-        self.title = title
-        self.subject = subject
-        self.description = description
-        self.max_score = max_score
-        self.created_at = datetime.now(timezone.utc)
-        self.status = "draft"  # draft, active, completed
-        self.question_file = None
-        self.total_students = 0
-        self.graded_students = 0
+# 以 dataclass 定義，實例屬性即為寫入 MongoDB 的文件內容（見 _doc）
+def _new_id():
+    return str(uuid.uuid4())
+
+def _utcnow():
+    return datetime.now(timezone.utc)
 
+@dataclass
+class Exam:
+    exam_id: str = field(init=False, default_factory=_new_id)
+    teacher_id: str
+    title: str
+    subject: str
+    description: str = ""
+    max_score: int = 100
+    created_at: datetime = field(init=False, default_factory=_utcnow)
+    status: str = field(init=False, default="draft")  # draft, active, completed
+    question_file: str = field(init=False, default=None)
+    total_students: int = field(init=False, default=0)
+    graded_students: int = field(init=False, default=0)
+
+@dataclass
 class Student:
-    def __init__(self, class_id, student_id, name, email=""):
-        self.student_id = student_id
-        self.class_id = class_id
-        self.name = name
-        self.email = email
-        self.created_at = datetime.now(timezone.utc)
+    class_id: str
+    student_id: str
+    name: str
+    email: str = ""
+    created_at: datetime = field(init=False, default_factory=_utcnow)
 
+@dataclass
 class Submission:
-    def __init__(self, exam_id, student_id, answer_file):
-        self.submission_id = str(uuid.uuid4())
-        self.exam_id = exam_id
-        self.student_id = student_id
-        self.answer_file = answer_file
-        self.submitted_at = datetime.now(timezone.utc)
-        self.status = "submitted"  # submitted, grading, completed, failed
-        self.grading_result_id = None
-
+    submission_id: str = field(init=False, default_factory=_new_id)
+    exam_id: str
+    student_id: str
+    answer_file: str
+    submitted_at: datetime = field(init=False, default_factory=_utcnow)
+    status: str = field(init=False, default="submitted")  # submitted, grading, completed, failed
+    grading_result_id: str = field(init=False, default=None)
+
+@dataclass
 class GradingResult:
-    def __init__(self, exam_id, student_id, submission_id):
-        self.result_id = str(uuid.uuid4())
-        self.exam_id = exam_id
-        self.student_id = student_id
-        self.submission_id = submission_id
-        self.task_id = str(uuid.uuid4())  # 用於關聯黑板訊息
-        self.graded_at = datetime.now(timezone.utc)
-        self.gpt_score = 0
-        self.claude_score = 0
-        self.final_score = 0
-        self.gpt_feedback = ""
-        self.claude_feedback = ""
-        self.final_feedback = ""
-        self.gpt_table = ""
-        self.claude_table = ""
-        self.final_table = ""
-        self.weakness_analysis = None
-        self.status = "completed"  # completed, failed
+    result_id: str = field(init=False, default_factory=_new_id)
+    exam_id: str
+    student_id: str
+    submission_id: str
+    task_id: str = field(init=False, default_factory=_new_id)  # 用於關聯黑板訊息
+    graded_at: datetime = field(init=False, default_factory=_utcnow)
+    gpt_score: float = field(init=False, default=0)
+    claude_score: float = field(init=False, default=0)
+    final_score: float = field(init=False, default=0)
+    gpt_feedback: str = field(init=False, default="")
+    claude_feedback: str = field(init=False, default="")
+    final_feedback: str = field(init=False, default="")
+    gpt_table: str = field(init=False, default="")
+    claude_table: str = field(init=False, default="")
+    final_table: str = field(init=False, default="")
+    weakness_analysis: dict = field(init=False, default=None)
+    status: str = field(init=False, default="completed")  # completed, failed
+
+_FIELD_NAMES = {}
+
+def _doc(obj):
+    """模型實例轉為 MongoDB 文件（每次產生新 dict，insert 在文件上加的 _id 不會寫回實例）"""
+    cls = type(obj)
+    names = _FIELD_NAMES.get(cls)
+    if names is None:
+        names = _FIELD_NAMES[cls] = tuple(f.name for f in dataclasses.fields(cls))
+    return {name: getattr(obj, name) for name in names}
 
 # ----------------------------------------------------------------------
 # 工具函數
 # ----------------------------------------------------------------------
+@lru_cache(maxsize=1)
+def _build_upload_index(folder, mtime_ns):
+    index = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            name = entry.name
+            index[name] = name  # 完整檔名優先
+            _, sep, original = name.partition("_")
+            if sep:
+                index.setdefault(original, name)
+    return index
+
+def _upload_index():
+    """上傳目錄的檔名索引 {檔名或去掉 "<uuid>_" 前綴的原檔名: 實際檔名}
+    以目錄 mtime 為快取鍵：目錄內新增或刪除檔案時才重新掃描
+    """
+    folder = app.config["UPLOAD_FOLDER"]
+    return _build_upload_index(folder, os.stat(folder).st_mtime_ns)
+
+@lru_cache(maxsize=256)
+def _read_text_at(path, mtime_ns, size):
+    return read_text(path)
+
+def _read_text_cached(path):
+    """讀取上傳檔案的文字內容（PDF / DOCX 解析較慢，調整提詞後重新批改時會重複讀同一批檔案）
+    以 (路徑, mtime, 大小) 快取，檔案被覆寫時自動失效；讀取失敗不快取
+    """
+    st = os.stat(path)
+    return _read_text_at(path, st.st_mtime_ns, st.st_size)
+
 def get_teacher_id():
     """簡化版：使用固定教師ID，實際應用中應該從session或認證系統獲取"""
     return "teacher_001"
 
 def save_exam(exam):
     """儲存考試到資料庫"""
-    exam_dict = {
-        "exam_id": exam.exam_id,
-        "teacher_id": exam.teacher_id,
-        "title": exam.title,
-        "subject": exam.subject,
-        "description": exam.description,
-        "max_score": exam.max_score,
-        "created_at": exam.created_at,
-        "status": exam.status,
-        "question_file": exam.question_file,
-        "total_students": exam.total_students,
-        "graded_students": exam.graded_students
-    }
+    exam_dict = _doc(exam)
     col_exams.insert_one(exam_dict)
     return exam_dict
 
+# 考試文件快取：同一批次中 get_exam 會對每位學生重複呼叫，文件本身很少變動
+# 本行程內的更新經 update_exam 立即清除；其他行程（其他 gunicorn worker、Celery worker）的更新最多延遲 EXAM_CACHE_TTL 秒
+EXAM_CACHE_TTL = float(os.getenv("EXAM_CACHE_TTL", "30"))
+EXAM_CACHE_SIZE = int(os.getenv("EXAM_CACHE_SIZE", "512"))
+_exam_cache = OrderedDict()  # exam_id -> (到期時間, 文件)
+_exam_cache_lock = threading.Lock()
+
 def get_exam(exam_id):
-    """獲取考試資料"""
-    return col_exams.find_one({"exam_id": exam_id})
+    """獲取考試資料（呼叫端只可讀取，不可修改回傳的文件）"""
+    now = time.monotonic()
+    with _exam_cache_lock:
+        hit = _exam_cache.get(exam_id)
+        if hit is not None and hit[0] > now:
+            _exam_cache.move_to_end(exam_id)
+            return hit[1]
+    
+    doc = col_exams.find_one({"exam_id": exam_id})
+    if doc is not None and EXAM_CACHE_TTL > 0:
+        with _exam_cache_lock:
+            _exam_cache[exam_id] = (now + EXAM_CACHE_TTL, doc)
+            _exam_cache.move_to_end(exam_id)
+            while len(_exam_cache) > EXAM_CACHE_SIZE:
+                _exam_cache.popitem(last=False)
+    return doc
+
+def update_exam(exam_id, fields):
+    """更新考試欄位並清除快取"""
+    col_exams.update_one({"exam_id": exam_id}, {"$set": fields})
+    with _exam_cache_lock:
+        _exam_cache.pop(exam_id, None)
+    if "max_score" in fields:
+        _invalidate_class_stats(exam_id)  # 成績分布門檻依滿分計算
 
 def get_exams_by_teacher(teacher_id):
     """獲取教師的所有考試"""
     return list(col_exams.find({"teacher_id": teacher_id}).sort("created_at", -1))
 
+def _insert_many_unordered(collection, docs, label):
+    """一次往返寫入多筆；ordered=False 讓單筆錯誤（如重複鍵）不會中斷其餘文件"""
+    if not docs:
+        return docs
+    try:
+        collection.insert_many(docs, ordered=False)
+    except mongo_errors.BulkWriteError as e:
+        logger.warning("批次寫入%s部分失敗：%s 筆", label, len(e.details.get("writeErrors", [])))
+    return docs
+
 def save_student(student):
     """儲存學生到資料庫"""
-    student_dict = {
-        "student_id": student.student_id,
-        "class_id": student.class_id,
-        "name": student.name,
-        "email": student.email,
-        "created_at": student.created_at
-    }
+    student_dict = _doc(student)
     col_students.insert_one(student_dict)
     return student_dict
 
+def save_students_bulk(students, now=None):
+    """批次儲存學生（匯入名單用）；同一批共用一個建立時間"""
+    now = now or _utcnow()
+    for s in students:
+        s.created_at = now
+    return _insert_many_unordered(col_students, [_doc(s) for s in students], "學生")
+
 def get_students_by_class(class_id):
     """獲取班級的所有學生"""
     return list(col_students.find({"class_id": class_id}))
 
 def save_submission(submission):
     """儲存學生提交"""
-    submission_dict = {
-        "submission_id": submission.submission_id,
-        "exam_id": submission.exam_id,
-        "student_id": submission.student_id,
-        "answer_file": submission.answer_file,
-        "submitted_at": submission.submitted_at,
-        "status": submission.status,
-        "grading_result_id": submission.grading_result_id
-    }
+    submission_dict = _doc(submission)
     col_submissions.insert_one(submission_dict)
     return submission_dict
 
+def save_submissions_bulk(submissions, now=None):
+    """批次儲存學生提交（多檔上傳用）；同一次上傳共用一個提交時間"""
+    now = now or _utcnow()
+    for s in submissions:
+        s.submitted_at = now
+    return _insert_many_unordered(col_submissions, [_doc(s) for s in submissions], "提交")
+
 def get_submissions_by_exam(exam_id):
     """獲取考試的所有提交"""
     return list(col_submissions.find({"exam_id": exam_id}))
 
 def save_grading_result(result):
-    """儲存批改結果"""
-    result_dict = {
-        "result_id": result.result_id,
-        "exam_id": result.exam_id,
-        "student_id": result.student_id,
-        "submission_id": result.submission_id,
-        "task_id": result.task_id,
-        "graded_at": result.graded_at,
-        "gpt_score": result.gpt_score,
-        "claude_score": result.claude_score,
-        "final_score": result.final_score,
-        "gpt_feedback": result.gpt_feedback,
-        "claude_feedback": result.claude_feedback,
-        "final_feedback": result.final_feedback,
-        "gpt_table": result.gpt_table,
-        "claude_table": result.claude_table,
-        "final_table": result.final_table,
-        "weakness_analysis": result.weakness_analysis,
-        "status": result.status
-    }
+    """儲存批改結果（弱點分析另存於 weakness_analyses，批改結果集合只留小文件）"""
+    result_dict = _doc(result)
+    weakness_analysis = result_dict.pop("weakness_analysis", None)
     col_grading_results.insert_one(result_dict)
+    if weakness_analysis:
+        col_weakness.insert_one({
+            "result_id": result.result_id,
+            "exam_id": result.exam_id,
+            "data": weakness_analysis
+        })
+    _invalidate_class_stats(result.exam_id)
+    result_dict["weakness_analysis"] = weakness_analysis
     return result_dict
 
+def get_weakness_analysis(result_id):
+    """依 result_id 讀取弱點分析（只在顯示單一學生時載入）"""
+    doc = col_weakness.find_one({"result_id": result_id}, {"data": 1, "_id": 0})
+    return doc["data"] if doc else None
+
+def _attach_weakness_analysis(result):
+    """補上弱點分析欄位；舊資料仍內嵌在批改結果中的直接沿用"""
+    if result is not None and "weakness_analysis" not in result and result.get("result_id"):
+        result["weakness_analysis"] = get_weakness_analysis(result["result_id"])
+    return result
+
+def save_grading_results_bulk(results):
+    """批次儲存批改結果（整份考卷批改用），弱點分析同樣另存"""
+    if not results:
+        return []
+    docs = [_doc(r) for r in results]
+    weakness_docs = []
+    for r, d in zip(results, docs):
+        weakness_analysis = d.pop("weakness_analysis", None)
+        if weakness_analysis:
+            weakness_docs.append({"result_id": r.result_id, "exam_id": r.exam_id, "data": weakness_analysis})
+    _insert_many_unordered(col_grading_results, docs, "批改結果")
+    _insert_many_unordered(col_weakness, weakness_docs, "弱點分析")
+    for exam_id in {r.exam_id for r in results}:
+        _invalidate_class_stats(exam_id)
+    return docs
+
+def iter_grading_results_by_exam(exam_id, fields=None):
+    """
+    逐筆產生考試的批改結果（只需走訪一次時使用，不把整個 cursor 留在記憶體）
+    fields 指定時只取這些欄位，不載入 feedback、表格與弱點分析等大型欄位，
+    且回傳唯讀的 RawBSONDocument（以 doc["欄位"] 讀取，不可修改）
+    """
+    if not fields:
+        yield from col_grading_results.find({"exam_id": exam_id})
+        return
+    projection = {f: 1 for f in fields}
+    projection["_id"] = 0
+    yield from col_grading_results_raw.find({"exam_id": exam_id}, projection)
+
 def get_grading_results_by_exam(exam_id):
     """獲取考試的所有批改結果"""
-    return list(col_grading_results.find({"exam_id": exam_id}))
+    return list(iter_grading_results_by_exam(exam_id))
+
+def get_grading_scores_by_exam(exam_id, fields=("final_score",)):
+    """只取分數等少數欄位（統計 / 匯出用）"""
+    return list(iter_grading_results_by_exam(exam_id, fields))
+
+def get_exam_score_stats(exam_id):
+    """已完成批改的平均 / 最高 / 最低分，由 MongoDB 以 (exam_id, status) 索引單次 $group 算出"""
+    agg = list(col_grading_results.aggregate([
+        {"$match": {"exam_id": exam_id, "status": "completed"}},
+        {"$group": {
+            "_id": None,
+            "avg": {"$avg": "$final_score"},
+            "max": {"$max": "$final_score"},
+            "min": {"$min": "$final_score"},
+            "n": {"$sum": 1}
+        }}
+    ]))
+    if not agg:
+        return {"avg": 0, "max": 0, "min": 0, "n": 0}
+    return agg[0]
+
+# 成績列表頁面用到的欄位
+_RESULT_LIST_FIELDS = ("result_id", "student_id", "gpt_score", "claude_score", "final_score", "graded_at", "status")
 
 def get_grading_result(exam_id, student_id):
     """獲取特定學生的批改結果"""
@@ -244,29 +547,73 @@ def get_grading_result(exam_id, student_id):
 def get_blackboard_messages(task_id):
     """獲取黑板訊息"""
     try:
-        # 直接連接黑板訊息資料庫
-        from pymongo import MongoClient
-        mongodb_uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
-        client = MongoClient(mongodb_uri)
-        db_blackboard = client["grading_blackboard"]
-        col_bbmsgs = db_blackboard["blackboard_messages"]
-        
-        cur = col_bbmsgs.find({"task_id": task_id}).sort("timestamp", 1)
-        messages = []
-        for x in cur:
-            messages.append({
-                "type": x.get("type"),
-                "action": x.get("action"),
-                "content": x.get("content"),
-                "payload": x.get("payload"),
-                "timestamp": x.get("timestamp")
-            })
-        client.close()
-        return messages
+        cur = (col_bbmsgs.find({"task_id": task_id}, projection=_BBMSG_PROJECTION)
+               .sort("timestamp", 1).batch_size(_BBMSG_BATCH_SIZE))
+        return list(cur)
     except Exception as e:
         logger.warning(f"獲取黑板訊息失敗：{e}")
         return []
 
+def get_weakness_review_message(task_id, blackboard_messages=None):
+    """取得任務最新一筆成功的整卷弱點分析訊息
+    已有該任務的訊息列表時直接從中挑選，否則以 (task_id, action, timestamp) 索引單筆查詢
+    """
+    if blackboard_messages is not None:
+        for msg in reversed(blackboard_messages):
+            if msg.get("action") == "weakness_review" and (msg.get("payload") or {}).get("ok") is not False:
+                return msg
+        return None
+    try:
+        return col_bbmsgs.find_one(
+            {"task_id": task_id, "action": "weakness_review", "payload.ok": {"$ne": False}},
+            projection=_BBMSG_PROJECTION,
+            sort=[("timestamp", -1)]
+        )
+    except Exception as e:
+        logger.warning(f"獲取弱點分析訊息失敗：{e}")
+        return None
+
+def get_grading_results_batch(exam_id, student_ids):
+    """一次查詢多位學生的批改結果 {student_id: result}（全班處理時取代逐一 find_one）"""
+    cur = col_grading_results.find({"exam_id": exam_id, "student_id": {"$in": list(student_ids)}})
+    return {r["student_id"]: r for r in cur}
+
+def get_blackboard_messages_batch(task_ids):
+    """一次查詢多個任務的黑板訊息 {task_id: [訊息...]}（依時間排序）"""
+    grouped = defaultdict(list)
+    try:
+        cur = col_bbmsgs.find({"task_id": {"$in": list(task_ids)}},
+                              projection={**_BBMSG_PROJECTION, "task_id": 1}).sort("timestamp", 1)
+        for msg in cur:
+            grouped[msg.pop("task_id")].append(msg)
+    except Exception as e:
+        logger.warning(f"批次獲取黑板訊息失敗：{e}")
+    return grouped
+
+# 練習建議各欄位的來源鍵（依序取第一個非空值）
+_SUGGESTION_TITLE_KEYS = ("title", "action", "topic")
+_SUGGESTION_DESCRIPTION_KEYS = ("description", "example_fix")
+
+def _first_value(item, keys, default):
+    for key in keys:
+        value = item.get(key)
+        if value:
+            return value
+    return default
+
+def _normalize_suggestion(item):
+    if isinstance(item, dict):
+        # 確保必備鍵存在
+        return {
+            "title": _first_value(item, _SUGGESTION_TITLE_KEYS, "練習建議"),
+            "description": _first_value(item, _SUGGESTION_DESCRIPTION_KEYS, ""),
+            "key_focus": item.get("key_focus"),
+            "examples": item.get("examples"),
+            "pre_submission_check": item.get("pre_submission_check")
+        }
+    # 視為簡單字串
+    return {"title": str(item), "description": ""}
+
 def _normalize_practice_suggestions(raw_list):
     """將練習建議標準化為字典列表。
     支援輸入為字串或字典；字串將轉為 {"title": 字串, "description": ""}。
@@ -274,88 +621,133 @@ def _normalize_practice_suggestions(raw_list):
     try:
         if not raw_list:
             return []
-        normalized = []
-        for item in raw_list:
-            if isinstance(item, dict):
-                # 確保必備鍵存在
-                normalized.append({
-                    "title": item.get("title") or item.get("action") or item.get("topic") or "練習建議",
-                    "description": item.get("description") or item.get("example_fix") or "",
-                    "key_focus": item.get("key_focus"),
-                    "examples": item.get("examples"),
-                    "pre_submission_check": item.get("pre_submission_check")
-                })
-            else:
-                # 視為簡單字串
-                text = str(item)
-                normalized.append({
-                    "title": text,
-                    "description": ""
-                })
-        return normalized
+        return [_normalize_suggestion(item) for item in raw_list]
     except Exception as e:
         logger.warning(f"標準化練習建議失敗：{e}")
         return []
 
 def analyze_class_performance(exam_id):
-    """分析全班學習狀況"""
+    """分析全班學習狀況（有 Redis 時先查快取，再查 MongoDB 實體化結果，都沒有才重新彙總）"""
+    # 缺少 scores 的舊格式結果視同未命中，重新彙總
+    cached = _get_cached_class_stats(exam_id)
+    if cached is not None and "scores" in cached:
+        return cached
+    
+    materialized = _get_materialized_class_stats(exam_id)
+    if materialized and "scores" in (materialized.get("stats") or {}):
+        _set_cached_class_stats(exam_id, materialized["stats"])
+        return materialized["stats"]
+    gen = (materialized or {}).get("gen", 0)
+    
     try:
-        grading_results = get_grading_results_by_exam(exam_id)
-        if not grading_results:
-            return None
-        
         # 獲取考試信息
         exam = get_exam(exam_id)
         max_possible_score = exam.get("max_score", 100) if exam else 100
         
-        # 基本統計
-        scores = [r["final_score"] for r in grading_results]
-        total_students = len(scores)
-        avg_score = sum(scores) / total_students if total_students > 0 else 0
-        max_score = max(scores) if scores else 0
-        min_score = min(scores) if scores else 0
-        
-        # 根據實際滿分（不限 100）動態計算成績分布（以百分比門檻切分）
-        score_ranges = {
-            "優秀": len([s for s in scores if s >= max_possible_score * 0.9]),
-            "良好": len([s for s in scores if max_possible_score * 0.8 <= s < max_possible_score * 0.9]),
-            "中等": len([s for s in scores if max_possible_score * 0.7 <= s < max_possible_score * 0.8]),
-            "待改進": len([s for s in scores if max_possible_score * 0.6 <= s < max_possible_score * 0.7]),
-            "需要加強": len([s for s in scores if s < max_possible_score * 0.6])
-        }
-        # 及格率基於 60% 的滿分
-        pass_rate = len([s for s in scores if s >= max_possible_score * 0.6]) / total_students * 100 if total_students > 0 else 0
+        # 根據實際滿分（不限 100）動態計算成績分布（以百分比門檻切分），門檻在此算好後帶入 pipeline
+        t90, t80, t70, t60 = (max_possible_score * r for r in (0.9, 0.8, 0.7, 0.6))
+        
+        def count_if(*conds):
+            return {"$sum": {"$cond": [{"$and": list(conds)}, 1, 0]}}
+        
+        # 統計全部在 MongoDB 端以單次 $group 完成，只傳回彙總值與分數列表（不傳整份批改文件）
+        agg = list(col_grading_results.aggregate([
+            {"$match": {"exam_id": exam_id}},
+            {"$group": {
+                "_id": None,
+                "total_students": {"$sum": 1},
+                "avg_score": {"$avg": "$final_score"},
+                "max_score": {"$max": "$final_score"},
+                "min_score": {"$min": "$final_score"},
+                "std_dev": {"$stdDevPop": "$final_score"},
+                "scores": {"$push": "$final_score"},
+                "優秀": count_if({"$gte": ["$final_score", t90]}),
+                "良好": count_if({"$gte": ["$final_score", t80]}, {"$lt": ["$final_score", t90]}),
+                "中等": count_if({"$gte": ["$final_score", t70]}, {"$lt": ["$final_score", t80]}),
+                "待改進": count_if({"$gte": ["$final_score", t60]}, {"$lt": ["$final_score", t70]}),
+                "需要加強": count_if({"$lt": ["$final_score", t60]})
+            }}
+        ]))
+        if not agg:
+            return None
+        g = agg[0]
         
-        # 標準差
-        variance = sum((s - avg_score) ** 2 for s in scores) / total_students if total_students > 0 else 0
-        std_dev = variance ** 0.5
+        total_students = g["total_students"]
+        score_ranges = {k: g[k] for k in ("優秀", "良好", "中等", "待改進", "需要加強")}
+        # 及格率基於 60% 的滿分
+        pass_rate = (total_students - score_ranges["需要加強"]) / total_students * 100
         
-        return {
+        stats = {
             "total_students": total_students,
-            "avg_score": round(avg_score, 1),
-            "max_score": max_score,
-            "min_score": min_score,
+            "avg_score": round(g["avg_score"] or 0, 1),
+            "max_score": g["max_score"],
+            "min_score": g["min_score"],
             "pass_rate": round(pass_rate, 1),
-            "std_dev": round(std_dev, 1),
+            "std_dev": round(g["std_dev"] or 0, 1),
             "score_ranges": score_ranges,
-            "scores": scores
+            "scores": g["scores"]  # 班級分析頁的分數分布直方圖使用
         }
+        _set_cached_class_stats(exam_id, stats)
+        _materialize_class_stats(exam_id, stats, gen)
+        return stats
     except Exception as e:
         logger.error(f"分析全班表現失敗：{e}")
         return None
 
-def generate_learning_suggestions(exam_id, student_id, result_id=None):
-    """使用Gemini生成詳細的個人學習建議"""
+def get_rank_percentiles(exam_id):
+    """全班每位學生的排名百分比 {student_id: %}（分數低於該生的人數比例）
+    由 MongoDB $setWindowFields 一次算出整班（需 MongoDB 5.0+），有 Redis 時快取
+    """
+    key = _rank_pct_key(exam_id)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+    
+    try:
+        rows = col_grading_results.aggregate([
+            {"$match": {"exam_id": exam_id}},
+            {"$setWindowFields": {
+                "sortBy": {"final_score": 1},
+                "output": {"rank": {"$rank": {}}, "n": {"$count": {}}}
+            }},
+            {"$project": {
+                "_id": 0,
+                "student_id": 1,
+                # 同分同名次，rank - 1 即為分數較低的人數
+                "rank_pct": {"$multiply": [{"$divide": [{"$subtract": ["$rank", 1]}, "$n"]}, 100]}
+            }}
+        ])
+        percentiles = {r["student_id"]: round(r["rank_pct"], 1) for r in rows}
+    except mongo_errors.OperationFailure as e:
+        logger.warning("計算排名百分比失敗（MongoDB 版本可能不支援 $setWindowFields）：%s", e)
+        return {}
+    
+    _cache_set(key, percentiles)
+    return percentiles
+
+def _rank_percentile(exam_id, student_id, student_score, total_students):
+    """該生的排名百分比；整班結果沒有該生時，以 (exam_id, final_score) 索引計數低於該生的人數"""
+    pct = get_rank_percentiles(exam_id).get(student_id)
+    if pct is not None:
+        return pct
+    below = col_grading_results.count_documents({"exam_id": exam_id, "final_score": {"$lt": student_score}})
+    return round(below / total_students * 100, 1)
+
+def generate_learning_suggestions(exam_id, student_id, result_id=None, result=None, blackboard_messages=None):
+    """使用Gemini生成詳細的個人學習建議
+    呼叫端已查過批改結果 / 黑板訊息時可直接傳入（如 get_grading_results_batch 的結果），不再重複查詢
+    """
     try:
         logger.info(f"generate_learning_suggestions 開始: exam_id={exam_id}, student_id={student_id}, result_id={result_id}")
         
         # 獲取學生結果
-        if result_id:
-            result = col_grading_results.find_one({"result_id": result_id})
-            logger.info(f"使用result_id查詢結果: {result}")
-        else:
-            result = get_grading_result(exam_id, student_id)
-            logger.info(f"使用exam_id和student_id查詢結果: {result}")
+        if result is None:
+            if result_id:
+                result = col_grading_results.find_one({"result_id": result_id})
+                logger.info(f"使用result_id查詢結果: {result}")
+            else:
+                result = get_grading_result(exam_id, student_id)
+                logger.info(f"使用exam_id和student_id查詢結果: {result}")
         
         if not result:
             return None
@@ -382,41 +774,40 @@ def generate_learning_suggestions(exam_id, student_id, result_id=None):
         gemini_suggestions = None
         if gemini_model and result.get("task_id"):
             try:
-                # 從黑板訊息中獲取Gemini生成的弱點分析
-                blackboard_messages = get_blackboard_messages(result["task_id"])
-                for msg in blackboard_messages:
-                    if msg.get("prompt_type") == "weakness_review" and msg.get("payload", {}).get("ok") is not False:
-                        # 嘗試從payload中獲取詳細數據
-                        payload = msg.get("payload", {})
-                        if payload.get("topics") or payload.get("risk_score") is not None:
-                            # 構建Gemini建議數據
-                            gemini_suggestions = {
-                                "coach_comment": f"基於AI分析，您的表現需要關注以下重點：{', '.join(payload.get('topics', ['程式碼品質']))}。",
-                                "risk_score": payload.get("risk_score", 50),
-                                "weakness_clusters": [
-                                    {
-                                        "topic": topic,
-                                        "frequency": 1,
-                                        "evidence_qids": ["1"],
-                                        "evidence_snippets": [f"在{topic}方面需要加強"]
-                                    } for topic in payload.get("topics", ["程式碼品質"])
-                                ],
-                                "prioritized_actions": [
-                                    {
-                                        "action": f"加強{topic}的學習",
-                                        "example_fix": f"建議多練習{topic}相關的題目"
-                                    } for topic in payload.get("topics", ["程式碼品質"])
-                                ],
-                                "practice_suggestions": [
-                                    f"針對{topic}進行專門練習" for topic in payload.get("topics", ["程式碼品質"])
-                                ]
-                            }
-                            logger.info("使用黑板訊息中的Gemini弱點分析數據")
-                            break
+                # 從黑板訊息中獲取Gemini生成的弱點分析（app.py 以 action="weakness_review" 寫入）
+                msg = get_weakness_review_message(result["task_id"], blackboard_messages)
+                # 嘗試從payload中獲取詳細數據
+                payload = (msg or {}).get("payload") or {}
+                if payload.get("topics") or payload.get("risk_score") is not None:
+                    # 構建Gemini建議數據
+                    gemini_suggestions = {
+                        "coach_comment": f"基於AI分析，您的表現需要關注以下重點：{', '.join(payload.get('topics', ['程式碼品質']))}。",
+                        "risk_score": payload.get("risk_score", 50),
+                        "weakness_clusters": [
+                            {
+                                "topic": topic,
+                                "frequency": 1,
+                                "evidence_qids": ["1"],
+                                "evidence_snippets": [f"在{topic}方面需要加強"]
+                            } for topic in payload.get("topics", ["程式碼品質"])
+                        ],
+                        "prioritized_actions": [
+                            {
+                                "action": f"加強{topic}的學習",
+                                "example_fix": f"建議多練習{topic}相關的題目"
+                            } for topic in payload.get("topics", ["程式碼品質"])
+                        ],
+                        "practice_suggestions": [
+                            f"針對{topic}進行專門練習" for topic in payload.get("topics", ["程式碼品質"])
+                        ]
+                    }
+                    logger.info("使用黑板訊息中的Gemini弱點分析數據")
             except Exception as e:
                 logger.warning(f"從黑板訊息獲取弱點分析數據失敗：{e}")
         
         # 如果沒有從黑板訊息獲取到，嘗試使用result中的weakness_analysis
+        if not gemini_suggestions:
+            _attach_weakness_analysis(result)
         if not gemini_suggestions and result.get("weakness_analysis"):
             try:
                 weakness_data = result["weakness_analysis"]
@@ -503,7 +894,7 @@ def generate_learning_suggestions(exam_id, student_id, result_id=None):
                     "student_score": student_score,
                     "max_score": max_possible_score,
                     "avg_score": avg_score,
-                    "rank_percentile": round((len([s for s in class_stats["scores"] if s < student_score]) / class_stats["total_students"]) * 100, 1)
+                    "rank_percentile": _rank_percentile(exam_id, result.get("student_id"), student_score, class_stats["total_students"])
                 }
             }
             logger.info(f"最終返回的學習建議: {final_suggestions}")
@@ -522,7 +913,7 @@ def generate_learning_suggestions(exam_id, student_id, result_id=None):
                     "student_score": student_score,
                     "max_score": max_possible_score,
                     "avg_score": avg_score,
-                    "rank_percentile": round((len([s for s in class_stats["scores"] if s < student_score]) / class_stats["total_students"]) * 100, 1)
+                    "rank_percentile": _rank_percentile(exam_id, result.get("student_id"), student_score, class_stats["total_students"])
                 }
             }
     except Exception as e:
@@ -577,6 +968,10 @@ def generate_coach_comment(student_score, max_score, avg_score, risk_score):
     except:
         return "請繼續努力學習，相信您一定能取得進步！"
 
+# 弱點關鍵字（於小寫化後的評語中比對），各編成單一正規式一次掃描
+_EXCEPTION_KEYWORDS_RE = re.compile("|".join(map(re.escape, ["exception", "try-catch", "null", "錯誤", "例外"])))
+_LOGIC_KEYWORDS_RE = re.compile("|".join(map(re.escape, ["邏輯", "迴圈", "條件", "邊界", "loop", "condition"])))
+
 def analyze_weakness_clusters(result, exam):
     """分析弱點聚類 - 根據學生實際表現生成個性化分析"""
     try:
@@ -587,14 +982,6 @@ def analyze_weakness_clusters(result, exam):
         max_score = exam.get("max_score", 100)
         score_percentage = (student_score / max_score) * 100 if max_score > 0 else 0
         
-        # 從批改結果中提取弱點信息
-        gpt_feedback = result.get("gpt_feedback", "")
-        claude_feedback = result.get("claude_feedback", "")
-        final_feedback = result.get("final_feedback", "")
-        
-        # 分析常見的程式設計弱點
-        all_feedback = f"{gpt_feedback} {claude_feedback} {final_feedback}".lower()
-        
         # 根據分數決定分析策略
         if score_percentage >= 90:
             # 高分學生：專注於進階改進
@@ -622,8 +1009,10 @@ def analyze_weakness_clusters(result, exam):
                 "why_it_matters": "細節決定成敗，高品質的程式碼更容易維護"
             })
         elif score_percentage >= 70:
-            # 中等學生：專注於基礎鞏固
-            if any(keyword in all_feedback for keyword in ["exception", "try-catch", "null", "錯誤", "例外"]):
+            # 中等學生：專注於基礎鞏固（只有這個分數段需要比對評語中的弱點關鍵字）
+            all_feedback = f"{result.get('gpt_feedback', '')} {result.get('claude_feedback', '')} {result.get('final_feedback', '')}".lower()
+            
+            if _EXCEPTION_KEYWORDS_RE.search(all_feedback):
                 weakness_clusters.append({
                     "topic": "例外處理與程式穩定性",
                     "frequency": 1,
@@ -632,7 +1021,7 @@ def analyze_weakness_clusters(result, exam):
                     "why_it_matters": "例外處理是程式穩定性的關鍵，能防止程式崩潰"
                 })
             
-            if any(keyword in all_feedback for keyword in ["邏輯", "迴圈", "條件", "邊界", "loop", "condition"]):
+            if _LOGIC_KEYWORDS_RE.search(all_feedback):
                 weakness_clusters.append({
                     "topic": "邏輯準確性與核心語法理解",
                     "frequency": 1,
@@ -695,126 +1084,338 @@ def analyze_weakness_clusters(result, exam):
             }
         ]
 
+# 弱點主題 → 固定的修正行動 / 練習建議
+# 主題字串可能帶有附加說明（如「例外處理與程式穩定性」），依下列順序比對，取第一個包含的關鍵字
+_TOPIC_KEYWORDS = (
+    "進階程式設計技巧",
+    "程式碼架構設計",
+    "程式碼品質優化",
+    "例外處理",
+    "邏輯準確性",
+    "基礎語法掌握",
+    "邏輯思維訓練",
+    "基本概念理解",
+    "學習方法改進",
+)
+
+@lru_cache(maxsize=256)
+def _topic_key(topic):
+    return next((k for k in _TOPIC_KEYWORDS if k in topic), None)
+
+_TOPIC_ACTIONS = {
+    "進階程式設計技巧": (
+        {
+            "action": "學習進階演算法：掌握排序、搜尋等經典演算法",
+            "mapping_topics": ["演算法", "進階技巧"],
+            "example_fix": "練習實作快速排序、二分搜尋等演算法，提升程式效率"
+        },
+        {
+            "action": "應用設計模式：學習並應用常見的設計模式",
+            "mapping_topics": ["設計模式", "架構設計"],
+            "example_fix": "學習單例模式、工廠模式等，提升程式碼的可維護性"
+        },
+    ),
+    "程式碼架構設計": (
+        {
+            "action": "模組化設計：將程式分解為獨立的功能模組",
+            "mapping_topics": ["模組化", "架構設計"],
+            "example_fix": "將不同功能分離到不同的類別和方法中，提高程式碼的組織性"
+        },
+    ),
+    "程式碼品質優化": (
+        {
+            "action": "完善錯誤處理：為所有可能出錯的操作添加適當的例外處理",
+            "mapping_topics": ["錯誤處理", "程式碼品質"],
+            "example_fix": "使用try-catch包圍檔案操作、網路請求等可能失敗的操作"
+        },
+        {
+            "action": "改善程式碼註解：為複雜邏輯添加清晰的註解",
+            "mapping_topics": ["程式碼品質", "可讀性"],
+            "example_fix": "為每個方法添加功能說明，為複雜邏輯添加行內註解"
+        },
+    ),
+    "例外處理": (
+        {
+            "action": "空值檢查：在存取可能為null的物件成員前，總是加上if檢查",
+            "mapping_topics": ["例外處理", "空值檢查"],
+            "example_fix": "if (nameListBox.SelectedItem != null) { string selected = nameListBox.SelectedItem.ToString(); }"
+        },
+        {
+            "action": "使用try-catch：包圍可能出錯的程式碼區塊",
+            "mapping_topics": ["例外處理", "錯誤處理"],
+            "example_fix": "try { // 可能出錯的程式碼 } catch (Exception ex) { // 錯誤處理 }"
+        },
+    ),
+    "邏輯準確性": (
+        {
+            "action": "迴圈邊界條件：仔細檢查for迴圈的起始值和結束條件",
+            "mapping_topics": ["邏輯準確性", "邊界條件"],
+            "example_fix": "for (int count = 0; count < 50; count++) 或 for (int count = 1; count <= 50; count++)"
+        },
+        {
+            "action": "條件判斷邏輯：確保if-else條件涵蓋所有可能情況",
+            "mapping_topics": ["邏輯準確性", "條件判斷"],
+            "example_fix": "使用if-else if-else結構，確保所有情況都被處理"
+        },
+    ),
+    "基礎語法掌握": (
+        {
+            "action": "語法練習：多練習基本的語法結構",
+            "mapping_topics": ["基礎語法", "練習"],
+            "example_fix": "練習變數宣告、迴圈、條件判斷等基本語法"
+        },
+        {
+            "action": "程式碼除錯：學會使用除錯工具找出語法錯誤",
+            "mapping_topics": ["除錯", "語法錯誤"],
+            "example_fix": "使用IDE的除錯功能，逐步執行程式碼找出問題"
+        },
+    ),
+    "邏輯思維訓練": (
+        {
+            "action": "問題分解：將複雜問題分解為簡單步驟",
+            "mapping_topics": ["邏輯思維", "問題分解"],
+            "example_fix": "用紙筆寫下解決問題的步驟，再轉換為程式碼"
+        },
+        {
+            "action": "演算法思維：學習基本的演算法概念",
+            "mapping_topics": ["邏輯思維", "演算法"],
+            "example_fix": "練習簡單的排序、搜尋演算法，理解其邏輯"
+        },
+    ),
+    "基本概念理解": (
+        {
+            "action": "重新學習基礎：從最基本的程式設計概念開始",
+            "mapping_topics": ["基本概念", "重新學習"],
+            "example_fix": "重新閱讀教材，理解變數、函數、類別等基本概念"
+        },
+        {
+            "action": "尋求幫助：主動向老師或同學請教",
+            "mapping_topics": ["學習方法", "尋求幫助"],
+            "example_fix": "遇到不懂的概念時，及時向老師或同學請教"
+        },
+    ),
+    "學習方法改進": (
+        {
+            "action": "制定學習計劃：為自己制定詳細的學習計劃",
+            "mapping_topics": ["學習方法", "計劃制定"],
+            "example_fix": "每天安排固定時間學習程式設計，循序漸進"
+        },
+        {
+            "action": "多練習：通過大量練習來鞏固所學知識",
+            "mapping_topics": ["學習方法", "練習"],
+            "example_fix": "每天至少完成一個簡單的程式設計練習"
+        },
+    )
+}
+
+_DEFAULT_ACTION = {
+    "action": "加強程式碼結構設計",
+    "mapping_topics": ["程式碼品質", "結構設計"],
+    "example_fix": "建議先規劃程式架構，再開始編寫代碼。使用清晰的變數命名和適當的函數分割。"
+}
+
+_TOPIC_SUGGESTIONS = {
+    "進階程式設計技巧": (
+        {
+            "title": "進階演算法練習",
+            "description": "挑戰更複雜的演算法問題，提升程式設計技巧",
+            "key_focus": [
+                "演算法效率：學習時間複雜度和空間複雜度分析",
+                "資料結構應用：熟練使用陣列、串列、樹等資料結構",
+                "動態規劃：學習動態規劃的基本概念和應用"
+            ],
+            "examples": [
+                "實作快速排序、合併排序等排序演算法",
+                "解決LeetCode中等難度題目",
+                "學習圖論演算法（BFS、DFS）"
+            ],
+            "pre_submission_check": "分析演算法複雜度，確保程式碼效率"
+        },
+        {
+            "title": "設計模式實作",
+            "description": "學習並實作常見的設計模式",
+            "key_focus": [
+                "單例模式：確保類別只有一個實例",
+                "工廠模式：創建物件的統一介面",
+                "觀察者模式：實現物件間的鬆耦合"
+            ],
+            "examples": [
+                "實作資料庫連接的單例模式",
+                "創建不同類型檔案的工廠類別",
+                "實現事件驅動的觀察者模式"
+            ],
+            "pre_submission_check": "確保設計模式的正確實作和應用場景"
+        },
+    ),
+    "程式碼架構設計": (
+        {
+            "title": "模組化程式設計",
+            "description": "學習如何設計良好的程式架構",
+            "key_focus": [
+                "模組分離：將不同功能分離到不同模組",
+                "介面設計：定義清晰的類別和方法介面",
+                "依賴管理：管理模組間的依賴關係"
+            ],
+            "examples": [
+                "重構現有程式碼，分離業務邏輯和資料存取",
+                "設計一個簡單的圖書館管理系統",
+                "實作MVC架構的簡單應用"
+            ],
+            "pre_submission_check": "檢查模組間的耦合度，確保架構清晰"
+        },
+    ),
+    "程式碼品質優化": (
+        {
+            "title": "程式碼品質提升",
+            "description": "專注於提升程式碼的品質和可維護性",
+            "key_focus": [
+                "錯誤處理：完善所有可能的錯誤情況處理",
+                "程式碼註解：為複雜邏輯添加清晰的註解",
+                "程式碼重構：改善現有程式碼的結構"
+            ],
+            "examples": [
+                "為現有程式碼添加完整的例外處理",
+                "重構長方法，分解為多個小方法",
+                "改善變數命名和程式碼格式"
+            ],
+            "pre_submission_check": "檢查程式碼的可讀性和維護性"
+        },
+    ),
+    "例外處理": (
+        {
+            "title": "例外處理練習",
+            "description": "學習如何正確處理程式中的例外情況",
+            "key_focus": [
+                "try-catch使用：正確使用例外處理語法",
+                "空值檢查：避免NullReferenceException",
+                "資源管理：使用using語句管理資源"
+            ],
+            "examples": [
+                "實作檔案讀寫的例外處理",
+                "處理使用者輸入的驗證和例外",
+                "管理資料庫連接的例外處理"
+            ],
+            "pre_submission_check": "測試各種例外情況，確保程式不會崩潰"
+        },
+    ),
+    "邏輯準確性": (
+        {
+            "title": "邏輯思維訓練",
+            "description": "加強邏輯思維和問題解決能力",
+            "key_focus": [
+                "迴圈邏輯：正確設計迴圈的起始和結束條件",
+                "條件判斷：確保所有情況都被正確處理",
+                "邊界條件：注意特殊情況和邊界值"
+            ],
+            "examples": [
+                "實作陣列排序演算法",
+                "解決數學計算問題",
+                "處理字串操作和搜尋"
+            ],
+            "pre_submission_check": "手動追蹤程式執行流程，檢查邏輯正確性"
+        },
+    ),
+    "基礎語法掌握": (
+        {
+            "title": "基礎語法練習",
+            "description": "鞏固程式設計的基本語法知識",
+            "key_focus": [
+                "變數宣告：正確宣告和使用變數",
+                "基本語法：掌握if、for、while等基本語法",
+                "方法定義：學會定義和調用方法"
+            ],
+            "examples": [
+                "實作簡單的計算器程式",
+                "練習陣列的基本操作",
+                "實作簡單的迴圈和條件判斷"
+            ],
+            "pre_submission_check": "檢查語法錯誤，確保程式能正常編譯"
+        },
+    ),
+    "邏輯思維訓練": (
+        {
+            "title": "問題解決思維",
+            "description": "培養分析和解決問題的能力",
+            "key_focus": [
+                "問題分解：將複雜問題分解為簡單步驟",
+                "演算法思維：學習基本的演算法概念",
+                "程式設計思維：將解決方案轉換為程式碼"
+            ],
+            "examples": [
+                "解決簡單的數學問題",
+                "實作基本的搜尋和排序",
+                "處理簡單的資料結構操作"
+            ],
+            "pre_submission_check": "確保解決方案邏輯清晰，步驟完整"
+        },
+    ),
+    "基本概念理解": (
+        {
+            "title": "基礎概念學習",
+            "description": "重新學習程式設計的基本概念",
+            "key_focus": [
+                "程式設計概念：理解變數、函數、類別等基本概念",
+                "語法基礎：掌握基本的語法規則",
+                "簡單邏輯：理解基本的程式執行流程"
+            ],
+            "examples": [
+                "實作Hello World程式",
+                "練習變數的宣告和使用",
+                "實作簡單的輸入輸出操作"
+            ],
+            "pre_submission_check": "確保理解每個概念的基本含義"
+        },
+    ),
+    "學習方法改進": (
+        {
+            "title": "學習方法優化",
+            "description": "改善學習方法和學習效率",
+            "key_focus": [
+                "學習計劃：制定合理的學習計劃",
+                "練習方法：找到適合自己的練習方式",
+                "尋求幫助：學會主動尋求幫助和指導"
+            ],
+            "examples": [
+                "每天完成一個簡單的程式設計練習",
+                "與同學討論程式設計問題",
+                "向老師請教不懂的概念"
+            ],
+            "pre_submission_check": "確保學習計劃的可行性和有效性"
+        },
+    )
+}
+
+_DEFAULT_SUGGESTION = {
+    "title": "程式碼品質提升練習",
+    "description": "專注於程式碼的可讀性和結構化",
+    "key_focus": ["變數命名規範", "函數設計原則", "程式碼註解"],
+    "examples": ["練習重構現有程式碼", "學習設計模式"],
+    "pre_submission_check": "檢查程式碼是否清晰易懂"
+}
+
+def _freeze_entry(entry):
+    """唯讀化單筆行動 / 建議（內層 list 轉 tuple），供各批改執行緒直接共用同一物件"""
+    return MappingProxyType({k: tuple(v) if isinstance(v, list) else v for k, v in entry.items()})
+
+_TOPIC_ACTIONS = MappingProxyType({k: tuple(map(_freeze_entry, v)) for k, v in _TOPIC_ACTIONS.items()})
+_TOPIC_SUGGESTIONS = MappingProxyType({k: tuple(map(_freeze_entry, v)) for k, v in _TOPIC_SUGGESTIONS.items()})
+_DEFAULT_ACTION = _freeze_entry(_DEFAULT_ACTION)
+_DEFAULT_SUGGESTION = _freeze_entry(_DEFAULT_SUGGESTION)
+
+
 def generate_prioritized_actions(weakness_clusters, subject):
     """生成優先修正行動 - 根據弱點分析生成個性化建議"""
     try:
         actions = []
         
         for cluster in weakness_clusters:
-            topic = cluster["topic"]
-            
-            if "進階程式設計技巧" in topic:
-                actions.append({
-                    "action": "學習進階演算法：掌握排序、搜尋等經典演算法",
-                    "mapping_topics": ["演算法", "進階技巧"],
-                    "example_fix": "練習實作快速排序、二分搜尋等演算法，提升程式效率"
-                })
-                actions.append({
-                    "action": "應用設計模式：學習並應用常見的設計模式",
-                    "mapping_topics": ["設計模式", "架構設計"],
-                    "example_fix": "學習單例模式、工廠模式等，提升程式碼的可維護性"
-                })
-            
-            elif "程式碼架構設計" in topic:
-                actions.append({
-                    "action": "模組化設計：將程式分解為獨立的功能模組",
-                    "mapping_topics": ["模組化", "架構設計"],
-                    "example_fix": "將不同功能分離到不同的類別和方法中，提高程式碼的組織性"
-                })
-            
-            elif "程式碼品質優化" in topic:
-                actions.append({
-                    "action": "完善錯誤處理：為所有可能出錯的操作添加適當的例外處理",
-                    "mapping_topics": ["錯誤處理", "程式碼品質"],
-                    "example_fix": "使用try-catch包圍檔案操作、網路請求等可能失敗的操作"
-                })
-                actions.append({
-                    "action": "改善程式碼註解：為複雜邏輯添加清晰的註解",
-                    "mapping_topics": ["程式碼品質", "可讀性"],
-                    "example_fix": "為每個方法添加功能說明，為複雜邏輯添加行內註解"
-                })
-            
-            elif "例外處理" in topic:
-                actions.append({
-                    "action": "空值檢查：在存取可能為null的物件成員前，總是加上if檢查",
-                    "mapping_topics": ["例外處理", "空值檢查"],
-                    "example_fix": "if (nameListBox.SelectedItem != null) { string selected = nameListBox.SelectedItem.ToString(); }"
-                })
-                actions.append({
-                    "action": "使用try-catch：包圍可能出錯的程式碼區塊",
-                    "mapping_topics": ["例外處理", "錯誤處理"],
-                    "example_fix": "try { // 可能出錯的程式碼 } catch (Exception ex) { // 錯誤處理 }"
-                })
-            
-            elif "邏輯準確性" in topic:
-                actions.append({
-                    "action": "迴圈邊界條件：仔細檢查for迴圈的起始值和結束條件",
-                    "mapping_topics": ["邏輯準確性", "邊界條件"],
-                    "example_fix": "for (int count = 0; count < 50; count++) 或 for (int count = 1; count <= 50; count++)"
-                })
-                actions.append({
-                    "action": "條件判斷邏輯：確保if-else條件涵蓋所有可能情況",
-                    "mapping_topics": ["邏輯準確性", "條件判斷"],
-                    "example_fix": "使用if-else if-else結構，確保所有情況都被處理"
-                })
-            
-            elif "基礎語法掌握" in topic:
-                actions.append({
-                    "action": "語法練習：多練習基本的語法結構",
-                    "mapping_topics": ["基礎語法", "練習"],
-                    "example_fix": "練習變數宣告、迴圈、條件判斷等基本語法"
-                })
-                actions.append({
-                    "action": "程式碼除錯：學會使用除錯工具找出語法錯誤",
-                    "mapping_topics": ["除錯", "語法錯誤"],
-                    "example_fix": "使用IDE的除錯功能，逐步執行程式碼找出問題"
-                })
-            
-            elif "邏輯思維訓練" in topic:
-                actions.append({
-                    "action": "問題分解：將複雜問題分解為簡單步驟",
-                    "mapping_topics": ["邏輯思維", "問題分解"],
-                    "example_fix": "用紙筆寫下解決問題的步驟，再轉換為程式碼"
-                })
-                actions.append({
-                    "action": "演算法思維：學習基本的演算法概念",
-                    "mapping_topics": ["邏輯思維", "演算法"],
-                    "example_fix": "練習簡單的排序、搜尋演算法，理解其邏輯"
-                })
-            
-            elif "基本概念理解" in topic:
-                actions.append({
-                    "action": "重新學習基礎：從最基本的程式設計概念開始",
-                    "mapping_topics": ["基本概念", "重新學習"],
-                    "example_fix": "重新閱讀教材，理解變數、函數、類別等基本概念"
-                })
-                actions.append({
-                    "action": "尋求幫助：主動向老師或同學請教",
-                    "mapping_topics": ["學習方法", "尋求幫助"],
-                    "example_fix": "遇到不懂的概念時，及時向老師或同學請教"
-                })
-            
-            elif "學習方法改進" in topic:
-                actions.append({
-                    "action": "制定學習計劃：為自己制定詳細的學習計劃",
-                    "mapping_topics": ["學習方法", "計劃制定"],
-                    "example_fix": "每天安排固定時間學習程式設計，循序漸進"
-                })
-                actions.append({
-                    "action": "多練習：通過大量練習來鞏固所學知識",
-                    "mapping_topics": ["學習方法", "練習"],
-                    "example_fix": "每天至少完成一個簡單的程式設計練習"
-                })
+            entries = _TOPIC_ACTIONS.get(_topic_key(cluster["topic"]))
+            if entries:
+                actions.extend(entries)
         
         # 如果沒有生成特定行動，提供通用的建議
         if not actions:
-            actions = [
-                {
-                    "action": "加強程式碼結構設計",
-                    "mapping_topics": ["程式碼品質", "結構設計"],
-                    "example_fix": "建議先規劃程式架構，再開始編寫代碼。使用清晰的變數命名和適當的函數分割。"
-                }
-            ]
+            actions = [_DEFAULT_ACTION]
         
         return actions
     except Exception as e:
@@ -833,200 +1434,18 @@ def generate_practice_suggestions(weakness_clusters, subject):
         suggestions = []
         
         for cluster in weakness_clusters:
-            topic = cluster["topic"]
-            
-            if "進階程式設計技巧" in topic:
-                suggestions.append({
-                    "title": "進階演算法練習",
-                    "description": "挑戰更複雜的演算法問題，提升程式設計技巧",
-                    "key_focus": [
-                        "演算法效率：學習時間複雜度和空間複雜度分析",
-                        "資料結構應用：熟練使用陣列、串列、樹等資料結構",
-                        "動態規劃：學習動態規劃的基本概念和應用"
-                    ],
-                    "examples": [
-                        "實作快速排序、合併排序等排序演算法",
-                        "解決LeetCode中等難度題目",
-                        "學習圖論演算法（BFS、DFS）"
-                    ],
-                    "pre_submission_check": "分析演算法複雜度，確保程式碼效率"
-                })
-                suggestions.append({
-                    "title": "設計模式實作",
-                    "description": "學習並實作常見的設計模式",
-                    "key_focus": [
-                        "單例模式：確保類別只有一個實例",
-                        "工廠模式：創建物件的統一介面",
-                        "觀察者模式：實現物件間的鬆耦合"
-                    ],
-                    "examples": [
-                        "實作資料庫連接的單例模式",
-                        "創建不同類型檔案的工廠類別",
-                        "實現事件驅動的觀察者模式"
-                    ],
-                    "pre_submission_check": "確保設計模式的正確實作和應用場景"
-                })
-            
-            elif "程式碼架構設計" in topic:
-                suggestions.append({
-                    "title": "模組化程式設計",
-                    "description": "學習如何設計良好的程式架構",
-                    "key_focus": [
-                        "模組分離：將不同功能分離到不同模組",
-                        "介面設計：定義清晰的類別和方法介面",
-                        "依賴管理：管理模組間的依賴關係"
-                    ],
-                    "examples": [
-                        "重構現有程式碼，分離業務邏輯和資料存取",
-                        "設計一個簡單的圖書館管理系統",
-                        "實作MVC架構的簡單應用"
-                    ],
-                    "pre_submission_check": "檢查模組間的耦合度，確保架構清晰"
-                })
-            
-            elif "程式碼品質優化" in topic:
-                suggestions.append({
-                    "title": "程式碼品質提升",
-                    "description": "專注於提升程式碼的品質和可維護性",
-                    "key_focus": [
-                        "錯誤處理：完善所有可能的錯誤情況處理",
-                        "程式碼註解：為複雜邏輯添加清晰的註解",
-                        "程式碼重構：改善現有程式碼的結構"
-                    ],
-                    "examples": [
-                        "為現有程式碼添加完整的例外處理",
-                        "重構長方法，分解為多個小方法",
-                        "改善變數命名和程式碼格式"
-                    ],
-                    "pre_submission_check": "檢查程式碼的可讀性和維護性"
-                })
-            
-            elif "例外處理" in topic:
-                suggestions.append({
-                    "title": "例外處理練習",
-                    "description": "學習如何正確處理程式中的例外情況",
-                    "key_focus": [
-                        "try-catch使用：正確使用例外處理語法",
-                        "空值檢查：避免NullReferenceException",
-                        "資源管理：使用using語句管理資源"
-                    ],
-                    "examples": [
-                        "實作檔案讀寫的例外處理",
-                        "處理使用者輸入的驗證和例外",
-                        "管理資料庫連接的例外處理"
-                    ],
-                    "pre_submission_check": "測試各種例外情況，確保程式不會崩潰"
-                })
-            
-            elif "邏輯準確性" in topic:
-                suggestions.append({
-                    "title": "邏輯思維訓練",
-                    "description": "加強邏輯思維和問題解決能力",
-                    "key_focus": [
-                        "迴圈邏輯：正確設計迴圈的起始和結束條件",
-                        "條件判斷：確保所有情況都被正確處理",
-                        "邊界條件：注意特殊情況和邊界值"
-                    ],
-                    "examples": [
-                        "實作陣列排序演算法",
-                        "解決數學計算問題",
-                        "處理字串操作和搜尋"
-                    ],
-                    "pre_submission_check": "手動追蹤程式執行流程，檢查邏輯正確性"
-                })
-            
-            elif "基礎語法掌握" in topic:
-                suggestions.append({
-                    "title": "基礎語法練習",
-                    "description": "鞏固程式設計的基本語法知識",
-                    "key_focus": [
-                        "變數宣告：正確宣告和使用變數",
-                        "基本語法：掌握if、for、while等基本語法",
-                        "方法定義：學會定義和調用方法"
-                    ],
-                    "examples": [
-                        "實作簡單的計算器程式",
-                        "練習陣列的基本操作",
-                        "實作簡單的迴圈和條件判斷"
-                    ],
-                    "pre_submission_check": "檢查語法錯誤，確保程式能正常編譯"
-                })
-            
-            elif "邏輯思維訓練" in topic:
-                suggestions.append({
-                    "title": "問題解決思維",
-                    "description": "培養分析和解決問題的能力",
-                    "key_focus": [
-                        "問題分解：將複雜問題分解為簡單步驟",
-                        "演算法思維：學習基本的演算法概念",
-                        "程式設計思維：將解決方案轉換為程式碼"
-                    ],
-                    "examples": [
-                        "解決簡單的數學問題",
-                        "實作基本的搜尋和排序",
-                        "處理簡單的資料結構操作"
-                    ],
-                    "pre_submission_check": "確保解決方案邏輯清晰，步驟完整"
-                })
-            
-            elif "基本概念理解" in topic:
-                suggestions.append({
-                    "title": "基礎概念學習",
-                    "description": "重新學習程式設計的基本概念",
-                    "key_focus": [
-                        "程式設計概念：理解變數、函數、類別等基本概念",
-                        "語法基礎：掌握基本的語法規則",
-                        "簡單邏輯：理解基本的程式執行流程"
-                    ],
-                    "examples": [
-                        "實作Hello World程式",
-                        "練習變數的宣告和使用",
-                        "實作簡單的輸入輸出操作"
-                    ],
-                    "pre_submission_check": "確保理解每個概念的基本含義"
-                })
-            
-            elif "學習方法改進" in topic:
-                suggestions.append({
-                    "title": "學習方法優化",
-                    "description": "改善學習方法和學習效率",
-                    "key_focus": [
-                        "學習計劃：制定合理的學習計劃",
-                        "練習方法：找到適合自己的練習方式",
-                        "尋求幫助：學會主動尋求幫助和指導"
-                    ],
-                    "examples": [
-                        "每天完成一個簡單的程式設計練習",
-                        "與同學討論程式設計問題",
-                        "向老師請教不懂的概念"
-                    ],
-                    "pre_submission_check": "確保學習計劃的可行性和有效性"
-                })
+            entries = _TOPIC_SUGGESTIONS.get(_topic_key(cluster["topic"]))
+            if entries:
+                suggestions.extend(entries)
         
         # 如果沒有生成特定建議，提供通用的練習建議
         if not suggestions:
-            suggestions = [
-                {
-                    "title": "程式碼品質提升練習",
-                    "description": "專注於程式碼的可讀性和結構化",
-                    "key_focus": ["變數命名規範", "函數設計原則", "程式碼註解"],
-                    "examples": ["練習重構現有程式碼", "學習設計模式"],
-                    "pre_submission_check": "檢查程式碼是否清晰易懂"
-                }
-            ]
+            suggestions = [_DEFAULT_SUGGESTION]
         
         return suggestions
     except Exception as e:
         logger.error(f"生成練習建議失敗：{e}")
-        return [
-            {
-                "title": "程式碼品質提升練習",
-                "description": "專注於程式碼的可讀性和結構化",
-                "key_focus": ["變數命名規範", "函數設計原則", "程式碼註解"],
-                "examples": ["練習重構現有程式碼", "學習設計模式"],
-                "pre_submission_check": "檢查程式碼是否清晰易懂"
-            }
-        ]
+        return [_DEFAULT_SUGGESTION]
 
 # ----------------------------------------------------------------------
 # 路由
@@ -1079,7 +1498,7 @@ def create_exam():
                 original_filename = secure_filename(question_file.filename)
                 question_filename = f"{uuid.uuid4()}_{original_filename}"
                 question_path = os.path.join(app.config["UPLOAD_FOLDER"], question_filename)
-                question_file.save(question_path)
+                question_file.save(question_path, buffer_size=UPLOAD_BUFFER_SIZE)
             else:
                 flash("不支援的檔案格式", "error")
                 return redirect(url_for("create_exam"))
@@ -1103,16 +1522,14 @@ def exam_detail(exam_id):
         return redirect(url_for("exams_list"))
     
     submissions = get_submissions_by_exam(exam_id)
-    grading_results = get_grading_results_by_exam(exam_id)
     
-    # 統計資料
+    # 統計資料（頁面只顯示完成數，由資料庫計數，不載入整份批改結果）
     total_submissions = len(submissions)
-    completed_gradings = len([r for r in grading_results if r["status"] == "completed"])
+    completed_gradings = col_grading_results.count_documents({"exam_id": exam_id, "status": "completed"})
     
     return render_template("teacher/exam_detail.html",
                          exam=exam,
                          submissions=submissions,
-                         grading_results=grading_results,
                          total_submissions=total_submissions,
                          completed_gradings=completed_gradings)
 
@@ -1127,7 +1544,7 @@ def upload_answers(exam_id):
     if request.method == "POST":
         # 處理多檔案上傳
         files = request.files.getlist("answer_files")
-        uploaded_count = 0
+        submissions = []
         
         for file in files:
             if file and file.filename and allowed_file(file.filename):
@@ -1138,20 +1555,18 @@ def upload_answers(exam_id):
                 # 儲存檔案
                 file_path = os.path.join(app.config["UPLOAD_FOLDER"], 
                                        f"{uuid.uuid4()}_{filename}")
-                file.save(file_path)
+                file.save(file_path, buffer_size=UPLOAD_BUFFER_SIZE)
                 
-                # 創建提交記錄
-                submission = Submission(exam_id, student_id, filename)
-                save_submission(submission)
-                uploaded_count += 1
+                # 創建提交記錄（全部檔案存好後一次寫入）
+                submissions.append(Submission(exam_id, student_id, filename))
+        
+        save_submissions_bulk(submissions)
+        uploaded_count = len(submissions)
         
         if uploaded_count > 0:
             flash(f"成功上傳 {uploaded_count} 個答案檔案", "success")
             # 如果有上傳檔案，將考試狀態改為active
-            col_exams.update_one(
-                {"exam_id": exam_id},
-                {"$set": {"status": "active", "total_students": uploaded_count}}
-            )
+            update_exam(exam_id, {"status": "active", "total_students": uploaded_count})
         else:
             flash("沒有成功上傳任何檔案", "error")
         
@@ -1189,20 +1604,17 @@ def start_grading(exam_id):
     
     # 如果檔案不存在，嘗試尋找匹配的檔案
     if not os.path.exists(question_path):
-        import glob
-        # 尋找包含該檔案名的檔案
-        pattern = os.path.join(app.config["UPLOAD_FOLDER"], f"*{question_filename}")
-        matching_files = glob.glob(pattern)
-        
-        if matching_files:
-            # 使用找到的第一個匹配檔案
-            question_path = matching_files[0]
+        # 上傳的檔案以「<uuid>_<原檔名>」儲存，從目錄索引找出對應的檔案
+        matched = _upload_index().get(question_filename)
+        
+        if matched:
+            question_path = os.path.join(app.config["UPLOAD_FOLDER"], matched)
             logger.info(f"找到匹配的題目檔案: {question_path}")
         else:
             return jsonify({"success": False, "message": f"找不到題目檔案：{question_filename}"})
     
     try:
-        exam_content = read_text(question_path)
+        exam_content = _read_text_cached(question_path)
     except Exception as e:
         return jsonify({"success": False, "message": f"讀取題目檔案失敗：{e}"})
     
@@ -1217,15 +1629,19 @@ def start_grading(exam_id):
         grading_tasks.append(task)
     
     # 更新考試狀態
-    col_exams.update_one(
-        {"exam_id": exam_id},
-        {"$set": {"status": "grading", "total_students": len(submissions)}}
-    )
+    update_exam(exam_id, {"status": "grading", "total_students": len(submissions)})
     
     # 啟動批改任務（異步處理）
     try:
+        if celery_app is not None:
+            # 只傳批改用到的題詞欄位（Mongo 文件含 ObjectId，無法直接序列化）
+            prompt_snapshot = {k: prompt_doc.get(k) for k in ("subject", "version", "prompt_content")}
+            async_result = grade_exam_task.delay(exam_id, exam_content, prompt_snapshot, grading_tasks)
+            return jsonify({"success": True,
+                            "message": f"已開始批改 {len(submissions)} 份答案，請稍後查看結果",
+                            "task_id": async_result.id})
+        
         # 使用線程池異步執行批改任務
-        from concurrent.futures import ThreadPoolExecutor
         executor = ThreadPoolExecutor(max_workers=1)
         future = executor.submit(process_grading_tasks, exam_id, exam_content, prompt_doc, grading_tasks)
         
@@ -1235,126 +1651,218 @@ def start_grading(exam_id):
         logger.error(f"啟動批改任務失敗：{e}")
         return jsonify({"success": False, "message": f"啟動批改任務失敗：{e}"})
 
+def _grade_task(exam_id, exam_content, prompt_doc, task, exam_questions=None, upload_index=None,
+                checker=None):
+    """批改單一提交（於批改執行緒池中執行），回傳 (結果, 是否標記為失敗)
+    結果為 None 表示未完成；資料庫寫入由 process_grading_tasks 批次進行
+    upload_index 為整批共用的上傳目錄檔名索引，未提供時自行取得
+    checker 為整批共用的安全檢查代理人，None 時略過安全檢查
+    """
+    try:
+        logger.info("處理任務：學生 %s", task["student_id"])
+        
+        # 讀取學生答案
+        answer_filename = task["answer_file"]
+        if upload_index is None:
+            upload_index = _upload_index()
+        
+        # 索引同時收錄完整檔名與去掉「<uuid>_」前綴的原檔名，完整檔名優先
+        matched = upload_index.get(answer_filename)
+        if not matched:
+            logger.error(f"找不到答案檔案：{answer_filename}")
+            return None, False
+        answer_path = os.path.join(app.config["UPLOAD_FOLDER"], matched)
+        if matched != answer_filename:
+            logger.debug("找到匹配的答案檔案: %s", answer_path)
+        
+        answer_content = _read_text_cached(answer_path)
+        logger.debug("成功讀取答案檔案，內容長度: %d", len(answer_content))
+        
+        # 安全檢查
+        try:
+            if checker is not None:
+                # 整卷批改只需判定結果，不請模型產生原因說明
+                security_result = checker.check(exam_content, answer_content, with_reason=False)
+                logger.info("安全檢查結果：%s", "攻擊行為" if security_result.get("is_attack") else "沒有攻擊行為")
+                
+                # 如果檢測到攻擊行為，跳過批改
+                if security_result.get('is_attack'):
+                    logger.warning(f"學生 {task['student_id']} 的答案被判定為攻擊行為，跳過批改")
+                    return None, False
+        except Exception as e:
+            logger.warning(f"安全檢查失敗（將繼續批改）：{e}")
+        
+        # 執行批改（使用現有的批改系統）
+        logger.info("開始批改學生 %s 的答案", task["student_id"])
+        result = grade_single_submission(exam_id, task["student_id"], 
+                                       task["submission_id"], exam_content, 
+                                       answer_content, prompt_doc,
+                                       exam_questions=exam_questions)
+        logger.info("批改完成，最終分數: %s", result.final_score)
+        return result, False
+        
+    except Exception as e:
+        logger.error(f"批改學生 {task['student_id']} 的答案時發生錯誤：{e}", exc_info=True)
+        return None, True
+
 def process_grading_tasks(exam_id, exam_content, prompt_doc, grading_tasks):
-    """處理批改任務"""
+    """處理批改任務：各份答案彼此獨立且多半在等待 LLM 回應，以執行緒池同時批改"""
     logger.info(f"開始處理 {len(grading_tasks)} 個批改任務")
     
     completed_count = 0
     failed_count = 0
     
-    for i, task in enumerate(grading_tasks):
+    # 題目對所有學生相同，只拆一次供各執行緒唯讀共用（失敗時交由各任務自行拆分並個別記錄錯誤）
+    try:
+        exam_questions = enhanced_split_by_question(exam_content)
+    except Exception as e:
+        logger.warning(f"拆分題目失敗：{e}")
+        exam_questions = None
+    
+    # 安全檢查代理人為單例且 check() 為無狀態呼叫，整批只取得一次並由各執行緒並行共用
+    checker = None
+    if get_checker is not None:
         try:
-            logger.info(f"處理任務 {i+1}/{len(grading_tasks)}: 學生 {task['student_id']}")
-            
-            # 讀取學生答案
-            answer_filename = task["answer_file"]
-            answer_path = os.path.join(app.config["UPLOAD_FOLDER"], answer_filename)
-            
-            # 如果檔案不存在，嘗試尋找匹配的檔案
-            if not os.path.exists(answer_path):
-                import glob
-                # 尋找包含該檔案名的檔案
-                pattern = os.path.join(app.config["UPLOAD_FOLDER"], f"*{answer_filename}")
-                matching_files = glob.glob(pattern)
-                
-                if matching_files:
-                    # 使用找到的第一個匹配檔案
-                    answer_path = matching_files[0]
-                    logger.info(f"找到匹配的答案檔案: {answer_path}")
-                else:
-                    logger.error(f"找不到答案檔案：{answer_filename}")
-                    failed_count += 1
-                    continue
-            
-            answer_content = read_text(answer_path)
-            logger.info(f"成功讀取答案檔案，內容長度: {len(answer_content)}")
-            
-            # 安全檢查
-            try:
-                from 安全檢查代理人 import get_checker
-                if get_checker is not None:
-                    checker = get_checker()
-                    security_result = checker.check(exam_content, answer_content)
-                    logger.info(f"安全檢查結果：{'攻擊行為' if security_result.get('is_attack') else '沒有攻擊行為'}")
-                    logger.info(f"安全檢查原因：{security_result.get('reason', '')}")
-                    
-                    # 如果檢測到攻擊行為，跳過批改
-                    if security_result.get('is_attack'):
-                        logger.warning(f"學生 {task['student_id']} 的答案被判定為攻擊行為，跳過批改")
-                        failed_count += 1
-                        continue
-            except Exception as e:
-                logger.warning(f"安全檢查失敗（將繼續批改）：{e}")
-            
-            # 執行批改（使用現有的批改系統）
-            logger.info(f"開始批改學生 {task['student_id']} 的答案")
-            result = grade_single_submission(exam_id, task["student_id"], 
-                                           task["submission_id"], exam_content, 
-                                           answer_content, prompt_doc)
-            
-            # 儲存結果
-            save_grading_result(result)
-            logger.info(f"批改完成，最終分數: {result.final_score}")
-            
-            # 更新提交狀態
-            col_submissions.update_one(
-                {"submission_id": task["submission_id"]},
-                {"$set": {"status": "completed", "grading_result_id": result.result_id}}
-            )
-            
-            completed_count += 1
-            
+            checker = get_checker()
         except Exception as e:
-            logger.error(f"批改學生 {task['student_id']} 的答案時發生錯誤：{e}", exc_info=True)
-            # 更新提交狀態為失敗
-            col_submissions.update_one(
-                {"submission_id": task["submission_id"]},
-                {"$set": {"status": "failed"}}
-            )
-            failed_count += 1
+            logger.warning(f"安全檢查代理人初始化失敗（本批將略過安全檢查）：{e}")
+    
+    # 上傳目錄只掃描一次，各任務以記憶體中的索引查找答案檔案
+    upload_index = _upload_index()
+    
+    # 批改結果與提交狀態累積後批次寫入，每 GRADING_WRITE_BATCH 份寫一次
+    pending_results = []
+    submission_ops = []
+    
+    def flush():
+        try:
+            save_grading_results_bulk(pending_results)
+            if submission_ops:
+                col_submissions.bulk_write(submission_ops, ordered=False)
+        except Exception as e:
+            logger.error(f"批次寫入批改結果失敗：{e}", exc_info=True)
+        pending_results.clear()
+        submission_ops.clear()
+    
+    workers = max(1, min(GRADING_CONCURRENCY, len(grading_tasks)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(_grade_task, exam_id, exam_content, prompt_doc, task,
+                               exam_questions, upload_index, checker): task
+                   for task in grading_tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            result, mark_failed = future.result()
+            if result is not None:
+                pending_results.append(result)
+                submission_ops.append(UpdateOne(
+                    {"submission_id": task["submission_id"]},
+                    {"$set": {"status": "completed", "grading_result_id": result.result_id}}
+                ))
+                completed_count += 1
+            else:
+                if mark_failed:
+                    submission_ops.append(UpdateOne(
+                        {"submission_id": task["submission_id"]},
+                        {"$set": {"status": "failed"}}
+                    ))
+                failed_count += 1
+            logger.info("批改進度 %d/%d", completed_count + failed_count, len(grading_tasks))
+            if len(submission_ops) >= GRADING_WRITE_BATCH:
+                flush()
+    flush()
     
     # 更新考試狀態
     if completed_count > 0:
-        col_exams.update_one(
-            {"exam_id": exam_id},
-            {"$set": {"status": "completed", "graded_students": completed_count}}
-        )
+        update_exam(exam_id, {"status": "completed", "graded_students": completed_count})
         logger.info(f"批改任務完成：成功 {completed_count} 個，失敗 {failed_count} 個")
+        # 仍在背景執行緒 / Celery worker 中：先算好全班統計，分析頁面載入時只需讀取一筆
+        analyze_class_performance(exam_id)
     else:
-        col_exams.update_one(
-            {"exam_id": exam_id},
-            {"$set": {"status": "failed"}}
-        )
+        update_exam(exam_id, {"status": "failed"})
         logger.error(f"所有批改任務都失敗了")
 
-def grade_single_submission(exam_id, student_id, submission_id, exam_content, answer_content, prompt_doc):
-    """批改單一提交（完整版，整合自動更新題詞功能）"""
+if celery_app is not None:
+    @celery_app.task(name="grade_exam")
+    def grade_exam_task(exam_id, exam_content, prompt_doc, grading_tasks):
+        """Celery 任務：批改整份考卷（與行程內執行緒版本相同流程）"""
+        process_grading_tasks(exam_id, exam_content, prompt_doc, grading_tasks)
+
+# GPT 批改交給共用執行緒池、Claude 在目前執行緒，兩者同時等待回應
+# 每份同時批改中的答案各需一個 GPT 執行緒，故與 GRADING_CONCURRENCY 同大小
+_gpt_grader_pool = ThreadPoolExecutor(max_workers=GRADING_CONCURRENCY, thread_name_prefix="gpt-grader")
+
+# 批改後處理（題詞自動優化、弱點分析）用的執行緒池：每份答案各佔兩個執行緒
+_post_grading_pool = ThreadPoolExecutor(max_workers=2 * GRADING_CONCURRENCY, thread_name_prefix="post-grading")
+
+def _call_both_graders(q_exam, q_ans, prompt, qid, peer_notes=None):
+    """同時送出 GPT 與 Claude 批改同一題，回傳 (gpt_res, claude_res)"""
+    if peer_notes is None:
+        gpt_future = _gpt_grader_pool.submit(call_gpt_grader, q_exam, q_ans, prompt)
+        claude_res = call_claude_grader(q_exam, q_ans, prompt, expected_item_ids=[qid])
+    else:
+        gpt_future = _gpt_grader_pool.submit(call_gpt_grader, q_exam, q_ans, prompt, peer_notes)
+        claude_res = call_claude_grader(q_exam, q_ans, prompt, expected_item_ids=[qid], peer_notes=peer_notes)
+    return gpt_future.result(), claude_res
+
+_QID_NUM_RE = re.compile(r"\d+")
+
+def _qid_key(qid):
+    """題號排序鍵：取第一段數字，沒有數字的排最後"""
+    m = _QID_NUM_RE.search(qid)
+    return int(m.group()) if m else 9999
+
+_PEER_NOTES_HEADER = (
+    "你與同儕對此題評論差異如下，請盡量對齊語意（可換句話說，但應傳達同樣重點）；"
+    "若仍不同，請在 comment 清楚說明依據與你堅持的理由。\n"
+)
+
+@lru_cache(maxsize=256)
+def _per_question_prompt(prompt_content, qid, expected_max_score):
+    """單題批改提詞（同一份考卷的每位學生共用，依題號與配分快取）
+    只組一次字串：避免 + 串接逐段產生中間字串
+    """
+    return (
+        f"{prompt_content}\n\n【僅批改此題】請只針對『題目 {qid}』與其對應的學生答案評分，"
+        "不得參考其他題。rubric.items 僅需輸出此題一筆，item_id 請用題號。\n"
+        f"【重要】此題配分為 {expected_max_score} 分，請確保 max_score 設為 {expected_max_score}。"
+    )
+
+def grade_single_submission(exam_id, student_id, submission_id, exam_content, answer_content, prompt_doc,
+                            exam_questions=None):
+    """批改單一提交（完整版，整合自動更新題詞功能）
+    exam_questions 為已拆好的題目（enhanced_split_by_question 的結果，唯讀共用），
+    整份考卷批改時由呼叫端拆一次傳入，未提供時才在此拆分
+    """
+    # 同一批次的工作執行緒共用呼叫端的 prompt_doc；自動套用題詞時會改寫版本號，須使用各自的副本
+    prompt_doc = dict(prompt_doc)
+    
     # 生成 task_id
     task_id = str(uuid.uuid4())
     
+    # 黑板訊息先累積在本地，於逐題批改後與流程結束時各以一次 insert_many 寫入
+    blackboard = []
+    log_bb = partial(log_prompt_blackboard, buffer=blackboard)
+    
     # 記錄批改開始
-    log_prompt_blackboard(
+    log_bb(
         task_id, prompt_doc["subject"], "grading_start",
         f"開始批改學生 {student_id} 的答案",
         payload={"student_id": student_id, "exam_id": exam_id}
     )
     
     # 記錄使用的題詞
-    log_prompt_blackboard(
+    log_bb(
         task_id, prompt_doc["subject"], "prompt_used",
         f"使用題詞版本 v{prompt_doc['version']}",
         payload={"version": prompt_doc["version"], "subject": prompt_doc["subject"]}
     )
     
     # 拆分題目和答案
-    exam_q_enhanced = enhanced_split_by_question(exam_content)
+    exam_q_enhanced = exam_questions if exam_questions is not None else enhanced_split_by_question(exam_content)
     ans_q = split_by_question(answer_content)
     
     # 獲取題號交集
-    qids = sorted(
-        set(exam_q_enhanced.keys()) & set(ans_q.keys()),
-        key=lambda x: int(re.findall(r"\d+", x)[0]) if re.findall(r"\d+", x) else 9999
-    )
+    qids = sorted(exam_q_enhanced.keys() & ans_q.keys(), key=_qid_key)
     
     if not qids:
         qids = ["1"]
@@ -1363,9 +1871,10 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
     
     # 執行完整批改流程
     gpt_total = claude_total = final_total = 0
-    gpt_items = []
-    claude_items = []
-    final_items = []
+    # 逐題結果依 qids 順序預先配置，以題目位置直接寫入
+    gpt_items = [None] * len(qids)
+    claude_items = [None] * len(qids)
+    final_items = [None] * len(qids)
     
     # 用於自動更新題詞的追蹤變數
     consensus_round_qids = set()
@@ -1373,27 +1882,24 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
     direct_consensus_qids = set()
     expected_scores = {}
     
-    for qid in qids:
+    for idx, qid in enumerate(qids):
         q_exam = exam_q_enhanced[qid]["content"]
         q_ans = ans_q[qid]
         expected_max_score = int(exam_q_enhanced[qid]["max_score"])
         expected_scores[qid] = expected_max_score
         
         # 調用GPT和Claude批改
-        per_q_prompt = (
-            prompt_doc["prompt_content"] +
-            f"\n\n【僅批改此題】請只針對『題目 {qid}』與其對應的學生答案評分，" +
-            "不得參考其他題。rubric.items 僅需輸出此題一筆，item_id 請用題號。\n" +
-            f"【重要】此題配分為 {expected_max_score} 分，請確保 max_score 設為 {expected_max_score}。"
-        )
+        per_q_prompt = _per_question_prompt(prompt_doc["prompt_content"], qid, expected_max_score)
         
         try:
-            logger.info(f"調用 GPT 批改題目 {qid}")
-            gpt_res = call_gpt_grader(q_exam, q_ans, per_q_prompt)
-            logger.info(f"GPT 批改完成，結果: {gpt_res}")
+            logger.debug("同時調用 GPT / Claude 批改題目 %s", qid)
+            gpt_res, claude_res = _call_both_graders(q_exam, q_ans, per_q_prompt, qid)
+            # 完整結果含評語與 rubric，只在 DEBUG 時才轉成字串
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("GPT 批改完成，結果: %r", gpt_res)
             
             # 記錄 GPT 批改到黑板
-            log_prompt_blackboard(
+            log_bb(
                 task_id, prompt_doc["subject"], "gpt_grade",
                 f"GPT 批改題目 {qid}，得分：{gpt_res.get('score', 0)}",
                 payload={"qid": qid, "score": gpt_res.get('score', 0), "feedback": gpt_res.get('feedback', '')}
@@ -1404,12 +1910,11 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
                 logger.error(f"GPT 返回結果格式錯誤: {type(gpt_res)}")
                 gpt_res = {"score": 0, "feedback": "GPT 批改失敗", "rubric": {"items": [], "total_score": 0}}
             
-            logger.info(f"調用 Claude 批改題目 {qid}")
-            claude_res = call_claude_grader(q_exam, q_ans, per_q_prompt, expected_item_ids=[qid])
-            logger.info(f"Claude 批改完成，結果: {claude_res}")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Claude 批改完成，結果: %r", claude_res)
             
             # 記錄 Claude 批改到黑板
-            log_prompt_blackboard(
+            log_bb(
                 task_id, prompt_doc["subject"], "claude_grade",
                 f"Claude 批改題目 {qid}，得分：{claude_res.get('score', 0)}",
                 payload={"qid": qid, "score": claude_res.get('score', 0), "feedback": claude_res.get('feedback', '')}
@@ -1424,28 +1929,46 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
             gpt_score = int(gpt_res.get("score", 0))
             claude_score = int(claude_res.get("score", 0))
             
-            # 語意相似度檢查
-            sim = call_gemini_similarity(gpt_res, claude_res, threshold=0.90)
-            
             # 分數差距計算
             gap_abs = abs(gpt_score - claude_score)
             gap_ratio = gap_abs / expected_max_score if expected_max_score > 0 else 0
             SCORE_GAP_RATIO = 0.30  # 30% 門檻
             
-            # 記錄相似度檢查
-            log_prompt_blackboard(
-                task_id, prompt_doc["subject"], "similarity_check",
-                f"[題目 {qid}] 語意相似度：{sim.get('score'):.2f} ｜ 分數差：{gap_abs} / {expected_max_score}（{gap_ratio:.2%}） ｜ 門檻：相似度≥0.90 且 差距<30%",
-                payload={"qid": qid, **sim, "gap_abs": gap_abs, "gap_ratio": gap_ratio, "gap_ratio_threshold": SCORE_GAP_RATIO}
-            )
+            # 快速共識：分數幾乎相同，或評語完全一致且差距在門檻內，省下一次 Gemini 呼叫
+            g_feedback = gpt_res.get("feedback")
+            same_feedback = bool(g_feedback) and g_feedback == claude_res.get("feedback")
+            fastpath = gap_abs <= CONSENSUS_FASTPATH_GAP or (same_feedback and gap_ratio < SCORE_GAP_RATIO)
             
+            if not fastpath:
+                # 語意相似度檢查
+                sim = call_gemini_similarity(gpt_res, claude_res, threshold=0.90)
+                
+                # 記錄相似度檢查
+                log_bb(
+                    task_id, prompt_doc["subject"], "similarity_check",
+                    f"[題目 {qid}] 語意相似度：{sim.get('score'):.2f} ｜ 分數差：{gap_abs} / {expected_max_score}（{gap_ratio:.2%}） ｜ 門檻：相似度≥0.90 且 差距<30%",
+                    payload={"qid": qid, **sim, "gap_abs": gap_abs, "gap_ratio": gap_ratio, "gap_ratio_threshold": SCORE_GAP_RATIO}
+                )
+            
+            if fastpath:
+                # 直接共識（略過語意比對）
+                final_score = int((gpt_score + claude_score) / 2)
+                direct_consensus_qids.add(qid)
+                
+                reason_fast = "評語相同" if same_feedback else f"分數差 {gap_abs} ≤ {CONSENSUS_FASTPATH_GAP}"
+                log_bb(
+                    task_id, prompt_doc["subject"], "consensus",
+                    f"[題目 {qid}] {reason_fast} → 略過語意比對，直接共識（平均 {final_score}；g={gpt_score}, c={claude_score}）",
+                    payload={"qid": qid, "avg_score": final_score, "g": gpt_score, "c": claude_score,
+                             "gap_abs": gap_abs, "same_feedback": same_feedback, "fastpath": True}
+                )
             # 共識判斷：語意相似度 >= 90% 且分數差距 < 30%
-            if sim.get("similar") and (gap_ratio < SCORE_GAP_RATIO):
+            elif sim.get("similar") and (gap_ratio < SCORE_GAP_RATIO):
                 # 直接共識
                 final_score = int((gpt_score + claude_score) / 2)
                 direct_consensus_qids.add(qid)
                 
-                log_prompt_blackboard(
+                log_bb(
                     task_id, prompt_doc["subject"], "consensus",
                     f"[題目 {qid}] Gate 通過 → 直接共識（平均 {final_score}；g={gpt_score}, c={claude_score}）",
                     payload={"qid": qid, "avg_score": final_score, "g": gpt_score, "c": claude_score}
@@ -1455,29 +1978,23 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
                 reason_enter = "語意差異" if not sim.get("similar") else f"分數差距 {gap_ratio:.2%} ≥ 30%"
                 consensus_round_qids.add(qid)
                 
-                log_prompt_blackboard(
+                log_bb(
                     task_id, prompt_doc["subject"], "consensus_round_enter",
                     f"[題目 {qid}] 進入共識回合，原因：{reason_enter}",
                     payload={"qid": qid, "reason": reason_enter, "sim": sim, "gap_ratio": gap_ratio}
                 )
                 
+                # 生成同儕提示（依首輪評語，各共識回合相同）
+                g_cmt = gpt_res.get("feedback", "")
+                c_cmt = claude_res.get("feedback", "")
+                peer_notes = f"{_PEER_NOTES_HEADER}- GPT：{g_cmt}\n- Claude：{c_cmt}\n"
+                
                 # 共識回合邏輯（最多2輪）
                 agreed = False
                 for round_idx in range(2):
-                    # 生成同儕提示
-                    g_cmt = gpt_res.get("feedback", "")
-                    c_cmt = claude_res.get("feedback", "")
-                    peer_notes = (
-                        "你與同儕對此題評論差異如下，請盡量對齊語意（可換句話說，但應傳達同樣重點）；"
-                        "若仍不同，請在 comment 清楚說明依據與你堅持的理由。\n"
-                        f"- GPT：{g_cmt}\n"
-                        f"- Claude：{c_cmt}\n"
-                    )
-                    
                     # 重新批改
                     try:
-                        gpt_res_round = call_gpt_grader(q_exam, q_ans, per_q_prompt, peer_notes)
-                        claude_res_round = call_claude_grader(q_exam, q_ans, per_q_prompt, expected_item_ids=[qid], peer_notes=peer_notes)
+                        gpt_res_round, claude_res_round = _call_both_graders(q_exam, q_ans, per_q_prompt, qid, peer_notes)
                         
                         # 重新計算分數和相似度
                         g_score_round = int(gpt_res_round.get("score", 0))
@@ -1491,14 +2008,14 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
                             final_score = int((g_score_round + c_score_round) / 2)
                             agreed = True
                             
-                            log_prompt_blackboard(
+                            log_bb(
                                 task_id, prompt_doc["subject"], "consensus",
                                 f"[題目 {qid}] 共識回合 {round_idx+1}：語意一致且分數差低於門檻 → 平均 {final_score}（g={g_score_round}, c={c_score_round}）",
                                 payload={"qid": qid, **sim_after, "gap_abs": gap_abs_round, "gap_ratio": gap_ratio_round, "avg_score": final_score}
                             )
                             break
                         else:
-                            log_prompt_blackboard(
+                            log_bb(
                                 task_id, prompt_doc["subject"], "disagreement",
                                 f"[題目 {qid}] 共識回合 {round_idx+1}：尚未同時滿足語意一致與分數差門檻（相似度 {sim_after.get('score'):.2f}；差距 {gap_ratio_round:.2%}）",
                                 payload={"qid": qid, **sim_after, "gap_abs": gap_abs_round, "gap_ratio": gap_ratio_round}
@@ -1514,7 +2031,7 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
                         final_score = int(arbitration_res.get("final_score", (gpt_score + claude_score) / 2))
                         arbitration_qids.add(qid)
                         
-                        log_prompt_blackboard(
+                        log_bb(
                             task_id, prompt_doc["subject"], "arbitration_summary",
                             f"[題目 {qid}] 交由仲裁，最終得分：{final_score}",
                             payload={"qid": qid, "decision": arbitration_res.get("decision"), "reason": arbitration_res.get("reason"), "final_score": final_score}
@@ -1523,7 +2040,7 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
                         logger.warning(f"仲裁失敗，使用平均分：{e}")
                         final_score = int((gpt_score + claude_score) / 2)
                         
-                        log_prompt_blackboard(
+                        log_bb(
                             task_id, prompt_doc["subject"], "arbitration_failed",
                             f"[題目 {qid}] 仲裁失敗，使用平均分：{final_score}",
                             payload={"qid": qid, "final_score": final_score, "error": str(e)}
@@ -1534,26 +2051,26 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
             final_total += final_score
             
             # 儲存逐題結果
-            gpt_items.append({
+            gpt_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": gpt_score,
                 "comment": gpt_res.get("feedback", "")
-            })
+            }
             
-            claude_items.append({
+            claude_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": claude_score,
                 "comment": claude_res.get("feedback", "")
-            })
+            }
             
-            final_items.append({
+            final_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": final_score,
                 "comment": f"GPT: {gpt_score}, Claude: {claude_score}, 平均: {final_score}"
-            })
+            }
             
         except Exception as e:
             logger.error(f"批改題目 {qid} 時發生錯誤：{e}", exc_info=True)
@@ -1563,26 +2080,28 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
             final_total += 0
             
             # 儲存錯誤結果
-            gpt_items.append({
+            gpt_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": 0,
                 "comment": f"批改錯誤：{str(e)}"
-            })
+            }
             
-            claude_items.append({
+            claude_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": 0,
                 "comment": f"批改錯誤：{str(e)}"
-            })
+            }
             
-            final_items.append({
+            final_items[idx] = {
                 "item_id": qid,
                 "max_score": expected_max_score,
                 "final_score": 0,
                 "comment": f"批改錯誤：{str(e)}"
-            })
+            }
+    
+    flush_blackboard(blackboard)
     
     # 構建完整的批改結果
     gpt_res = {
@@ -1603,91 +2122,99 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
         "items": final_items
     }
     
-    # === 自動更新題詞功能 ===
-    try:
-        entered_consensus_rounds = len(consensus_round_qids) > 0
-        entered_arbitration = len(arbitration_qids) > 0
-        
-        if PROMPT_AUTOTUNE_MODE in ("suggest", "apply"):
-            if not (entered_consensus_rounds or entered_arbitration):
-                # 完全沒有分歧（沒有進入共識回合，也沒有仲裁）→ 跳過題詞修改
-                log_prompt_blackboard(
-                    task_id, prompt_doc["subject"], "quality_gate",
-                    "本次所有題目皆未進入『共識回合』或『仲裁』 → 跳過題詞自動優化。",
-                    payload={
-                        "mode": PROMPT_AUTOTUNE_MODE,
-                        "consensus_round_qids": [],
-                        "arbitration_qids": [],
-                        "direct_consensus_qids": sorted(list(direct_consensus_qids)),
-                    }
-                )
-            else:
-                ctx = {
-                    "gpt": gpt_res,
-                    "claude": claude_res,
-                    "arbitration": arbitration,
-                    "expected_scores": expected_scores,
-                    # 聚焦題目清單
-                    "consensus_round_qids": sorted(list(consensus_round_qids)),
-                    "arbitration_qids": sorted(list(arbitration_qids)),
-                    "direct_consensus_qids": sorted(list(direct_consensus_qids)),
-                }
-                auto = run_prompt_autotune(prompt_doc["subject"], prompt_doc["prompt_content"], ctx)
-                if auto is not None:
-                    proposed = (auto.get("updated_prompt") or "").strip()
-                    reason = (auto.get("reason") or "").strip()
-                    diff_summary = (auto.get("diff_summary") or "").strip()
-                    
-                    # 黑板：一定記錄一次建議（即使 proposed 為空，方便追蹤）
-                    log_prompt_blackboard(
-                        task_id, prompt_doc["subject"], "suggestion",
-                        content=f"Gemini 題詞建議：{diff_summary or '（無摘要）'}",
+    # === 批改後處理：題詞自動優化與弱點分析各為一次 Gemini 呼叫，彼此獨立，同時送出 ===
+    def _autotune_step():
+        try:
+            entered_consensus_rounds = len(consensus_round_qids) > 0
+            entered_arbitration = len(arbitration_qids) > 0
+        
+            if PROMPT_AUTOTUNE_MODE in ("suggest", "apply"):
+                if not (entered_consensus_rounds or entered_arbitration):
+                    # 完全沒有分歧（沒有進入共識回合，也沒有仲裁）→ 跳過題詞修改
+                    log_bb(
+                        task_id, prompt_doc["subject"], "quality_gate",
+                        "本次所有題目皆未進入『共識回合』或『仲裁』 → 跳過題詞自動優化。",
                         payload={
-                            "proposed": proposed,
-                            "reason": reason,
                             "mode": PROMPT_AUTOTUNE_MODE,
-                            "consensus_round_qids": sorted(list(consensus_round_qids)),
-                            "arbitration_qids": sorted(list(arbitration_qids)),
+                            "consensus_round_qids": [],
+                            "arbitration_qids": [],
+                            "direct_consensus_qids": sorted(list(direct_consensus_qids)),
                         }
                     )
+                else:
+                    ctx = {
+                        "gpt": gpt_res,
+                        "claude": claude_res,
+                        "arbitration": arbitration,
+                        "expected_scores": expected_scores,
+                        # 聚焦題目清單
+                        "consensus_round_qids": sorted(list(consensus_round_qids)),
+                        "arbitration_qids": sorted(list(arbitration_qids)),
+                        "direct_consensus_qids": sorted(list(direct_consensus_qids)),
+                    }
+                    auto = run_prompt_autotune(prompt_doc["subject"], prompt_doc["prompt_content"], ctx)
+                    if auto is not None:
+                        proposed = (auto.get("updated_prompt") or "").strip()
+                        reason = (auto.get("reason") or "").strip()
+                        diff_summary = (auto.get("diff_summary") or "").strip()
                     
-                    # 若是自動套用模式且有新題詞，直接升版
-                    if PROMPT_AUTOTUNE_MODE == "apply" and proposed:
-                        pr2 = create_or_bump_prompt(prompt_doc["subject"], proposed, updated_by="gemini_autotune")
-                        log_prompt_blackboard(
-                            task_id, prompt_doc["subject"], "updated",
-                            content=f"Gemini 已自動套用題詞，版本升至 v{pr2['version']}",
-                            payload={"source": "autotune_apply", "diff_summary": diff_summary}
+                        # 黑板：一定記錄一次建議（即使 proposed 為空，方便追蹤）
+                        log_bb(
+                            task_id, prompt_doc["subject"], "suggestion",
+                            content=f"Gemini 題詞建議：{diff_summary or '（無摘要）'}",
+                            payload={
+                                "proposed": proposed,
+                                "reason": reason,
+                                "mode": PROMPT_AUTOTUNE_MODE,
+                                "consensus_round_qids": sorted(list(consensus_round_qids)),
+                                "arbitration_qids": sorted(list(arbitration_qids)),
+                            }
                         )
-                        # 讓後續儲存/頁面顯示用到最新版
-                        prompt_doc["version"] = pr2["version"]
-    except Exception as e:
-        logger.warning(f"題詞自動優化流程失敗：{e}")
-    
-    # === 弱點分析 ===
-    weakness_analysis = None
-    try:
-        matrix = build_comment_matrix_for_weakness(gpt_res, claude_res, arbitration)
-        weakness_analysis = run_gemini_weakness_review(
-            subject=prompt_doc["subject"],
-            matrix=matrix,
-            exam_text=exam_content,
-            student_text=answer_content
-        )
-        
-        if weakness_analysis:
-            log_prompt_blackboard(
-                task_id, prompt_doc["subject"], "weakness_analysis",
-                content="弱點分析完成",
-                payload=weakness_analysis
+                    
+                        # 若是自動套用模式且有新題詞，直接升版
+                        if PROMPT_AUTOTUNE_MODE == "apply" and proposed:
+                            pr2 = create_or_bump_prompt(prompt_doc["subject"], proposed, updated_by="gemini_autotune")
+                            log_bb(
+                                task_id, prompt_doc["subject"], "updated",
+                                content=f"Gemini 已自動套用題詞，版本升至 v{pr2['version']}",
+                                payload={"source": "autotune_apply", "diff_summary": diff_summary}
+                            )
+                            # 讓後續儲存/頁面顯示用到最新版
+                            prompt_doc["version"] = pr2["version"]
+        except Exception as e:
+            logger.warning(f"題詞自動優化流程失敗：{e}")
+
+    def _weakness_step():
+        weakness_analysis = None
+        try:
+            matrix = build_comment_matrix_for_weakness(gpt_res, claude_res, arbitration)
+            weakness_analysis = run_gemini_weakness_review(
+                subject=prompt_doc["subject"],
+                matrix=matrix,
+                exam_text=exam_content,
+                student_text=answer_content
             )
-    except Exception as e:
-        logger.warning(f"弱點分析失敗：{e}")
+        
+            if weakness_analysis:
+                log_bb(
+                    task_id, prompt_doc["subject"], "weakness_analysis",
+                    content="弱點分析完成",
+                    payload=weakness_analysis
+                )
+        except Exception as e:
+            logger.warning(f"弱點分析失敗：{e}")
+        return weakness_analysis
+
+    auto_future = _post_grading_pool.submit(_autotune_step)
+    weakness_future = _post_grading_pool.submit(_weakness_step)
     
     # 生成表格
-    gpt_table = render_final_table(gpt_items, gpt_total)
-    claude_table = render_final_table(claude_items, claude_total)
-    final_table = render_final_table(final_items, final_total)
+    gpt_table, claude_table, final_table = render_final_tables(
+        (gpt_items, claude_items, final_items), (gpt_total, claude_total, final_total))
+    
+    # 等待後處理完成（autotune 可能更新 prompt_doc["version"]，須在建立結果前完成）
+    auto_future.result()
+    weakness_analysis = weakness_future.result()
     
     # 創建批改結果
     result = GradingResult(exam_id, student_id, submission_id)
@@ -1712,7 +2239,7 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
     result.weakness_analysis = weakness_analysis
     
     # 記錄批改完成
-    log_prompt_blackboard(
+    log_bb(
         task_id, prompt_doc["subject"], "grading_complete",
         f"批改完成 - GPT: {gpt_total}, Claude: {claude_total}, 最終: {final_total}",
         payload={
@@ -1723,6 +2250,7 @@ def grade_single_submission(exam_id, student_id, submission_id, exam_content, an
             "consensus_count": len(direct_consensus_qids)
         }
     )
+    flush_blackboard(blackboard)
     
     return result
 
@@ -1734,23 +2262,16 @@ def exam_results(exam_id):
         flash("考試不存在", "error")
         return redirect(url_for("exams_list"))
     
-    grading_results = get_grading_results_by_exam(exam_id)
-    
-    # 統計資料
-    if grading_results:
-        scores = [r["final_score"] for r in grading_results if r["status"] == "completed"]
-        avg_score = sum(scores) / len(scores) if scores else 0
-        max_score = max(scores) if scores else 0
-        min_score = min(scores) if scores else 0
-    else:
-        avg_score = max_score = min_score = 0
+    # 列表只取頁面用到的欄位；統計交給 MongoDB 彙總
+    grading_results = get_grading_scores_by_exam(exam_id, _RESULT_LIST_FIELDS)
+    stats = get_exam_score_stats(exam_id) if grading_results else {"avg": 0, "max": 0, "min": 0}
     
     return render_template("teacher/exam_results.html",
                          exam=exam,
                          grading_results=grading_results,
-                         avg_score=avg_score,
-                         max_score=max_score,
-                         min_score=min_score)
+                         avg_score=stats["avg"] or 0,
+                         max_score=stats["max"] or 0,
+                         min_score=stats["min"] or 0)
 
 @app.route("/teacher/exams/<exam_id>/analysis")
 def class_analysis(exam_id):
@@ -1760,9 +2281,9 @@ def class_analysis(exam_id):
         flash("考試不存在", "error")
         return redirect(url_for("exams_list"))
     
-    # 獲取分析數據
+    # 獲取分析數據（學生列表只需連結與分數欄位）
     class_stats = analyze_class_performance(exam_id)
-    grading_results = get_grading_results_by_exam(exam_id)
+    grading_results = get_grading_scores_by_exam(exam_id, ("result_id", "student_id", "final_score"))
     
     return render_template("teacher/class_analysis.html",
                          exam=exam,
@@ -1786,65 +2307,40 @@ def student_detail(exam_id, student_id, result_id=None):
         # 否則使用原來的查詢方式
         result = get_grading_result(exam_id, student_id)
     
-    # 調試：直接查詢資料庫
-    logger.info(f"直接查詢資料庫: exam_id={exam_id}, student_id={student_id}")
-    direct_result = col_grading_results.find_one({"exam_id": exam_id, "student_id": student_id})
-    logger.info(f"直接查詢結果: {direct_result}")
+    # 調試：直接查詢資料庫（多一次查詢且輸出整份文件，只在 DEBUG 時執行）
+    if logger.isEnabledFor(logging.DEBUG):
+        direct_result = col_grading_results.find_one({"exam_id": exam_id, "student_id": student_id})
+        logger.debug("直接查詢資料庫: exam_id=%s, student_id=%s → %s", exam_id, student_id, direct_result)
     
     if not result:
         flash("找不到該學生的批改結果", "error")
         return redirect(url_for("exam_results", exam_id=exam_id))
     
+    # 弱點分析另存於 weakness_analyses，只在詳細頁載入
+    _attach_weakness_analysis(result)
+    
     # 獲取黑板訊息
     blackboard_messages = []
-    logger.info(f"批改結果: {result}")
-    logger.info(f"result.get('task_id'): {result.get('task_id')}")
-    logger.info(f"result.get('task_id') 的類型: {type(result.get('task_id'))}")
+    logger.debug("批改結果: %s", result)
     
     if result.get("task_id"):
         task_id = result["task_id"]
-        logger.info(f"開始獲取黑板訊息，task_id: {task_id}")
-        logger.info(f"task_id 類型: {type(task_id)}")
-        
-        # 直接測試資料庫查詢
-        from pymongo import MongoClient
-        mongodb_uri = os.getenv("MONGODB_URI", "mongodb://localhost:27017/")
-        client = MongoClient(mongodb_uri)
-        db_blackboard = client["grading_blackboard"]
-        col_bbmsgs = db_blackboard["blackboard_messages"]
-        
-        # 直接查詢
-        direct_messages = list(col_bbmsgs.find({"task_id": task_id}))
-        logger.info(f"直接查詢找到 {len(direct_messages)} 條訊息")
-        
-        # 直接構建訊息列表
-        blackboard_messages = []
-        for x in direct_messages:
-            blackboard_messages.append({
-                "type": x.get("type"),
-                "action": x.get("action"),
-                "content": x.get("content"),
-                "payload": x.get("payload"),
-                "timestamp": x.get("timestamp")
-            })
-        
-        logger.info(f"構建的黑板訊息: {blackboard_messages}")
-        
-        client.close()
+        blackboard_messages = get_blackboard_messages(task_id)
+        logger.info("task_id %s 找到 %d 條黑板訊息", task_id, len(blackboard_messages))
     else:
-        logger.warning(f"批改結果沒有 task_id: {result}")
+        logger.warning("批改結果沒有 task_id: result_id=%s", result.get("result_id"))
     
-    logger.info(f"傳遞給模板的 blackboard_messages: {blackboard_messages}")
-    logger.info(f"blackboard_messages 是否為空: {not blackboard_messages}")
+    logger.debug("傳遞給模板的 blackboard_messages: %s", blackboard_messages)
     
     # 如果沒有找到黑板訊息，記錄警告
     if not blackboard_messages:
         logger.warning("沒有找到黑板訊息")
     
     # 生成個人學習建議
-    logger.info(f"開始生成學習建議: exam_id={exam_id}, student_id={student_id}, result_id={result_id}")
-    learning_suggestions = generate_learning_suggestions(exam_id, student_id, result_id)
-    logger.info(f"生成的學習建議: {learning_suggestions}")
+    logger.info("開始生成學習建議: exam_id=%s, student_id=%s, result_id=%s", exam_id, student_id, result_id)
+    learning_suggestions = generate_learning_suggestions(exam_id, student_id, result_id,
+                                                         result=result, blackboard_messages=blackboard_messages)
+    logger.debug("生成的學習建議: %s", learning_suggestions)
     
     return render_template("teacher/student_detail.html",
                          exam=exam,
@@ -1908,26 +2404,66 @@ def api_prompt(subject):
         "prompt_content": pr["prompt_content"]
     })
 
+# 批改進度推送（Server-Sent Events）：以 MongoDB change stream 取代頁面輪詢
+# change stream 需要副本集（replica set）；單機 MongoDB 回傳 501，頁面維持手動「檢查狀態」
+# keep-alive 間隔即 getMore 的 max_await_time_ms，須小於 client 的 socketTimeoutMS，
+# 否則每次等待都會在用戶端逾時、丟棄連線並重新開啟串流；超過上限時改用上限
+_EXAM_EVENTS_KEEPALIVE_MAX_MS = MONGO_SOCKET_TIMEOUT_MS - 1000
+EXAM_EVENTS_KEEPALIVE_MS = int(os.getenv("EXAM_EVENTS_KEEPALIVE_MS", "4000"))
+if EXAM_EVENTS_KEEPALIVE_MS > _EXAM_EVENTS_KEEPALIVE_MAX_MS:
+    logger.warning(f"EXAM_EVENTS_KEEPALIVE_MS={EXAM_EVENTS_KEEPALIVE_MS} 不小於 MongoDB socketTimeoutMS，改用 {_EXAM_EVENTS_KEEPALIVE_MAX_MS}")
+    EXAM_EVENTS_KEEPALIVE_MS = _EXAM_EVENTS_KEEPALIVE_MAX_MS
+
+@app.get("/api/exams/<exam_id>/events")
+def api_exam_events(exam_id):
+    """推送該考試的提交狀態與考試狀態變更，考試批改結束後關閉串流"""
+    pipeline = [{"$match": {
+        "operationType": {"$in": ["insert", "update", "replace"]},
+        "ns.coll": {"$in": [col_submissions.name, col_exams.name]},
+        "fullDocument.exam_id": exam_id
+    }}]
+    try:
+        stream = db.watch(pipeline, full_document="updateLookup", max_await_time_ms=EXAM_EVENTS_KEEPALIVE_MS)
+    except mongo_errors.PyMongoError as e:
+        logger.warning(f"無法開啟 change stream（MongoDB 需為副本集）：{e}")
+        return jsonify({"success": False, "message": "目前的資料庫不支援即時推送"}), 501
+    
+    def events():
+        with stream:
+            yield ": connected\n\n"
+            while stream.alive:
+                change = stream.try_next()
+                if change is None:
+                    yield ": keep-alive\n\n"  # 客戶端斷線時由寫入失敗結束串流
+                    continue
+                doc = change.get("fullDocument") or {}
+                data = {
+                    "collection": change["ns"]["coll"],
+                    "submission_id": doc.get("submission_id"),
+                    "student_id": doc.get("student_id"),
+                    "status": doc.get("status"),
+                    "graded_students": doc.get("graded_students")
+                }
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                if data["collection"] == col_exams.name and data["status"] in ("completed", "failed"):
+                    break
+    
+    return Response(stream_with_context(events()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.get("/api/blackboard/<task_id>")
 def api_blackboard(task_id):
     """獲取指定任務的黑板訊息"""
     try:
-        # 連接到黑板資料庫
-        client = MongoClient(os.getenv("MONGODB_URI"))
-        db = client["grading_blackboard"]
-        col_bbmsgs = db["blackboard_messages"]
-        
-        cur = col_bbmsgs.find({"task_id": task_id}).sort("timestamp", 1)
-        out = []
-        for x in cur:
-            out.append({
-                "type": x.get("type"),
-                "action": x.get("action"),
-                "content": x.get("content"),
-                "payload": x.get("payload"),
-                "timestamp": x.get("timestamp").isoformat() if x.get("timestamp") else None
-            })
-        return jsonify(out)
+        cur = (col_bbmsgs.find({"task_id": task_id}, projection=_BBMSG_PROJECTION)
+               .sort("timestamp", 1).batch_size(_BBMSG_BATCH_SIZE))
+        return jsonify([{
+            "type": x.get("type"),
+            "action": x.get("action"),
+            "content": x.get("content"),
+            "payload": x.get("payload"),
+            "timestamp": x["timestamp"].isoformat() if x.get("timestamp") else None
+        } for x in cur])
     except Exception as e:
         logger.error(f"獲取黑板訊息失敗: {e}")
         return jsonify([])
@@ -1950,8 +2486,7 @@ def api_security_check():
         
         # 導入安全檢查代理人
         try:
-            from 安全檢查代理人 import get_checker
-            checker = get_checker()
+            checker = get_checker() if get_checker is not None else None
             
             if checker is None:
                 logger.warning("安全檢查代理人未初始化，跳過檢查")
@@ -1963,14 +2498,14 @@ def api_security_check():
                 })
             
             # 執行安全檢查
-            logger.info(f"開始安全檢查，答案長度: {len(answer)}")
+            logger.info("開始安全檢查，答案長度: %d", len(answer))
             security_result = checker.check(question, answer)
             
             is_attack = security_result.get('is_attack', False)
             reason = security_result.get('reason', '未知')
             raw_reply = security_result.get('raw_reply', '')
             
-            logger.info(f"安全檢查完成: {'攻擊行為' if is_attack else '安全'} - {reason}")
+            logger.info("安全檢查完成: %s - %s", "攻擊行為" if is_attack else "安全", reason)
             
             return jsonify({
                 "success": True,
@@ -1998,6 +2533,57 @@ def api_security_check():
             "error": str(e)
         }), 500
 
+@app.post("/api/security-check/batch")
+def api_security_check_batch():
+    """批次安全檢查 API - 一次送入多筆 {question, answer}，合併為少量代理人對話，結果依輸入順序回傳"""
+    try:
+        data = request.get_json() or {}
+        items = data.get("items") or []
+        if not isinstance(items, list):
+            return jsonify({"success": False, "error": "items 必須為陣列"}), 400
+        
+        check_time = datetime.now().isoformat()
+        results = [None] * len(items)
+        pending = []  # (原索引, (question, answer))
+        for i, it in enumerate(items):
+            answer = (it or {}).get("answer", "")
+            if not answer:
+                results[i] = {"is_attack": False, "reason": "答案為空，跳過安全檢查"}
+            else:
+                pending.append((i, ((it or {}).get("question", ""), answer)))
+        
+        if pending:
+            try:
+                checker = get_checker() if get_checker is not None else None
+                if checker is None:
+                    logger.warning("安全檢查代理人未初始化，跳過檢查")
+                    for i, _ in pending:
+                        results[i] = {"is_attack": False, "reason": "安全檢查代理人未啟用"}
+                else:
+                    logger.info(f"開始批次安全檢查，共 {len(pending)} 筆")
+                    verdicts = checker.check_many([pair for _, pair in pending])
+                    for (i, _), v in zip(pending, verdicts):
+                        results[i] = {
+                            "is_attack": v.get("is_attack", False),
+                            "reason": v.get("reason", "未知"),
+                            "raw_reply": v.get("raw_reply", ""),
+                        }
+                    logger.info(f"批次安全檢查完成，攻擊行為 {sum(1 for v in verdicts if v.get('is_attack'))} 筆")
+            except Exception as e:
+                logger.error(f"批次安全檢查執行失敗: {e}")
+                # 與單筆端點一致：檢查失敗時不阻斷批改流程
+                for i, _ in pending:
+                    results[i] = {"is_attack": False, "reason": f"安全檢查執行失敗: {str(e)}", "error": str(e)}
+        
+        return jsonify({"success": True, "results": results, "check_time": check_time})
+        
+    except Exception as e:
+        logger.error(f"API 批次安全檢查失敗: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 500
+
 @app.get("/api/system-status")
 def api_system_status():
     """獲取系統狀態"""
@@ -2006,10 +2592,11 @@ def api_system_status():
         agent_ok = False
         agent_msg = ""
         try:
-            from 安全檢查代理人 import get_checker
             if get_checker is not None:
                 c = get_checker()
                 agent_ok = True if c is not None else False
+            else:
+                agent_msg = "安全檢查代理人模組未載入"
         except Exception as e:
             agent_msg = f"{e}"
         
@@ -2089,15 +2676,18 @@ def old_grade():
     task_id = str(uuid.uuid4())
     ex_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_exam_{secure_filename(exam_file.filename)}")
     st_path = os.path.join(app.config["UPLOAD_FOLDER"], f"{task_id}_student_{secure_filename(ans_file.filename)}")
-    exam_file.save(ex_path)
-    ans_file.save(st_path)
 
+    # 直接解析上傳串流，不先寫檔再重新開啟；解析成功後才存檔留底
     try:
-        exam_raw = read_text(ex_path)
-        answer_raw = read_text(st_path)
+        exam_raw = read_text(exam_file.stream, exam_file.filename)
+        answer_raw = read_text(ans_file.stream, ans_file.filename)
     except Exception as e:
         flash(f"讀檔失敗：{e}", "error")
         return redirect(url_for("old_index", subject=subject))
+    exam_file.stream.seek(0)
+    exam_file.save(ex_path)
+    ans_file.stream.seek(0)
+    ans_file.save(st_path)
 
     # 執行批改邏輯（簡化版本）
     try:
@@ -2132,26 +2722,26 @@ def export_results(exam_id):
         flash("考試不存在", "error")
         return redirect(url_for("exams_list"))
     
-    grading_results = get_grading_results_by_exam(exam_id)
+    grading_results = iter_grading_results_by_exam(
+        exam_id, ("student_id", "gpt_score", "claude_score", "final_score", "graded_at"))
     
-    # 創建Excel檔案
-    data = []
+    # 以 openpyxl 唯寫模式逐列寫入（列資料直接寫進暫存 XML，不在記憶體中保留整張表）
+    from openpyxl import Workbook  # 只有匯出 Excel 會用到，延後載入以加快啟動
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("考試結果")
+    ws.append(["學生ID", "GPT分數", "Claude分數", "最終分數", "批改時間"])
     for result in grading_results:
-        data.append({
-            "學生ID": result["student_id"],
-            "GPT分數": result["gpt_score"],
-            "Claude分數": result["claude_score"],
-            "最終分數": result["final_score"],
-            "批改時間": result["graded_at"].strftime("%Y-%m-%d %H:%M:%S")
-        })
-    
-    df = pd.DataFrame(data)
-    
-    # 創建Excel檔案在記憶體中
+        ws.append([
+            result["student_id"],
+            result["gpt_score"],
+            result["claude_score"],
+            result["final_score"],
+            result["graded_at"].strftime("%Y-%m-%d %H:%M:%S")
+        ])
+    
+    # 記憶體中只保留壓縮後的 xlsx
     output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, sheet_name='考試結果', index=False)
-    
+    wb.save(output)
     output.seek(0)
     
     return send_file(
@@ -2168,6 +2758,16 @@ def export_results(exam_id):
 # ----------------------------------------------------------------------
 # API 端點 - 用於外部系統整合
 # ----------------------------------------------------------------------
+def _grade_question_with(grader, q_id, q_text, answer, q_score, prompt_text):
+    """在工作執行緒中以指定代理人批改單一題目，回傳附上題號的結果"""
+    result = grader(
+        question=q_text,
+        answer=answer,
+        max_score=q_score,
+        prompt_text=prompt_text
+    )
+    return {"id": q_id, **result}
+
 @app.route("/api/grade_single", methods=["POST"])
 def api_grade_single():
     """
@@ -2179,11 +2779,11 @@ def api_grade_single():
         
         # 驗證必要欄位
         required_fields = ["question", "answer", "subject", "max_score"]
-        for field in required_fields:
-            if field not in data:
+        for key in required_fields:
+            if key not in data:
                 return jsonify({
                     "success": False,
-                    "message": f"缺少必要欄位：{field}"
+                    "message": f"缺少必要欄位：{key}"
                 }), 400
         
         question_text = data["question"]
@@ -2216,36 +2816,26 @@ def api_grade_single():
         except:
             answers_list = split_by_question(answer_text)
         
-        # 執行批改
-        gpt_results = []
-        claude_results = []
-        
+        # 執行批改（答案依題號建立索引，避免每題線性搜尋）
+        answers_by_id = {a["id"]: a for a in reversed(answers_list)}  # 題號重複時與原本一樣取第一筆
+        jobs = []
         for q_item in questions_list:
             q_id = q_item["id"]
             q_text = q_item["text"]
             q_score = q_item.get("score", max_score // len(questions_list))
             
             # 找到對應的答案
-            answer_item = next((a for a in answers_list if a["id"] == q_id), None)
+            answer_item = answers_by_id.get(q_id)
             answer = answer_item["text"] if answer_item else ""
-            
-            # 調用 GPT 批改
-            gpt_result = call_gpt_grader(
-                question=q_text,
-                answer=answer,
-                max_score=q_score,
-                prompt_text=prompt_doc["prompt"]
-            )
-            gpt_results.append({"id": q_id, **gpt_result})
-            
-            # 調用 Claude 批改
-            claude_result = call_claude_grader(
-                question=q_text,
-                answer=answer,
-                max_score=q_score,
-                prompt_text=prompt_doc["prompt"]
-            )
-            claude_results.append({"id": q_id, **claude_result})
+            jobs.append((q_id, q_text, answer, q_score, prompt_doc["prompt"]))
+        
+        # 各題的 GPT / Claude 呼叫彼此獨立，全部同時送出（同時進行數以 GRADING_CONCURRENCY 為上限）
+        workers = max(1, min(2 * len(jobs), GRADING_CONCURRENCY))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            gpt_futures = [pool.submit(_grade_question_with, call_gpt_grader, *job) for job in jobs]
+            claude_futures = [pool.submit(_grade_question_with, call_claude_grader, *job) for job in jobs]
+            gpt_results = [f.result() for f in gpt_futures]
+            claude_results = [f.result() for f in claude_futures]
         
         # 計算總分
         gpt_total = sum(r.get("score", 0) for r in gpt_results)
@@ -2255,11 +2845,13 @@ def api_grade_single():
         final_score = round((gpt_total + claude_total) / 2)
         
         # 生成回饋
+        gpt_by_id = {r["id"]: r for r in reversed(gpt_results)}
+        claude_by_id = {r["id"]: r for r in reversed(claude_results)}
         feedback_parts = []
         for i, q_item in enumerate(questions_list):
             q_id = q_item["id"]
-            gpt_r = next((r for r in gpt_results if r["id"] == q_id), {})
-            claude_r = next((r for r in claude_results if r["id"] == q_id), {})
+            gpt_r = gpt_by_id.get(q_id, {})
+            claude_r = claude_by_id.get(q_id, {})
             
             avg_score = round((gpt_r.get("score", 0) + claude_r.get("score", 0)) / 2)
             feedback_parts.append(f"Q{q_id}: {avg_score}/{q_item.get('score', 0)}分")
@@ -2296,6 +2888,19 @@ if __name__ == "__main__":
     print("="*60)
     print("自動批改系統教師版 - 考試管理與自動批改系統")
     print("="*60)
-    app.run(host=os.getenv("FLASK_HOST","0.0.0.0"),
-            port=int(os.getenv("TEACHER_PORT","5001")),
-            debug=os.getenv("FLASK_DEBUG","True").lower() == "true")
+    host = os.getenv("FLASK_HOST", "0.0.0.0")
+    port = int(os.getenv("TEACHER_PORT", "5001"))
+    debug = os.getenv("FLASK_DEBUG", "False").lower() == "true"
+    
+    # 頁面多半在等 Mongo / LLM 回應，以多執行緒伺服器同時處理多個請求
+    if not debug:
+        try:
+            from waitress import serve
+            threads = int(os.getenv("TEACHER_APP_THREADS", "16"))
+            logger.info(f"使用 waitress 啟動（threads={threads}）")
+            serve(app, host=host, port=port, threads=threads)
+            raise SystemExit(0)
+        except ImportError:
+            logger.warning("未安裝 waitress，改用 Flask 內建伺服器（多執行緒模式）")
+    
+    app.run(host=host, port=port, debug=debug, threaded=True)